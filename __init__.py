@@ -8,6 +8,7 @@ from importlib.metadata import version
 __version__ = version("k3zkutil")
 
 from .exceptions import (
+    BackwardLockingConflict,
     ZKWaitTimeout,
 )
 
@@ -43,15 +44,73 @@ from .zkutil import (
 from .zklock import (
     ZKLock,
     LockTimeout,
+    get_lock_owner,
     make_identifier,
+    set_lock_vals,
+    try_acquire_many,
+)
+
+from .zklockstats import (
+    ZKLockStats,
+)
+
+from .zklockmanager import (
+    ZKLockManager,
+)
+
+from .zksemaphore import (
+    ZKSemaphore,
+)
+
+from .zklockreaper import (
+    AgeLiveness,
+    HeartbeatLiveness,
+    LocalPidLiveness,
+    ZKLockReaper,
+    register_heartbeat,
+)
+
+from .zklockscan import (
+    LockIndex,
+    list_locks,
+    migrate_lock_shards,
+    scan_locks,
+)
+
+from .zklockset import (
+    ZKLockSet,
+    ZKOrderedLockSet,
+)
+
+from .zkrwlock import (
+    ZKRWLock,
+)
+
+from .zkaio import (
+    AsyncZKLock,
+    as_future,
+    async_cas_loop,
+    async_get_next,
+    async_wait_absent,
+)
+
+from .dispatcher import (
+    AsyncioDispatcher,
+    ThreadDispatcher,
 )
 
 from .cached_reader import (
     CachedReader,
+    CachedReaderRegistry,
+    CachedReaderView,
+    CachedTreeReader,
+    dict_diff,
+    shared_cached_reader,
 )
 
 __all__ = [
     "PermTypeError",
+    "BackwardLockingConflict",
     "ZKWaitTimeout",
     "ZkPathError",
     "cas_loop",
@@ -73,7 +132,37 @@ __all__ = [
     "wait_absent",
     "get_next",
     "ZKLock",
+    "ZKLockManager",
+    "ZKLockStats",
+    "ZKLockReaper",
+    "AgeLiveness",
+    "HeartbeatLiveness",
+    "LocalPidLiveness",
+    "register_heartbeat",
+    "LockIndex",
+    "list_locks",
+    "migrate_lock_shards",
+    "scan_locks",
+    "ZKLockSet",
+    "ZKOrderedLockSet",
+    "ZKRWLock",
+    "ZKSemaphore",
+    "AsyncZKLock",
+    "as_future",
+    "async_cas_loop",
+    "async_get_next",
+    "async_wait_absent",
     "LockTimeout",
     "CachedReader",
+    "AsyncioDispatcher",
+    "ThreadDispatcher",
+    "CachedReaderRegistry",
+    "CachedReaderView",
+    "CachedTreeReader",
+    "dict_diff",
+    "shared_cached_reader",
+    "get_lock_owner",
     "make_identifier",
+    "set_lock_vals",
+    "try_acquire_many",
 ]
@@ -0,0 +1,3 @@
+from .zkcli import main
+
+main()
@@ -0,0 +1,3 @@
+"""
+Benchmark suite of k3zkutil, see `zkbench`.
+"""
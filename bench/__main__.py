@@ -0,0 +1,3 @@
+from .zkbench import main
+
+main()
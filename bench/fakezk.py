@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+An in-process zookeeper stand-in for benchmarking without a zookeeper server.
+
+`FakeServer` keeps znodes in memory and `FakeClient` is a `KazooClient` that
+talks to it. Requests of one client are served in order by one thread, and
+every reply is delayed by `rtt` seconds, thus pipelined requests overlap the
+same way they do over a real connection.
+
+Only what k3zkutil uses is implemented: create, get, exists, get_children, set,
+delete, ensure_path, transaction, watches and connection listeners. ACL and
+auth are ignored.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import ConnectionClosedError
+from kazoo.exceptions import NoChildrenForEphemeralsError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NotEmptyError
+from kazoo.exceptions import RolledBackError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+logger = logging.getLogger(__name__)
+
+
+class _Node(object):
+    def __init__(self, value, owner, zxid, now):
+        self.value = value
+        self.version = 0
+        self.owner = owner
+        self.czxid = zxid
+        self.mzxid = zxid
+        self.ctime = now
+        self.mtime = now
+        self.cversion = 0
+        self.seq = 0
+        self.children = set()
+
+
+class FakeServer(object):
+    """
+    In memory znode tree shared by `FakeClient`s.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.nodes = {"/": _Node(b"", 0, 0, 0)}
+        self.zxid = 0
+        self.session_id = 0
+
+        # path to {(client, watch_func)}
+        self.data_watches = {}
+        self.child_watches = {}
+
+    def new_session(self):
+        with self.lock:
+            self.session_id += 1
+            return self.session_id
+
+    def close_session(self, session_id):
+        with self.lock:
+            paths = [p for p, n in self.nodes.items() if n.owner == session_id]
+            for p in sorted(paths, reverse=True):
+                self._fire(self._delete(p, -1))
+
+            for watches in (self.data_watches, self.child_watches):
+                for p in list(watches.keys()):
+                    watches[p] = {w for w in watches[p] if w[0].session_id != session_id}
+
+    def watch(self, client, path, func, child=False):
+        watches = self.child_watches if child else self.data_watches
+        watches.setdefault(path, set()).add((client, func))
+
+    def create(self, client, path, value, ephemeral, sequence, makepath):
+        with self.lock:
+            if makepath:
+                self._ensure(_parent(path))
+
+            path, events = self._create(client, path, value, ephemeral, sequence)
+            self._fire(events)
+            return path
+
+    def ensure_path(self, path):
+        with self.lock:
+            self._ensure(path)
+
+    def get(self, client, path, watch):
+        with self.lock:
+            node = self._get_node(path)
+            if watch is not None:
+                self.watch(client, path, watch)
+            return node.value, self._stat(path)
+
+    def exists(self, client, path, watch):
+        with self.lock:
+            if watch is not None:
+                self.watch(client, path, watch)
+
+            if path not in self.nodes:
+                return None
+            return self._stat(path)
+
+    def get_children(self, client, path, watch, include_data):
+        with self.lock:
+            node = self._get_node(path)
+            if watch is not None:
+                self.watch(client, path, watch, child=True)
+
+            children = list(node.children)
+            if include_data:
+                return children, self._stat(path)
+            return children
+
+    def set(self, client, path, value, version):
+        with self.lock:
+            stat, events = self._set(path, value, version)
+            self._fire(events)
+            return stat
+
+    def delete(self, client, path, version):
+        with self.lock:
+            self._fire(self._delete(path, version))
+            return True
+
+    def multi(self, client, ops):
+        # Apply all operations or none of them.
+        with self.lock:
+            # original nodes touched by this transaction, `None` for absent
+            saved = {}
+            zxid = self.zxid
+
+            rsts = []
+            events = []
+            for op, args in ops:
+                path = args[0]
+                for p in (path, _parent(path)):
+                    if p not in saved:
+                        saved[p] = _copy_node(self.nodes.get(p))
+
+                try:
+                    if op == "create":
+                        path, evs = self._create(client, *args)
+                        saved.setdefault(path, None)
+                        rsts.append(path)
+                    elif op == "delete":
+                        evs = self._delete(*args)
+                        rsts.append(True)
+                    elif op == "set":
+                        stat, evs = self._set(*args)
+                        rsts.append(stat)
+                    else:
+                        path, version = args
+                        if self._get_node(path).version != version:
+                            raise BadVersionError()
+                        evs = []
+                        rsts.append(True)
+                except Exception as e:
+                    self._restore(saved, zxid)
+                    return [RolledBackError() for _ in rsts] + [e] + [RolledBackError() for _ in ops[len(rsts) + 1 :]]
+
+                events.extend(evs)
+
+            self._fire(events)
+            return rsts
+
+    def _ensure(self, path):
+        parts = [x for x in path.split("/") if x != ""]
+        for i in range(len(parts)):
+            p = "/" + "/".join(parts[: i + 1])
+            if p not in self.nodes:
+                self._fire(self._create(None, p, b"", False, False)[1])
+
+    def _create(self, client, path, value, ephemeral, sequence):
+        parent = self._get_node(_parent(path))
+        if parent.owner:
+            raise NoChildrenForEphemeralsError()
+
+        if sequence:
+            path = "{p}{s:0>10}".format(p=path, s=parent.seq)
+            parent.seq += 1
+
+        if path in self.nodes:
+            raise NodeExistsError()
+
+        self.zxid += 1
+        owner = client.session_id if ephemeral else 0
+        self.nodes[path] = _Node(value, owner, self.zxid, _now_ms())
+        parent.children.add(_basename(path))
+        parent.cversion += 1
+
+        return path, [
+            (self.data_watches, path, EventType.CREATED),
+            (self.child_watches, _parent(path), EventType.CHILD),
+        ]
+
+    def _delete(self, path, version):
+        node = self._get_node(path)
+        if version != -1 and node.version != version:
+            raise BadVersionError()
+        if len(node.children) > 0:
+            raise NotEmptyError()
+
+        self.zxid += 1
+        del self.nodes[path]
+        parent = self.nodes[_parent(path)]
+        parent.children.discard(_basename(path))
+        parent.cversion += 1
+
+        return [
+            (self.data_watches, path, EventType.DELETED),
+            (self.child_watches, path, EventType.DELETED),
+            (self.child_watches, _parent(path), EventType.CHILD),
+        ]
+
+    def _set(self, path, value, version):
+        node = self._get_node(path)
+        if version != -1 and node.version != version:
+            raise BadVersionError()
+
+        self.zxid += 1
+        node.value = value
+        node.version += 1
+        node.mzxid = self.zxid
+        node.mtime = _now_ms()
+
+        return self._stat(path), [(self.data_watches, path, EventType.CHANGED)]
+
+    def _fire(self, events):
+        for watches, path, typ in events:
+            for client, func in watches.pop(path, ()):
+                client._queue_event(func, WatchedEvent(typ, KeeperState.CONNECTED, path))
+
+    def _get_node(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            raise NoNodeError()
+        return node
+
+    def _stat(self, path):
+        n = self.nodes[path]
+        return ZnodeStat(
+            n.czxid,
+            n.mzxid,
+            n.ctime,
+            n.mtime,
+            n.version,
+            n.cversion,
+            0,
+            n.owner,
+            len(n.value),
+            len(n.children),
+            n.czxid,
+        )
+
+    def _restore(self, saved, zxid):
+        for p, node in saved.items():
+            if node is None:
+                self.nodes.pop(p, None)
+            else:
+                self.nodes[p] = node
+        self.zxid = zxid
+
+
+class FakeTransaction(object):
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def create(self, path, value=b"", acl=None, ephemeral=False, sequence=False):
+        self.ops.append(("create", (_norm(path), value, ephemeral, sequence)))
+
+    def delete(self, path, version=-1):
+        self.ops.append(("delete", (_norm(path), version)))
+
+    def set_data(self, path, value, version=-1):
+        self.ops.append(("set", (_norm(path), value, version)))
+
+    def check(self, path, version):
+        self.ops.append(("check", (_norm(path), version)))
+
+    def commit_async(self):
+        return self.client._submit(self.client.server.multi, self.client, self.ops)
+
+    def commit(self):
+        return self.commit_async().get()
+
+
+class FakeClient(KazooClient):
+    """
+    A `KazooClient` connected to a `FakeServer`.
+
+        srv = FakeServer()
+        zk = FakeClient(srv, rtt=0.001)
+        zk.start()
+        with ZKLock("foo", zkclient=zk):
+            ...
+    """
+
+    def __init__(self, server, rtt=0.0, hosts="127.0.0.1:2181", **kwargs):
+        super(FakeClient, self).__init__(hosts=hosts, **kwargs)
+
+        self.server = server
+        self.rtt = rtt
+        self.session_id = None
+
+        self._requests = None
+        self._events = None
+
+    def start(self, timeout=15):
+        if self._live.is_set():
+            return
+
+        self.handler.start()
+
+        self.session_id = self.server.new_session()
+        self._session_id = self.session_id
+        self._session_passwd = b"fake"
+
+        self._requests = queue.Queue()
+        self._events = queue.Queue()
+        for target in (self._serve_requests, self._serve_events):
+            th = threading.Thread(target=target, args=(self._requests, self._events))
+            th.daemon = True
+            th.start()
+
+        self._stopped.clear()
+        self._live.set()
+        self._set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        if not self._live.is_set():
+            return
+
+        self._live.clear()
+        self._stopped.set()
+
+        self.server.close_session(self.session_id)
+        self._set_state(KazooState.LOST)
+
+        self._requests.put(None)
+        self._events.put(None)
+
+    def close(self):
+        pass
+
+    def create_async(
+        self, path, value=b"", acl=None, ephemeral=False, sequence=False, makepath=False, include_data=False
+    ):
+        srv = self.server
+
+        def _create():
+            p = srv.create(self, _norm(path), value, ephemeral, sequence, makepath)
+            if include_data:
+                return p, srv._stat(p)
+            return p
+
+        return self._submit(_create)
+
+    def create(self, path, value=b"", acl=None, ephemeral=False, sequence=False, makepath=False, include_data=False):
+        return self.create_async(path, value, acl, ephemeral, sequence, makepath, include_data).get()
+
+    def ensure_path_async(self, path, acl=None):
+        return self._submit(self.server.ensure_path, _norm(path))
+
+    def ensure_path(self, path, acl=None):
+        return self.ensure_path_async(path).get()
+
+    def get_async(self, path, watch=None):
+        return self._submit(self.server.get, self, _norm(path), watch)
+
+    def get(self, path, watch=None):
+        return self.get_async(path, watch).get()
+
+    def exists_async(self, path, watch=None):
+        return self._submit(self.server.exists, self, _norm(path), watch)
+
+    def exists(self, path, watch=None):
+        return self.exists_async(path, watch).get()
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return self._submit(self.server.get_children, self, _norm(path), watch, include_data)
+
+    def get_children(self, path, watch=None, include_data=False):
+        return self.get_children_async(path, watch, include_data).get()
+
+    def set_async(self, path, value, version=-1):
+        return self._submit(self.server.set, self, _norm(path), value, version)
+
+    def set(self, path, value, version=-1):
+        return self.set_async(path, value, version).get()
+
+    def delete_async(self, path, version=-1):
+        return self._submit(self.server.delete, self, _norm(path), version)
+
+    def delete(self, path, version=-1, recursive=False):
+        if recursive:
+            for c in self.get_children(path):
+                self.delete(path.rstrip("/") + "/" + c, recursive=True)
+
+        return self.delete_async(path, version).get()
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def _submit(self, func, *args):
+        if not self._live.is_set():
+            raise ConnectionClosedError("Connection has been closed")
+
+        rst = self.handler.async_result()
+        self._requests.put((time.time() + self.rtt, func, args, rst))
+        return rst
+
+    def _serve_requests(self, requests, events):
+        # Serve requests in order, every reply arrives `rtt` seconds after
+        # the request is sent.
+        while True:
+            req = requests.get()
+            if req is None:
+                return
+
+            due, func, args, rst = req
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                rst.set(func(*args))
+            except Exception as e:
+                rst.set_exception(e)
+
+    def _serve_events(self, requests, events):
+        # watch functions and connection listeners run in one thread, the same
+        # as kazoo does.
+        while True:
+            ev = events.get()
+            if ev is None:
+                return
+
+            func, arg = ev
+            try:
+                func(arg)
+            except Exception as e:
+                logger.exception(repr(e) + " while calling {f}".format(f=func))
+
+    def _queue_event(self, func, arg):
+        if self._events is not None:
+            self._events.put((func, arg))
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in list(self.state_listeners):
+            self._queue_event(listener, state)
+
+
+def _copy_node(node):
+    if node is None:
+        return None
+
+    c = _Node(node.value, node.owner, node.czxid, node.ctime)
+    c.__dict__.update(node.__dict__)
+    c.children = set(node.children)
+    return c
+
+
+def _norm(path):
+    return "/" + path.strip("/")
+
+
+def _parent(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+
+def _basename(path):
+    return path.rsplit("/", 1)[-1]
+
+
+def _now_ms():
+    return int(time.time() * 1000)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks of `ZKLock`, `cas_loop` and `CachedReader`.
+
+Run against an in-process fake zookeeper:
+
+    python -m k3zkutil.bench --rtt 0.001
+
+Or against a zookeeper server:
+
+    python -m k3zkutil.bench --hosts 127.0.0.1:2181 --procs 1,4
+
+Every result is printed as one line of json, such as:
+
+    {"bench": "lock", "threads": 4, "procs": 1, "names": 1, "ops": 800,
+     "ops_per_sec": 1520.3, "p50_ms": 1.9, "p99_ms": 7.2, ...}
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+from kazoo.client import KazooClient
+
+from ..cached_reader import CachedReader
+from ..zkacid import cas_loop
+from ..zkconf import ZKConf
+from ..zklock import ZKLock
+from .fakezk import FakeClient
+from .fakezk import FakeServer
+
+
+class ClientFactory(object):
+    """
+    Make started zk clients of a zookeeper server at `hosts`, or of one
+    `FakeServer` if `hosts` is `None`.
+    """
+
+    def __init__(self, hosts=None, rtt=0.0):
+        self.hosts = hosts
+        self.rtt = rtt
+        self.server = FakeServer() if hosts is None else None
+
+    def target(self):
+        if self.hosts is None:
+            return "fake(rtt={r})".format(r=self.rtt)
+        return self.hosts
+
+    def __call__(self):
+        if self.hosts is None:
+            zk = FakeClient(self.server, rtt=self.rtt)
+        else:
+            zk = KazooClient(hosts=self.hosts)
+
+        zk.start()
+        return zk
+
+
+def bench_lock(make_client, threads=1, procs=1, names=1, ops=100, lock_kwargs=None):
+    """
+    Measure acquire latency and acquire/release throughput of `ZKLock`.
+
+    `procs` processes each run `threads` threads sharing one zk client, every
+    thread acquires and releases a random one of `names` locks `ops` times.
+    """
+    lock_kwargs = lock_kwargs or {}
+
+    zk = make_client()
+    zk.ensure_path(ZKConf().lock_dir())
+
+    args = (threads, names, ops, lock_kwargs)
+    t0 = time.time()
+    if procs == 1:
+        latencies = _lock_proc(zk, *args)
+    else:
+        if make_client.hosts is None:
+            raise ValueError("fake zookeeper can not be shared by processes")
+
+        with multiprocessing.Pool(procs) as pool:
+            rsts = pool.starmap(_lock_proc_main, [(make_client.hosts,) + args] * procs)
+        latencies = [x for rst in rsts for x in rst]
+    spent = time.time() - t0
+
+    zk.stop()
+
+    rst = {
+        "bench": "lock",
+        "threads": threads,
+        "procs": procs,
+        "names": names,
+        "lock_kwargs": lock_kwargs,
+    }
+    rst.update(_summary(latencies, spent))
+    return rst
+
+
+def bench_cas(make_client, threads=1, ops=100):
+    """
+    Measure throughput of `cas_loop` increasing one counter from `threads`
+    threads, and how many times a cas conflicts.
+    """
+    zk = make_client()
+
+    path = "/k3zkutil_bench_cas"
+    try:
+        zk.delete(path)
+    except Exception:
+        pass
+    zk.create(path, b"0")
+
+    latencies = []
+    # one count per thread, summed up after all threads are done
+    conflicts = []
+
+    def _work():
+        n = 0
+        for _ in range(ops):
+            t = time.time()
+            for curr in cas_loop(zk, path):
+                curr.v += 1
+            latencies.append(time.time() - t)
+            n += curr.n
+        conflicts.append(n)
+
+    spent = _run_threads(threads, _work)
+
+    val, _ = zk.get(path)
+    assert int(val) == threads * ops
+    zk.delete(path)
+    zk.stop()
+
+    rst = {
+        "bench": "cas",
+        "threads": threads,
+        "conflicts": sum(conflicts),
+    }
+    rst.update(_summary(latencies, spent))
+    return rst
+
+
+def bench_cached_reader(make_client, readers=1, updates=100):
+    """
+    Measure the time it takes for an update to reach all of `readers`
+    `CachedReader`s on one node.
+    """
+    zk = make_client()
+
+    path = "/k3zkutil_bench_reader"
+    try:
+        zk.delete(path)
+    except Exception:
+        pass
+    zk.create(path, json.dumps({"i": -1}).encode("utf-8"))
+
+    mutex = threading.Lock()
+    seen = {"i": -1, "n": 0}
+    all_seen = threading.Event()
+
+    def _on_change(p, old, new):
+        with mutex:
+            if new["i"] != seen["i"]:
+                return
+            seen["n"] += 1
+            if seen["n"] == readers:
+                all_seen.set()
+
+    crs = [CachedReader(zk, path, callback=_on_change) for _ in range(readers)]
+
+    latencies = []
+    t0 = time.time()
+    for i in range(updates):
+        with mutex:
+            seen["i"] = i
+            seen["n"] = 0
+            all_seen.clear()
+
+        t = time.time()
+        zk.set(path, json.dumps({"i": i}).encode("utf-8"))
+        if not all_seen.wait(10):
+            raise RuntimeError("CachedReader did not see update {i}".format(i=i))
+        latencies.append(time.time() - t)
+    spent = time.time() - t0
+
+    for cr in crs:
+        cr.close()
+    zk.delete(path)
+    zk.stop()
+
+    rst = {
+        "bench": "cached_reader",
+        "readers": readers,
+    }
+    rst.update(_summary(latencies, spent))
+    return rst
+
+
+def _lock_proc_main(hosts, threads, names, ops, lock_kwargs):
+    zk = ClientFactory(hosts)()
+    try:
+        return _lock_proc(zk, threads, names, ops, lock_kwargs)
+    finally:
+        zk.stop()
+
+
+def _lock_proc(zk, threads, names, ops, lock_kwargs):
+    latencies = []
+
+    def _work():
+        rnd = random.Random()
+        for _ in range(ops):
+            lck = ZKLock("bench_{i}".format(i=rnd.randrange(names)), zkclient=zk, timeout=60, **lock_kwargs)
+
+            t = time.time()
+            lck.acquire()
+            latencies.append(time.time() - t)
+
+            lck.release()
+
+    _run_threads(threads, _work)
+    return latencies
+
+
+def _run_threads(n, target):
+    ths = [threading.Thread(target=target) for _ in range(n)]
+
+    t0 = time.time()
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+
+    return time.time() - t0
+
+
+def _summary(latencies, spent):
+    latencies = sorted(latencies)
+    n = len(latencies)
+
+    def _pct(p):
+        if n == 0:
+            return None
+        return round(latencies[int(p * (n - 1))] * 1000, 3)
+
+    return {
+        "ops": n,
+        "seconds": round(spent, 3),
+        "ops_per_sec": round(n / spent, 1) if spent > 0 else None,
+        "p50_ms": _pct(0.5),
+        "p99_ms": _pct(0.99),
+    }
+
+
+def _int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m k3zkutil.bench", description="k3zkutil benchmarks")
+    parser.add_argument("--hosts", help="zookeeper hosts, use an in-process fake zookeeper if absent")
+    parser.add_argument("--rtt", type=float, default=0.0, help="round trip time in seconds of fake zookeeper")
+    parser.add_argument("--bench", default="lock,cas,cached_reader", help="benchmarks to run")
+    parser.add_argument("--threads", type=_int_list, default=[1, 4, 16])
+    parser.add_argument("--procs", type=_int_list, default=[1])
+    parser.add_argument("--names", type=_int_list, default=[1, 100])
+    parser.add_argument("--readers", type=_int_list, default=[1, 10, 100])
+    parser.add_argument("--ops", type=int, default=100, help="operations per thread")
+    parser.add_argument("--lock-kwargs", type=json.loads, default={}, help="json, such as '{\"local_first\": true}'")
+    parser.add_argument("--output", help="append results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    make_client = ClientFactory(args.hosts, args.rtt)
+    benches = args.bench.split(",")
+
+    if args.output is None:
+        _run_benches(args, make_client, benches, sys.stdout)
+    else:
+        with open(args.output, "a") as out:
+            _run_benches(args, make_client, benches, out)
+
+
+def _run_benches(args, make_client, benches, out):
+    def _emit(rst):
+        rst["target"] = make_client.target()
+        rst["time"] = int(time.time())
+        out.write(json.dumps(rst, sort_keys=True) + "\n")
+        out.flush()
+
+    if "lock" in benches:
+        for procs in args.procs:
+            for threads in args.threads:
+                for names in args.names:
+                    _emit(bench_lock(make_client, threads, procs, names, args.ops, args.lock_kwargs))
+
+    if "cas" in benches:
+        for threads in args.threads:
+            _emit(bench_cas(make_client, threads, args.ops))
+
+    if "cached_reader" in benches:
+        for readers in args.readers:
+            _emit(bench_cached_reader(make_client, readers, args.ops))
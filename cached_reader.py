@@ -1,12 +1,31 @@
 #!/usr/bin/env python2
 # coding: utf-8
 
+import collections
 import logging
 import threading
+from collections.abc import Mapping
+
+import k3utfjson
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import UnimplementedError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
 
 from . import zkconf
 from . import zkutil
 from . import exceptions
+from .zklockscan import pipeline
+
+try:
+    # kazoo with persistent recursive watches of zookeeper 3.6+
+    from kazoo.protocol.states import AddWatchMode
+    from kazoo.protocol.states import WatcherType
+except ImportError:
+    AddWatchMode = None
+    WatcherType = None
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +39,7 @@ class CachedReader(dict):
     # cr = CachedReader('127.0.0.1:2181', 'bar')
     # for i in range(cr['jobs']['num']):
     #     doit()
-    def __init__(self, zk, path, callback=None):
+    def __init__(self, zk, path, callback=None, diff_callback=None, dispatcher=None):
         """
 
         :param zk: is the connection argument, which can be:
@@ -34,15 +53,32 @@ class CachedReader(dict):
         :param path: the path of the node in zookeeper.
         :param callback: give a callback when the node change. Defaults to `None`.
         It has 3 arguments `(path, old_dict, new_dict)`.
+        :param diff_callback: give a callback with what is changed when the
+        node change. It has 3 arguments `(path, diff, new_dict)`, `diff` is
+        returned by `dict_diff`.
+
+        Callbacks are not called if the new value equals the old one.
+        :param dispatcher: a `ThreadDispatcher` or `AsyncioDispatcher` to
+        decode updates and call back in, instead of kazoo event thread. By
+        default `None`, everything runs in kazoo event thread.
+        Updates of one reader are applied in order, and an update not yet
+        applied is replaced by a newer one.
         """
         super(CachedReader, self).__init__()
 
         self.zke, self.owning_zk = zkconf.kazoo_client_ext(zk)
         self.path = path
         self.callback = callback
+        self.diff_callback = diff_callback
+        self.dispatcher = dispatcher
         self.available_ev = threading.Event()
         self.stopped = False
         self.val = [None, None]
+        # the latest read not yet applied by dispatcher
+        self._fetched = None
+        # what is changed from val[0] to val[1]
+        self.diff = None
+        self.zstat = None
         # lock for update the dict
         self.lock = threading.RLock()
 
@@ -57,14 +93,16 @@ class CachedReader(dict):
         self.zke.add_listener(self.conn_change_cb)
         self._update()
 
-    def watch(self, timeout=None):
+    def watch(self, timeout=None, diff=False):
         """
         Wait until the node change and return a list `[old_dict, new_dict]`.
         If timeout, raise a `ZKWaitTimeout`.
         :param timeout: specifies the time(in second) to wait.
         By default it is `None` which means to wait for a year
+        :param diff: whether to return the `dict_diff` too.
         :return: If close the `CachedReader` by `zkutil.CachedReader.close()`, it return `None`.
-        If the node change, it return a list `[old_dict, new_dict]`
+        If the node change, it return a list `[old_dict, new_dict]`, or
+        `[old_dict, new_dict, diff]` if `diff` is `True`.
         """
         self.available_ev.clear()
 
@@ -74,7 +112,9 @@ class CachedReader(dict):
             if self.stopped:
                 return None
 
-            else:
+            with self.lock:
+                if diff:
+                    return self.val + [self.diff]
                 return self.val
 
         else:
@@ -93,9 +133,40 @@ class CachedReader(dict):
             zkutil.close_zk(self.zke)
 
     def _on_conn_change(self, state):
+        # The last value is served while disconnected.
         logger.info("state changed: {state}".format(state=state))
-        self.stopped = True
-        self.available_ev.set()
+
+        if state != KazooState.CONNECTED or self.stopped:
+            return
+
+        # Changes made while disconnected might not be notified, and watches
+        # are gone if the session expired. Re-arm the watch with one `exists`
+        # and re-read only if the node changed.
+        self.zke._zk.exists_async(self.path, watch=self.node_change_cb).rawlink(self._on_reconnected)
+
+    def _on_reconnected(self, rst):
+        if self.stopped:
+            return
+
+        try:
+            zstat = rst.get()
+        except Exception as e:
+            logger.info(repr(e) + " while check {p} after reconnected".format(p=self.path))
+            return
+
+        if zstat is None:
+            # watched by `exists`, creating it again fires the watch
+            logger.info("{p} is deleted, keep the last value".format(p=self.path))
+            return
+
+        if self.zstat is not None and zstat.mzxid == self.zstat.mzxid:
+            logger.debug("{p} is not changed after reconnected".format(p=self.path))
+            return
+
+        try:
+            self._refresh()
+        except Exception as e:
+            logger.info(repr(e) + " while update {p} after reconnected".format(p=self.path))
 
     def _on_node_change(self, event):
         logger.info("node state changed:{ev}".format(ev=event))
@@ -103,21 +174,786 @@ class CachedReader(dict):
         if self.stopped:
             return
 
-        self._update()
-        self.available_ev.set()
+        if event.type == EventType.NONE:
+            # session expired, the watch is re-armed once connected
+            return
 
-        if self.callback is None:
+        self._refresh()
+
+    def _refresh(self):
+        if self.dispatcher is None:
+            if self._update():
+                self._notify()
+            return
+
+        # Only send the request here, decode and apply it in dispatcher.
+        self.zke._zk.get_async(self.path, watch=self.node_change_cb).rawlink(self._on_fetched)
+
+    def _on_fetched(self, rst):
+        with self.lock:
+            queued = self._fetched is not None
+            self._fetched = rst
+
+        if not queued:
+            self.dispatcher.submit(id(self), self._apply_fetched)
+
+    def _apply_fetched(self):
+        with self.lock:
+            rst, self._fetched = self._fetched, None
+
+        if self.stopped:
+            return
+
+        try:
+            val, zstat = rst.get()
+        except Exception as e:
+            logger.info(repr(e) + " while read {p}".format(p=self.path))
             return
 
-        self.callback(self.path, self.val[0], self.val[1])
+        if self._apply(self.zke._jl(val), zstat):
+            self._notify()
+
+    def _notify(self):
+        self.available_ev.set()
+
+        with self.lock:
+            old, new = self.val
+            diff = self.diff
+
+        if self.callback is not None:
+            self.callback(self.path, old, new)
+
+        if self.diff_callback is not None:
+            self.diff_callback(self.path, diff, new)
 
     def _update(self):
+        """
+        Read the node and apply the changed keys.
+        :return: whether the value is changed.
+        """
+        curr, zstat = self.zke.get(self.path, watch=self.node_change_cb)
+        return self._apply(curr, zstat)
+
+    def _apply(self, curr, zstat):
         with self.lock:
-            curr, _ = self.zke.get(self.path, watch=self.node_change_cb)
-            self.val = [self.val[1], curr]
-            self.update(curr)
+            if self.zstat is not None and zstat.mzxid < self.zstat.mzxid:
+                # an older read
+                return False
 
-            keys = list(self.keys())
-            for k in keys:
-                if k not in curr:
+            self.zstat = zstat
+
+            prev = self.val[1]
+            diff = dict_diff(prev or {}, curr)
+            if prev is not None and _diff_empty(diff):
+                return False
+
+            self.val = [prev, curr]
+            self.diff = diff
+
+            # only top level keys are stored in self
+            for k in set([p[0] for ps in diff.values() for p in ps]):
+                if k in curr:
+                    self[k] = curr[k]
+                else:
                     del self[k]
+
+            return True
+
+
+class CachedReaderView(Mapping):
+    """
+    A reference to a `CachedReader` shared in the process, returned by
+    `shared_cached_reader`. It reads the same as a `CachedReader`, and has
+    its own `callback`, `diff_callback` and `watch`.
+    """
+
+    def __init__(self, registry, shared, callback=None, diff_callback=None):
+        self.registry = registry
+        self.shared = shared
+        self.path = shared.reader.path
+        self.callback = callback
+        self.diff_callback = diff_callback
+        self.available_ev = threading.Event()
+        self.stopped = False
+
+    @property
+    def val(self):
+        return self.shared.reader.val
+
+    @property
+    def diff(self):
+        return self.shared.reader.diff
+
+    def __getitem__(self, key):
+        return self.shared.reader[key]
+
+    def __iter__(self):
+        return iter(self.shared.reader)
+
+    def __len__(self):
+        return len(self.shared.reader)
+
+    def watch(self, timeout=None, diff=False):
+        """
+        The same as `CachedReader.watch`.
+        """
+        if self.stopped:
+            return None
+
+        self.available_ev.clear()
+
+        timeout = timeout or 86400 * 365
+
+        if not self.available_ev.wait(timeout):
+            raise exceptions.ZKWaitTimeout("timeout {t} sec".format(t=timeout))
+
+        if self.stopped:
+            return None
+
+        reader = self.shared.reader
+        with reader.lock:
+            if diff:
+                return reader.val + [reader.diff]
+            return reader.val
+
+    def close(self):
+        """
+        Drop this reference. The shared `CachedReader` is closed with the last
+        reference.
+        """
+        if self.stopped:
+            return
+
+        self.stopped = True
+        self.available_ev.set()
+        self.registry.release(self)
+
+    def _notify(self, old, new, diff):
+        if self.stopped:
+            return
+
+        self.available_ev.set()
+
+        if self.callback is not None:
+            self.callback(self.path, old, new)
+
+        if self.diff_callback is not None:
+            self.diff_callback(self.path, diff, new)
+
+
+class CachedReaderRegistry(object):
+    """
+    CachedReaderRegistry shares one `CachedReader` among all readers of a
+    node: one decoded value, one watch and one connection listener.
+
+    Readers with a `KazooClient` share by `(client, path)`. Readers with
+    hosts, a `ZKConf` or a `dict` share by `(hosts, auth, path)`, and the
+    shared reader owns its connection.
+
+    Shared readers call back in `dispatcher`, see `CachedReader`.
+    """
+
+    def __init__(self, dispatcher=None):
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        # key to _SharedReader
+        self.readers = {}
+
+    def get(self, zk, path, callback=None, diff_callback=None):
+        """
+        :return: a `CachedReaderView` of the shared reader of `path`.
+        """
+        key = _registry_key(zk, path)
+
+        while True:
+            with self.lock:
+                shared = self.readers.get(key)
+                building = shared is None
+                if building:
+                    # Build the reader out of the lock, it may take long, e.g.
+                    # connecting to an unreachable ensemble. Others of the
+                    # same key wait for it.
+                    shared = _SharedReader(key)
+                    self.readers[key] = shared
+
+            if building:
+                try:
+                    shared.build(zk, path, self.dispatcher)
+                finally:
+                    if shared.reader is None:
+                        with self.lock:
+                            if self.readers.get(key) is shared:
+                                del self.readers[key]
+                    shared.ready.set()
+            else:
+                shared.ready.wait()
+
+            with self.lock:
+                # Failed to build or closed by the last view meanwhile
+                if shared.reader is None or self.readers.get(key) is not shared:
+                    continue
+
+                view = CachedReaderView(self, shared, callback=callback, diff_callback=diff_callback)
+                shared.views.append(view)
+
+            return view
+
+    def release(self, view):
+        shared = view.shared
+        with self.lock:
+            if view in shared.views:
+                shared.views.remove(view)
+
+            if len(shared.views) > 0 or self.readers.get(shared.key) is not shared:
+                return
+
+            del self.readers[shared.key]
+
+        logger.info("close shared reader: {k}".format(k=shared.key))
+        shared.reader.close()
+
+
+class _SharedReader(object):
+    def __init__(self, key):
+        self.key = key
+        self.views = []
+        self.reader = None
+        # set once `reader` is built or failed to
+        self.ready = threading.Event()
+
+    def build(self, zk, path, dispatcher):
+        self.reader = CachedReader(zk, path, diff_callback=self._on_change, dispatcher=dispatcher)
+
+    def _on_change(self, path, diff, new):
+        old = self.reader.val[0]
+        for view in list(self.views):
+            try:
+                view._notify(old, new, diff)
+            except Exception as e:
+                logger.exception(repr(e) + " while call back for {p}".format(p=path))
+
+
+_cached_readers = CachedReaderRegistry()
+
+
+def shared_cached_reader(zk, path, callback=None, diff_callback=None):
+    """
+    Get a reference to the `CachedReader` of `path` shared in the process.
+    Arguments are the same as `CachedReader`. Close the returned
+    `CachedReaderView` when done, the shared reader is closed with the last
+    one.
+
+        conf = shared_cached_reader(zk, "conf/router")
+        conf["routes"]
+        conf.close()
+
+    :return: a `CachedReaderView`.
+    """
+    return _cached_readers.get(zk, path, callback=callback, diff_callback=diff_callback)
+
+
+def _registry_key(zk, path):
+    path = "/" + path.strip("/")
+
+    if isinstance(zk, zkconf.KazooClientExt):
+        zk = zk._zk
+
+    if isinstance(zk, KazooClient):
+        return (zk, path)
+
+    if isinstance(zk, str):
+        zk = zkconf.ZKConf(hosts=zk)
+    elif isinstance(zk, dict):
+        zk = zkconf.ZKConf(**zk)
+
+    if not isinstance(zk, zkconf.ZKConf):
+        raise TypeError("invalid zk: {z!r}".format(z=zk))
+
+    return (zk.hosts(), zk.kazoo_auth(), path)
+
+
+def dict_diff(old, new):
+    """
+    Compare two `dict`s key by key. Nested `dict`s are compared recursively,
+    other values are compared as a whole.
+
+        dict_diff({"a": {"b": 1, "c": 2}}, {"a": {"b": 1, "c": 3}, "d": 4})
+        # {"added": [("d",)], "removed": [], "changed": [("a", "c")]}
+
+    :return: a `dict` of `"added"`, `"removed"` and `"changed"` key paths. A
+    key path is a `tuple` of keys from the top level.
+    """
+    rst = {"added": [], "removed": [], "changed": []}
+    _diff(old, new, (), rst)
+    return rst
+
+
+def _diff(old, new, prefix, rst):
+    for k in old:
+        if k not in new:
+            rst["removed"].append(prefix + (k,))
+
+    for k, v in new.items():
+        if k not in old:
+            rst["added"].append(prefix + (k,))
+            continue
+
+        o = old[k]
+        if isinstance(o, dict) and isinstance(v, dict):
+            _diff(o, v, prefix + (k,), rst)
+        elif type(o) is not type(v) or o != v:
+            rst["changed"].append(prefix + (k,))
+
+
+def _diff_empty(diff):
+    return all([len(ps) == 0 for ps in diff.values()])
+
+
+class CachedTreeReader(object):
+    """
+    CachedTreeReader mirrors the JSON values of all of the nodes in the
+    subtree at `path`:
+
+        tr = CachedTreeReader(zk, "conf")
+        tr.get("db/primary")  # value of /conf/db/primary
+        tr.children("db")  # ["primary", "replica"]
+        tr.tree()  # {"value": ..., "children": {"db": {...}}}
+
+    Paths in a reader are relative to `path`, `""` is `path` itself. An empty
+    node has value `None`.
+
+    The subtree is loaded level by level, all nodes of a level in one round
+    of pipelined requests. If the client and the server support persistent
+    recursive watches (kazoo with `add_watch` and zookeeper 3.6+), one watch
+    on `path` keeps the subtree current. Otherwise every node has its own
+    data and children watch, which is re-armed on every change.
+
+    After the session expires, the subtree is loaded again and the
+    differences are reported as changes.
+    """
+
+    def __init__(self, zk, path, callback=None, concurrency=256, dispatcher=None):
+        """
+        :param zk: the same as `CachedReader`.
+        :param path: the root of the subtree in zookeeper.
+        :param callback: called for every changed node with 3 arguments
+        `(path, old_value, new_value)`, `path` is absolute. `old_value` of a
+        created node and `new_value` of a deleted node are `None`.
+        :param concurrency: max number of requests on the wire while loading.
+        :param dispatcher: a `ThreadDispatcher` to handle changes and call
+        back in, instead of kazoo event thread. Changes of one reader are
+        handled in order. Events of a node not yet handled are collapsed into
+        the latest one, thus a reader has at most one task queued and never
+        blocks kazoo event thread.
+        """
+        self.zke, self.owning_zk = zkconf.kazoo_client_ext(zk, json=False)
+        self.zk = self.zke._zk
+
+        self.path = "/" + path.strip("/")
+        self.callback = callback
+        self.concurrency = concurrency
+        self.dispatcher = dispatcher
+
+        # relative path to value, and to the set of child names
+        self.values = {}
+        self.kids = {}
+
+        self.available_ev = threading.Event()
+        self.stopped = False
+        self.changes = []
+        self.lock = threading.RLock()
+
+        self.recursive = False
+        self._expired = False
+
+        # (handler, path) to the latest event not yet handled by dispatcher
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+
+        # Events during the initial load are handled after it, otherwise a
+        # newer value would be overwritten by the loaded one.
+        self._loading = True
+        self._buffered = []
+
+        self.zke.add_listener(self._on_conn_change)
+
+        self._watch_recursive()
+
+        loaded = self._load("")
+        if "" not in loaded:
+            self.close()
+            raise NoNodeError(self.path)
+
+        # the initial load is not reported as changes
+        with self.lock:
+            for r, (val, children) in loaded.items():
+                self.values[r] = val
+                self.kids[r] = children
+
+        with self._pending_lock:
+            self._loading = False
+            buffered, self._buffered = self._buffered, []
+
+        # handlers read the nodes again, only what changed is reported
+        for func, event in buffered:
+            self._dispatch(func, event)
+
+    def get(self, path="", default=None):
+        """
+        :return: the value of node `path`, or `default` if it does not exist.
+        """
+        return self.values.get(path.strip("/"), default)
+
+    def children(self, path=""):
+        """
+        :return: sorted names of the children of node `path`.
+        """
+        return sorted(self.kids.get(path.strip("/"), ()))
+
+    def tree(self, path=""):
+        """
+        :return: a nested `dict` of the subtree at `path`:
+        `{"value": value, "children": {name: {...}}}`, or `None` if `path`
+        does not exist.
+        """
+        rel = path.strip("/")
+        with self.lock:
+            if rel not in self.values:
+                return None
+
+            return {
+                "value": self.values[rel],
+                "children": {c: self.tree(_join(rel, c)) for c in self.kids.get(rel, ())},
+            }
+
+    def watch(self, timeout=None):
+        """
+        Wait until any node in the subtree changes.
+        If timeout, raise a `ZKWaitTimeout`.
+        :param timeout: the same as `CachedReader.watch`.
+        :return: a list of `(path, old_value, new_value)` of the changes, or
+        `None` if the reader is closed.
+        """
+        if self.stopped:
+            return None
+
+        with self.lock:
+            self.changes = []
+            self.available_ev.clear()
+
+        timeout = timeout or 86400 * 365
+
+        if not self.available_ev.wait(timeout):
+            raise exceptions.ZKWaitTimeout("timeout {t} sec".format(t=timeout))
+
+        if self.stopped:
+            return None
+
+        with self.lock:
+            changes, self.changes = self.changes, []
+            return changes
+
+    def close(self):
+        """
+        Stop the `watch` and the callback.
+        :return: nothing
+        """
+        self.stopped = True
+        self.available_ev.set()
+
+        self.zke.remove_listener(self._on_conn_change)
+        if self.recursive:
+            self._unwatch_recursive()
+
+        if self.owning_zk:
+            zkutil.close_zk(self.zke)
+
+    def _watch_recursive(self):
+        if AddWatchMode is None or not hasattr(self.zk, "add_watch"):
+            return
+
+        try:
+            self.zk.add_watch(self.path, self._on_tree_change, AddWatchMode.PERSISTENT_RECURSIVE)
+            self.recursive = True
+        except UnimplementedError as e:
+            logger.info(repr(e) + " while add recursive watch on {p}, watch every node".format(p=self.path))
+
+    def _unwatch_recursive(self):
+        self.recursive = False
+        try:
+            self.zk.remove_all_watches(self.path, WatcherType.PERSISTENT_RECURSIVE)
+        except Exception as e:
+            logger.info(repr(e) + " while remove recursive watch on {p}".format(p=self.path))
+
+    def _load(self, rel):
+        """
+        Read the subtree at `rel`, level by level.
+        :return: a `dict` of relative path to `(value, child_names)`.
+        """
+        data_watch = None if self.recursive else self._on_node_change
+        child_watch = None if self.recursive else self._on_children_change
+
+        def _send(req):
+            r, op = req
+            if op == "get":
+                return self.zk.get_async(self._abs(r), watch=data_watch)
+            return self.zk.get_children_async(self._abs(r), watch=child_watch)
+
+        loaded = {}
+        level = [rel]
+        while len(level) > 0:
+            reqs = [(r, op) for r in level for op in ("get", "children")]
+            rsts = dict(pipeline(reqs, _send, self.concurrency))
+
+            nxt = []
+            for r in level:
+                val, children = rsts[(r, "get")], rsts[(r, "children")]
+                if isinstance(val, NoNodeError) or isinstance(children, NoNodeError):
+                    continue
+                for rst in (val, children):
+                    if isinstance(rst, Exception):
+                        raise rst
+
+                loaded[r] = (_load_value(val[0]), set(children))
+                nxt.extend([_join(r, c) for c in children])
+
+            level = nxt
+
+        if rel == "" and rel not in loaded and not self.recursive:
+            # watch for the root to be created again
+            if self.zk.exists(self.path, watch=self._on_node_change) is not None:
+                return self._load(rel)
+
+        return loaded
+
+    def _apply(self, rel, loaded):
+        """
+        Replace the subtree at `rel` with `loaded` and report the differences.
+        """
+        changes = []
+        with self.lock:
+            for r in self._subtree(rel):
+                if r not in loaded:
+                    changes.append((r, self.values.pop(r), None))
+                    self.kids.pop(r, None)
+
+            for r, (val, children) in loaded.items():
+                old = self.values.get(r)
+                if r not in self.values or old != val:
+                    changes.append((r, old, val))
+                self.values[r] = val
+                self.kids[r] = children
+
+            self._link(rel, rel in loaded)
+
+        self._fire(changes)
+
+    def _remove(self, rel):
+        loaded = {}
+        if rel == "" and not self.recursive:
+            # it might have been created again
+            loaded = self._load(rel)
+
+        self._apply(rel, loaded)
+
+    def _set_value(self, rel, val):
+        with self.lock:
+            if rel in self.values and self.values[rel] == val:
+                return
+
+            old = self.values.get(rel)
+            self.values[rel] = val
+            self.kids.setdefault(rel, set())
+            self._link(rel, True)
+
+        self._fire([(rel, old, val)])
+
+    def _link(self, rel, exists):
+        # add or remove `rel` in the children of its parent
+        if rel == "":
+            return
+
+        parent, _, name = rel.rpartition("/")
+        if exists:
+            self.kids.setdefault(parent, set()).add(name)
+        elif parent in self.kids:
+            self.kids[parent].discard(name)
+
+    def _subtree(self, rel):
+        prefix = rel + "/" if rel != "" else ""
+        return [r for r in self.values if r == rel or r.startswith(prefix)]
+
+    def _fire(self, changes):
+        if len(changes) == 0:
+            return
+
+        changes = [(self._abs(r), old, new) for r, old, new in changes]
+        with self.lock:
+            self.changes.extend(changes)
+            self.available_ev.set()
+
+        if self.callback is None:
+            return
+
+        for path, old, new in changes:
+            try:
+                self.callback(path, old, new)
+            except Exception as e:
+                logger.exception(repr(e) + " while call back for {p}".format(p=path))
+
+    def _on_conn_change(self, state):
+        logger.info("state changed: {state}".format(state=state))
+
+        if state == KazooState.LOST:
+            # watches are gone with the session
+            self._expired = True
+        elif state == KazooState.CONNECTED and self._expired:
+            self._expired = False
+            if self.dispatcher is not None:
+                self._dispatch(self._reload, None)
+            else:
+                th = threading.Thread(target=self._reload, daemon=True)
+                th.start()
+
+    def _reload(self, event=None):
+        if self.stopped:
+            return
+
+        try:
+            if self.recursive:
+                self.recursive = False
+                self._watch_recursive()
+            self._apply("", self._load(""))
+        except Exception as e:
+            logger.exception(repr(e) + " while reload {p}".format(p=self.path))
+
+    def _dispatch(self, func, event):
+        with self._pending_lock:
+            if self._loading:
+                self._buffered.append((func, event))
+                return
+
+        if self.dispatcher is None:
+            func(event)
+            return
+
+        # Handlers read the node again, only the latest event of a node
+        # matters. One task drains all of the pending events of this reader.
+        key = (func, None if event is None else event.path)
+        with self._pending_lock:
+            queued = len(self._pending) > 0
+            self._pending[key] = event
+            self._pending.move_to_end(key)
+
+        if not queued:
+            self.dispatcher.submit(id(self), self._drain)
+
+    def _drain(self):
+        while True:
+            with self._pending_lock:
+                if len(self._pending) == 0:
+                    return
+                (func, _), event = self._pending.popitem(last=False)
+
+            try:
+                func(event)
+            except Exception as e:
+                logger.exception(repr(e) + " while handle {ev}: {p}".format(ev=event, p=self.path))
+
+    def _on_node_change(self, event):
+        self._dispatch(self._node_changed, event)
+
+    def _on_children_change(self, event):
+        self._dispatch(self._children_changed, event)
+
+    def _on_tree_change(self, event):
+        self._dispatch(self._tree_changed, event)
+
+    def _node_changed(self, event):
+        # one-shot data watch, or exists watch on a deleted node
+        logger.debug("node state changed:{ev}".format(ev=event))
+
+        if self.stopped or event.type == EventType.NONE:
+            # session expired, reloaded once connected
+            return
+
+        rel = self._rel(event.path)
+        if event.type == EventType.DELETED:
+            self._remove(rel)
+        elif event.type == EventType.CREATED:
+            self._apply(rel, self._load(rel))
+        else:
+            try:
+                val, _ = self.zk.get(event.path, watch=self._on_node_change)
+            except NoNodeError:
+                self._remove(rel)
+                return
+            self._set_value(rel, _load_value(val))
+
+    def _children_changed(self, event):
+        logger.debug("children changed:{ev}".format(ev=event))
+
+        if self.stopped or event.type == EventType.NONE:
+            # session expired, reloaded once connected
+            return
+
+        rel = self._rel(event.path)
+        if event.type == EventType.DELETED:
+            self._remove(rel)
+            return
+
+        try:
+            children = set(self.zk.get_children(event.path, watch=self._on_children_change))
+        except NoNodeError:
+            self._remove(rel)
+            return
+
+        with self.lock:
+            known = set(self.kids.get(rel, ()))
+
+        for c in known - children:
+            self._remove(_join(rel, c))
+
+        for c in children - known:
+            r = _join(rel, c)
+            self._apply(r, self._load(r))
+
+    def _tree_changed(self, event):
+        # persistent recursive watch: created, deleted or data changed
+        logger.debug("tree changed:{ev}".format(ev=event))
+
+        if self.stopped or event.type == EventType.NONE:
+            # session expired, reloaded once connected
+            return
+
+        rel = self._rel(event.path)
+        if event.type == EventType.DELETED:
+            self._remove(rel)
+            return
+
+        try:
+            val, _ = self.zk.get(event.path)
+        except NoNodeError:
+            self._remove(rel)
+            return
+        self._set_value(rel, _load_value(val))
+
+    def _abs(self, rel):
+        if rel == "":
+            return self.path
+        return self.path.rstrip("/") + "/" + rel
+
+    def _rel(self, path):
+        return path[len(self.path) :].strip("/")
+
+
+def _join(rel, name):
+    if rel == "":
+        return name
+    return rel + "/" + name
+
+
+def _load_value(val):
+    if val is None or len(val) == 0:
+        return None
+    return k3utfjson.load(val)
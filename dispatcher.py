@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _DispatchStats(object):
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.submitted = 0
+        self.done = 0
+        self.errors = 0
+        self.blocked = 0
+        self.started = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+        self.lag_last = 0.0
+
+    def on_submitted(self, blocked):
+        with self.mutex:
+            self.submitted += 1
+            if blocked:
+                self.blocked += 1
+
+    def on_started(self, submitted_at):
+        lag = time.time() - submitted_at
+        with self.mutex:
+            self.started += 1
+            self.lag_sum += lag
+            self.lag_max = max(self.lag_max, lag)
+            self.lag_last = lag
+
+    def on_done(self, err):
+        with self.mutex:
+            self.done += 1
+            if err:
+                self.errors += 1
+
+    def snapshot(self):
+        with self.mutex:
+            started = self.started
+            return {
+                "submitted": self.submitted,
+                "done": self.done,
+                "pending": self.submitted - self.done,
+                "errors": self.errors,
+                "blocked": self.blocked,
+                "lag_avg": self.lag_sum / started if started > 0 else 0.0,
+                "lag_max": self.lag_max,
+                "lag_last": self.lag_last,
+            }
+
+
+class ThreadDispatcher(object):
+    """
+    ThreadDispatcher runs callbacks in its own threads instead of kazoo event
+    thread, so that a slow callback does not delay other watches and
+    connection events.
+
+    Tasks with the same `key` run one by one in the order they are submitted,
+    tasks with different keys run concurrently in up to `threads` threads.
+    `threads=1` is a dedicated thread.
+
+    At most `maxsize` tasks of a key are queued, `submit` blocks until the
+    key has room.
+
+        d = ThreadDispatcher(threads=4)
+        cr = CachedReader(zk, "foo", callback=reload, dispatcher=d)
+        d.stats()  # {"pending": 0, "lag_max": 0.003, ...}
+    """
+
+    def __init__(self, threads=1, maxsize=1000, name="k3zkutil-dispatcher"):
+        if threads < 1:
+            raise ValueError("threads must be at least 1, but: {n}".format(n=threads))
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, but: {n}".format(n=maxsize))
+
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        # key to queue of (submitted_at, func, args)
+        self.queues = {}
+        # keys with queued tasks and not running
+        self.ready = collections.deque()
+        self.running = set()
+        self.closed = False
+        self._stats = _DispatchStats()
+
+        self.workers = []
+        for i in range(threads):
+            th = threading.Thread(target=self._loop, name="{n}-{i}".format(n=name, i=i))
+            th.daemon = True
+            th.start()
+            self.workers.append(th)
+
+    def submit(self, key, func, *args):
+        """
+        Run `func(*args)` after the tasks of `key` submitted before. `key` must
+        be hashable, such as `id(obj)`.
+        :return: nothing
+        """
+        blocked = False
+        with self.cond:
+            q = self.queues.setdefault(key, collections.deque())
+            while len(q) >= self.maxsize and not self.closed:
+                blocked = True
+                self.cond.wait()
+
+            if self.closed:
+                logger.info("dispatcher closed, drop task: {f}".format(f=func))
+                return
+
+            q.append((time.time(), func, args))
+            if len(q) == 1 and key not in self.running:
+                self.ready.append(key)
+                self.cond.notify_all()
+
+        self._stats.on_submitted(blocked)
+
+    def stats(self):
+        """
+        :return: a `dict` of numbers of tasks `"submitted"`, `"done"`,
+        `"pending"`, `"errors"`, and `"blocked"` submits, and the dispatch lag
+        in seconds, from submitted to started: `"lag_avg"`, `"lag_max"` and
+        `"lag_last"`.
+        """
+        return self._stats.snapshot()
+
+    def close(self):
+        """
+        Stop the threads after the queued tasks are done.
+        :return: nothing
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        for th in self.workers:
+            if th is not threading.current_thread():
+                th.join()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while len(self.ready) == 0 and not self.closed:
+                    self.cond.wait()
+
+                if len(self.ready) == 0:
+                    return
+
+                key = self.ready.popleft()
+                submitted_at, func, args = self.queues[key].popleft()
+                self.running.add(key)
+                # wake up submitters blocked on a full queue
+                self.cond.notify_all()
+
+            self._stats.on_started(submitted_at)
+            err = _run(func, args)
+            self._stats.on_done(err)
+
+            with self.cond:
+                self.running.discard(key)
+                if len(self.queues[key]) > 0:
+                    self.ready.append(key)
+                    self.cond.notify_all()
+                else:
+                    del self.queues[key]
+
+
+class AsyncioDispatcher(object):
+    """
+    AsyncioDispatcher runs callbacks in the thread of an asyncio event loop.
+    The loop runs one task at a time, thus tasks of every key run in the
+    order they are submitted.
+
+    Tasks must not block the loop: `CachedReader` only decodes the value and
+    calls back in a task, while `CachedTreeReader` reads zookeeper in its
+    tasks and should use a `ThreadDispatcher`.
+
+    At most `maxsize` tasks are queued, `submit` blocks until there is room.
+    """
+
+    def __init__(self, loop, maxsize=1000):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, but: {n}".format(n=maxsize))
+
+        self.loop = loop
+        self.maxsize = maxsize
+        self.slots = threading.Semaphore(maxsize)
+        self._stats = _DispatchStats()
+
+    def submit(self, key, func, *args):
+        """
+        The same as `ThreadDispatcher.submit`. It must not be called in the
+        loop thread.
+        """
+        blocked = not self.slots.acquire(blocking=False)
+        if blocked:
+            self.slots.acquire()
+
+        self.loop.call_soon_threadsafe(self._run, time.time(), func, args)
+        self._stats.on_submitted(blocked)
+
+    def stats(self):
+        """
+        The same as `ThreadDispatcher.stats`.
+        """
+        return self._stats.snapshot()
+
+    def close(self):
+        pass
+
+    def _run(self, submitted_at, func, args):
+        self.slots.release()
+
+        self._stats.on_started(submitted_at)
+        err = _run(func, args)
+        self._stats.on_done(err)
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception as e:
+        logger.exception(repr(e) + " while dispatch {f}".format(f=func))
+        return True
+
+    return False
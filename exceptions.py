@@ -8,3 +8,7 @@ class ZKUtilError(Exception):
 
 class ZKWaitTimeout(ZKUtilError):
     pass
+
+
+class BackwardLockingConflict(ZKUtilError):
+    pass
@@ -0,0 +1,69 @@
+import unittest
+
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import RolledBackError
+
+import k3ut
+import k3zkutil
+from k3zkutil.bench import zkbench
+from k3zkutil.bench.fakezk import FakeClient
+from k3zkutil.bench.fakezk import FakeServer
+
+dd = k3ut.dd
+
+
+class TestFakeZK(unittest.TestCase):
+    def setUp(self):
+        self.srv = FakeServer()
+        self.zk = FakeClient(self.srv)
+        self.zk.start()
+        self.zk.ensure_path("lock/")
+
+    def tearDown(self):
+        self.zk.stop()
+
+    def test_lock(self):
+        zk2 = FakeClient(self.srv)
+        zk2.start()
+
+        l1 = k3zkutil.ZKLock("foo", zkclient=self.zk)
+        l2 = k3zkutil.ZKLock("foo", zkclient=zk2)
+
+        l1.acquire()
+        self.assertEqual((False, l1.identifier, 0), l2.try_acquire())
+
+        # ephemeral node is removed when session closed, the watch wakes up l2
+        self.zk.stop()
+        l2.acquire(timeout=1)
+        self.assertTrue(l2.is_locked())
+
+        l2.release()
+        zk2.stop()
+
+    def test_transaction(self):
+        self.zk.create("lock/a")
+
+        tx = self.zk.transaction()
+        tx.create("lock/b")
+        tx.create("lock/a")
+        rsts = tx.commit()
+
+        self.assertIsInstance(rsts[0], RolledBackError)
+        self.assertIsInstance(rsts[1], NodeExistsError)
+        self.assertEqual(["a"], self.zk.get_children("lock"))
+
+
+class TestBench(unittest.TestCase):
+    def test_bench(self):
+        make_client = zkbench.ClientFactory(rtt=0.0001)
+
+        for rst in (
+            zkbench.bench_lock(make_client, threads=4, names=2, ops=10),
+            zkbench.bench_lock(make_client, threads=4, ops=10, lock_kwargs={"queued": True}),
+            zkbench.bench_cas(make_client, threads=4, ops=10),
+            zkbench.bench_cached_reader(make_client, readers=4, updates=10),
+        ):
+            dd(rst)
+            self.assertEqual(40 if rst["bench"] != "cached_reader" else 10, rst["ops"])
+            self.assertGreater(rst["ops_per_sec"], 0)
+            self.assertLessEqual(rst["p50_ms"], rst["p99_ms"])
@@ -5,6 +5,7 @@ import time
 import unittest
 
 from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import KazooState
 
 import k3thread
 import k3utdocker
@@ -98,3 +99,348 @@ class TestCachedReader(unittest.TestCase):
 
         k3thread.daemon(_close, after=1)
         self.assertEqual(None, c.watch())
+
+    def test_diff(self):
+        changes = []
+
+        def cb(path, old, new):
+            changes.append(new)
+
+        diffs = []
+
+        def diff_cb(path, diff, new):
+            diffs.append(diff)
+
+        c = k3zkutil.CachedReader(self.zk, "foo", callback=cb, diff_callback=diff_cb)
+        self.assertEqual({"added": [("a",), ("b",)], "removed": [], "changed": []}, c.diff)
+
+        val = {"a": 1, "b": {"c": 3}}
+        self.zk.set("foo", k3utfjson.dump(val).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual([val], changes)
+        self.assertEqual([{"added": [], "removed": [], "changed": [("b",)]}], diffs)
+
+        # the same value: no callback
+        self.zk.set("foo", k3utfjson.dump(val).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual(1, len(changes))
+        self.assertEqual(1, len(diffs))
+
+        new_val = {"b": {"c": 4, "d": 5}}
+
+        def _change_node():
+            self.zk.set("foo", k3utfjson.dump(new_val).encode("utf-8"))
+
+        k3thread.daemon(_change_node, after=1)
+        self.assertEqual(
+            [val, new_val, {"added": [("b", "d")], "removed": [("a",)], "changed": [("b", "c")]}],
+            c.watch(diff=True),
+        )
+        self.assertDictEqual(new_val, c)
+
+        c.close()
+
+    def test_shared(self):
+        changes = []
+
+        def cb(path, old, new):
+            changes.append(new)
+
+        a = k3zkutil.shared_cached_reader(self.zk, "foo", callback=cb)
+        b = k3zkutil.shared_cached_reader(self.zk, "/foo")
+        self.assertIs(a.shared, b.shared)
+        self.assertDictEqual(self.val, dict(a))
+        self.assertEqual(1, b["a"])
+
+        val = {"a": 3}
+        self.zk.set("foo", k3utfjson.dump(val).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual([val], changes)
+        self.assertDictEqual(val, dict(b))
+
+        reader = a.shared.reader
+        a.close()
+        self.assertFalse(reader.stopped)
+        self.assertIsNone(a.watch())
+
+        b.close()
+        self.assertTrue(reader.stopped)
+
+        # a new shared reader after all are closed
+        c = k3zkutil.shared_cached_reader(self.zk, "foo")
+        self.assertIsNot(reader, c.shared.reader)
+        c.close()
+
+    def test_shared_slow_build(self):
+        self.zk.create("bar", k3utfjson.dump(self.val).encode("utf-8"))
+
+        shared_reader = k3zkutil.cached_reader._SharedReader
+        orig = shared_reader.build
+        sess = {"fail": False}
+
+        def _slow_build(shared, zk, path, dispatcher):
+            if path == "foo":
+                time.sleep(1)
+                if sess["fail"]:
+                    raise NoNodeError()
+            orig(shared, zk, path, dispatcher)
+
+        registry = k3zkutil.CachedReaderRegistry()
+        views = []
+
+        shared_reader.build = _slow_build
+        try:
+            # a slow reader does not block readers of other nodes
+            th = k3thread.daemon(lambda: views.append(registry.get(self.zk, "foo")))
+            time.sleep(0.1)
+            th2 = k3thread.daemon(lambda: views.append(registry.get(self.zk, "foo")))
+
+            t0 = time.time()
+            bar = registry.get(self.zk, "bar")
+            self.assertLess(time.time() - t0, 0.5)
+            self.assertEqual(1, bar["a"])
+
+            # the others of the same node wait for it
+            th.join()
+            th2.join()
+            self.assertEqual(2, len(views))
+            self.assertIs(views[0].shared, views[1].shared)
+            self.assertEqual(1, views[0]["a"])
+
+            for v in views + [bar]:
+                v.close()
+
+            # a failed build is not kept
+            sess["fail"] = True
+            self.assertRaises(NoNodeError, registry.get, self.zk, "foo")
+            self.assertEqual({}, registry.readers)
+        finally:
+            shared_reader.build = orig
+
+        foo = registry.get(self.zk, "foo")
+        self.assertEqual(1, foo["a"])
+        foo.close()
+
+    def test_dispatcher(self):
+        self.zk.create("bar", k3utfjson.dump(self.val).encode("utf-8"))
+
+        d = k3zkutil.ThreadDispatcher(threads=2)
+
+        slow = []
+
+        def slow_cb(path, old, new):
+            slow.append(new["a"])
+            time.sleep(1)
+
+        fast = []
+
+        def fast_cb(path, old, new):
+            fast.append(new["a"])
+
+        a = k3zkutil.CachedReader(self.zk, "foo", callback=slow_cb, dispatcher=d)
+        b = k3zkutil.CachedReader(self.zk, "bar", callback=fast_cb, dispatcher=d)
+
+        for i in range(2, 6):
+            self.zk.set("foo", k3utfjson.dump({"a": i}).encode("utf-8"))
+        self.zk.set("bar", k3utfjson.dump({"a": 2}).encode("utf-8"))
+
+        # not delayed by the slow callback
+        time.sleep(0.5)
+        self.assertEqual([2], fast)
+
+        # updates not yet applied are replaced by the latest one
+        time.sleep(2)
+        self.assertEqual(5, slow[-1])
+        self.assertEqual(sorted(slow), slow)
+        self.assertEqual(5, a["a"])
+
+        a.close()
+        b.close()
+        d.close()
+        self.assertEqual(0, d.stats()["pending"])
+
+    def test_tree_dispatcher(self):
+        for i in range(10):
+            self.zk.create("foo/n{i}".format(i=i), b"0")
+
+        d = k3zkutil.ThreadDispatcher(maxsize=1)
+
+        def slow_cb(path, old, new):
+            time.sleep(0.01)
+
+        tr = k3zkutil.CachedTreeReader(self.zk, "foo", callback=slow_cb, dispatcher=d)
+
+        for v in range(1, 6):
+            for i in range(10):
+                self.zk.set("foo/n{i}".format(i=i), str(v).encode("utf-8"))
+
+        time.sleep(2)
+        for i in range(10):
+            self.assertEqual(5, tr.get("n{i}".format(i=i)))
+
+        # pending events are collapsed, kazoo event thread never waits
+        self.assertEqual(0, d.stats()["blocked"])
+
+        tr.close()
+        d.close()
+
+    def test_reconnect(self):
+        changes = []
+
+        def cb(path, old, new):
+            changes.append(new)
+
+        c = k3zkutil.CachedReader(self.zk, "foo", callback=cb)
+
+        # keep serving while disconnected
+        c._on_conn_change(KazooState.SUSPENDED)
+        self.assertFalse(c.stopped)
+        self.assertDictEqual(self.val, c)
+
+        # reconnected without change: no callback
+        c._on_conn_change(KazooState.CONNECTED)
+        time.sleep(0.5)
+        self.assertEqual([], changes)
+
+        # watch is still armed
+        self.zk.set("foo", k3utfjson.dump({"a": 3}).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual([{"a": 3}], changes)
+
+        # a change missed while disconnected is re-read once reconnected
+        c._on_conn_change(KazooState.SUSPENDED)
+        # the watch is dropped, as if the session expired
+        self.zk._data_watchers.clear()
+        self.zk.set("foo", k3utfjson.dump({"a": 4}).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual([{"a": 3}], changes)
+        self.assertDictEqual({"a": 3}, c)
+
+        c._on_conn_change(KazooState.CONNECTED)
+        time.sleep(0.5)
+        self.assertEqual([{"a": 3}, {"a": 4}], changes)
+        self.assertDictEqual({"a": 4}, c)
+
+        # and watched again
+        self.zk.set("foo", k3utfjson.dump({"a": 5}).encode("utf-8"))
+        time.sleep(0.5)
+        self.assertEqual([{"a": 3}, {"a": 4}, {"a": 5}], changes)
+
+        c.close()
+
+    def test_tree(self):
+        self.zk.create("foo/db", b"")
+        self.zk.create("foo/db/primary", k3utfjson.dump("10.0.0.1").encode("utf-8"))
+
+        changes = []
+
+        def cb(path, old, new):
+            changes.append((path, old, new))
+
+        tr = k3zkutil.CachedTreeReader(self.zk, "foo", callback=cb)
+        # the initial load is not a change
+        self.assertEqual([], changes)
+        self.assertEqual(self.val, tr.get())
+        self.assertEqual("10.0.0.1", tr.get("db/primary"))
+        self.assertEqual(["db"], tr.children())
+        self.assertEqual(
+            {
+                "value": self.val,
+                "children": {
+                    "db": {"value": None, "children": {"primary": {"value": "10.0.0.1", "children": {}}}},
+                },
+            },
+            tr.tree(),
+        )
+
+        self.zk.set("foo/db/primary", k3utfjson.dump("10.0.0.2").encode("utf-8"))
+        self.zk.create("foo/db/replica", b"1")
+        time.sleep(0.5)
+        self.assertEqual(
+            [("/foo/db/primary", "10.0.0.1", "10.0.0.2"), ("/foo/db/replica", None, 1)],
+            changes,
+        )
+        self.assertEqual(["primary", "replica"], tr.children("db"))
+
+        del changes[:]
+        self.zk.delete("foo/db", recursive=True)
+        time.sleep(0.5)
+        self.assertEqual(
+            [("/foo/db", None, None), ("/foo/db/primary", "10.0.0.2", None), ("/foo/db/replica", 1, None)],
+            sorted(changes),
+        )
+        self.assertEqual([], tr.children())
+        self.assertIsNone(tr.tree("db"))
+
+        def _change_node():
+            self.zk.set("foo", k3utfjson.dump({"a": 3}).encode("utf-8"))
+
+        k3thread.daemon(_change_node, after=1)
+        self.assertEqual([("/foo", self.val, {"a": 3})], tr.watch())
+
+        tr.close()
+        self.assertIsNone(tr.watch())
+
+    def test_tree_change_while_loading(self):
+        self.zk.create("foo/db", b"")
+        self.zk.create("foo/db/primary", b"1")
+
+        orig = k3zkutil.cached_reader.pipeline
+        levels = []
+
+        def _pipeline(items, send, concurrency):
+            rst = orig(items, send, concurrency)
+            levels.append(items)
+            if len(levels) == 1:
+                # changed after the first level is read and watched
+                self.zk.set("foo", k3utfjson.dump({"a": 3}).encode("utf-8"))
+                self.zk.create("foo/extra", b"2")
+                time.sleep(0.3)
+            return rst
+
+        changes = []
+
+        def cb(path, old, new):
+            changes.append((path, old, new))
+
+        k3zkutil.cached_reader.pipeline = _pipeline
+        try:
+            tr = k3zkutil.CachedTreeReader(self.zk, "foo", callback=cb)
+        finally:
+            k3zkutil.cached_reader.pipeline = orig
+
+        time.sleep(0.5)
+        self.assertEqual({"a": 3}, tr.get())
+        self.assertEqual(2, tr.get("extra"))
+        self.assertEqual(["db", "extra"], tr.children())
+        self.assertEqual(1, tr.get("db/primary"))
+        self.assertEqual(
+            [("/foo", self.val, {"a": 3}), ("/foo/extra", None, 2)],
+            sorted(changes, key=lambda c: c[0]),
+        )
+
+        tr.close()
+
+    def test_tree_ex(self):
+        self.assertRaises(NoNodeError, k3zkutil.CachedTreeReader, self.zk, "bar")
+
+
+class TestDictDiff(unittest.TestCase):
+    def test_dict_diff(self):
+        cases = (
+            ({}, {}, {"added": [], "removed": [], "changed": []}),
+            ({"a": 1}, {"a": 1}, {"added": [], "removed": [], "changed": []}),
+            ({"a": 1}, {"b": 1}, {"added": [("b",)], "removed": [("a",)], "changed": []}),
+            ({"a": 1}, {"a": "1"}, {"added": [], "removed": [], "changed": [("a",)]}),
+            ({"a": 1}, {"a": True}, {"added": [], "removed": [], "changed": [("a",)]}),
+            ({"a": [1, 2]}, {"a": [1, 3]}, {"added": [], "removed": [], "changed": [("a",)]}),
+            ({"a": {"b": 1}}, {"a": 1}, {"added": [], "removed": [], "changed": [("a",)]}),
+            (
+                {"a": {"b": {"c": 1, "d": 2}}},
+                {"a": {"b": {"c": 1, "e": 3}}},
+                {"added": [("a", "b", "e")], "removed": [("a", "b", "d")], "changed": []},
+            ),
+        )
+
+        for old, new, expected in cases:
+            self.assertEqual(expected, k3zkutil.dict_diff(old, new), "{o} -> {n}".format(o=old, n=new))
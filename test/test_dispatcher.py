@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import k3zkutil
+
+
+class TestThreadDispatcher(unittest.TestCase):
+    def test_order_by_key(self):
+        d = k3zkutil.ThreadDispatcher(threads=4)
+
+        rst = {"a": [], "b": []}
+
+        def _run(key, i):
+            time.sleep(0.001)
+            rst[key].append(i)
+
+        for i in range(50):
+            d.submit("a", _run, "a", i)
+            d.submit("b", _run, "b", i)
+
+        d.close()
+
+        self.assertEqual(list(range(50)), rst["a"])
+        self.assertEqual(list(range(50)), rst["b"])
+
+        st = d.stats()
+        self.assertEqual(100, st["submitted"])
+        self.assertEqual(100, st["done"])
+        self.assertEqual(0, st["pending"])
+
+    def test_slow_key(self):
+        d = k3zkutil.ThreadDispatcher(threads=2)
+        done = threading.Event()
+
+        d.submit("slow", time.sleep, 0.5)
+
+        t0 = time.time()
+        d.submit("fast", done.set)
+        self.assertTrue(done.wait(1))
+        self.assertLess(time.time() - t0, 0.2)
+
+        d.close()
+        self.assertGreaterEqual(d.stats()["lag_max"], 0)
+
+    def test_bounded(self):
+        d = k3zkutil.ThreadDispatcher(threads=1, maxsize=2)
+        release = threading.Event()
+
+        d.submit("a", release.wait)
+        # wait for the first one to start
+        time.sleep(0.1)
+        d.submit("a", time.sleep, 0)
+        d.submit("a", time.sleep, 0)
+
+        def _release():
+            time.sleep(0.3)
+            release.set()
+
+        th = threading.Thread(target=_release)
+        th.start()
+
+        t0 = time.time()
+        d.submit("a", time.sleep, 0)
+        self.assertGreater(time.time() - t0, 0.2)
+        th.join()
+
+        d.close()
+        st = d.stats()
+        self.assertEqual(1, st["blocked"])
+        self.assertEqual(4, st["done"])
+
+    def test_error(self):
+        d = k3zkutil.ThreadDispatcher()
+
+        def _raise():
+            raise ValueError("foo")
+
+        d.submit("a", _raise)
+        d.close()
+        self.assertEqual(1, d.stats()["errors"])
+
+        # dropped after closed
+        d.submit("a", _raise)
+        self.assertEqual(1, d.stats()["submitted"])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, k3zkutil.ThreadDispatcher, threads=0)
+        self.assertRaises(ValueError, k3zkutil.ThreadDispatcher, maxsize=0)
+
+
+class TestAsyncioDispatcher(unittest.TestCase):
+    def test_run_in_loop(self):
+        loop = asyncio.new_event_loop()
+        th = threading.Thread(target=loop.run_forever)
+        th.start()
+
+        d = k3zkutil.AsyncioDispatcher(loop)
+        rst = []
+
+        def _run(i):
+            rst.append((threading.current_thread() is th, i))
+
+        for i in range(10):
+            d.submit("a", _run, i)
+
+        time.sleep(0.2)
+        loop.call_soon_threadsafe(loop.stop)
+        th.join()
+        loop.close()
+
+        self.assertEqual([(True, i) for i in range(10)], rst)
+        self.assertEqual(10, d.stats()["done"])
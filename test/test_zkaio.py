@@ -0,0 +1,174 @@
+import asyncio
+import unittest
+
+import k3ut
+import k3utdocker
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKAio(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def test_lock(self):
+        async def _run():
+            a = k3zkutil.AsyncZKLock("foo_name", zkclient=self.zk)
+            b = k3zkutil.AsyncZKLock("foo_name", zkclient=self.zk)
+
+            async with a:
+                self.assertTrue(a.is_locked())
+                self.assertEqual((False, a.identifier, 0), await b.try_acquire())
+
+                with k3ut.Timer() as t:
+                    with self.assertRaises(k3zkutil.LockTimeout):
+                        await b.acquire(timeout=0.2)
+                    self.assertAlmostEqual(0.2, t.spent(), places=1)
+
+            await b.acquire(timeout=1)
+            self.assertTrue(b.is_locked())
+            await b.release()
+
+        asyncio.run(_run())
+
+        with self.assertRaises(ValueError):
+            k3zkutil.AsyncZKLock("foo_name", zkclient=self.zk, priority=0)
+
+    def test_deleted_while_acquiring(self):
+        a = k3zkutil.AsyncZKLock("foo_name", zkclient=self.zk)
+        sess = {"get": None, "deleted": False}
+
+        orig_get_async = self.zk.get_async
+        orig_as_future = k3zkutil.zkaio.as_future
+
+        def _get_async(path, watch=None):
+            sess["get"] = orig_get_async(path, watch=watch)
+            return sess["get"]
+
+        def _as_future(async_result):
+            fut = orig_as_future(async_result)
+            if async_result is not sess["get"] or sess["deleted"]:
+                return fut
+
+            # delete the lock node after "get" replied, before the lock
+            # holder is updated
+            async def _delete_after_get():
+                rst = await fut
+                sess["deleted"] = True
+                self.zk.delete(a.lock_path)
+                await asyncio.sleep(0.2)
+                return rst
+
+            return _delete_after_get()
+
+        async def _run():
+            await a.acquire(timeout=1)
+            self.assertTrue(a.is_locked())
+            self.assertIsNotNone(self.zk.exists(a.lock_path))
+            await a.release()
+
+        self.zk.get_async = _get_async
+        k3zkutil.zkaio.as_future = _as_future
+        try:
+            asyncio.run(_run())
+        finally:
+            k3zkutil.zkaio.as_future = orig_as_future
+
+        self.assertTrue(sess["deleted"])
+
+    def test_concurrent(self):
+        sess = {"counter": 0, "total": 0}
+
+        async def _loop_acquire(n):
+            for ii in range(n):
+                async with k3zkutil.AsyncZKLock("foo_name", zkclient=self.zk, timeout=30):
+                    sess["counter"] += 1
+                    self.assertEqual(1, sess["counter"])
+                    await asyncio.sleep(0.001)
+                    sess["counter"] -= 1
+                    sess["total"] += 1
+
+        async def _run():
+            await asyncio.gather(*[_loop_acquire(10) for _ in range(20)])
+
+        asyncio.run(_run())
+        self.assertEqual(200, sess["total"])
+
+    def test_cas_loop(self):
+        self.zk.create("foo", b"1")
+
+        async def _incr():
+            async for curr in k3zkutil.async_cas_loop(self.zk, "foo"):
+                curr.v += 1
+
+        async def _run():
+            await asyncio.gather(*[_incr() for _ in range(10)])
+
+        asyncio.run(_run())
+
+        val, zstat = self.zk.get("foo")
+        self.assertEqual(b"11", val)
+
+        async def _by_hosts():
+            async for curr in k3zkutil.async_cas_loop("127.0.0.1:21811", "foo"):
+                curr.v += 1
+
+        # connecting a new client would block the loop
+        self.assertRaises(TypeError, asyncio.run, _by_hosts())
+
+    def test_get_next_and_wait_absent(self):
+        self.zk.create("foo", b"1")
+
+        async def _change():
+            await asyncio.sleep(0.2)
+            self.zk.set("foo", b"2")
+            await asyncio.sleep(0.2)
+            self.zk.delete("foo")
+
+        async def _run():
+            task = asyncio.ensure_future(_change())
+
+            val, zstat = await k3zkutil.async_get_next(self.zk, "foo", timeout=1, version=0)
+            self.assertEqual((b"2", 1), (val, zstat.version))
+
+            self.assertIsNone(await k3zkutil.async_wait_absent(self.zk, "foo", timeout=1))
+            await task
+
+            with self.assertRaises(k3zkutil.ZKWaitTimeout):
+                await k3zkutil.async_get_next(self.zk, "lock/", timeout=0.2, version=10)
+
+        asyncio.run(_run())
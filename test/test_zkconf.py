@@ -32,6 +32,7 @@ class TestZKConf(unittest.TestCase):
 
         self.assertEqual("lock_dir/", c.lock())
         self.assertEqual("lock_dir/a", c.lock("a"))
+        self.assertEqual("lock_dir/__queue__/a", c.lock_queue("a"))
         self.assertEqual("record_dir/", c.record())
         self.assertEqual("record_dir/a", c.record("a"))
         self.assertEqual("tx_dir/alive/", c.tx_alive())
@@ -117,3 +118,36 @@ class TestZKConf(unittest.TestCase):
             conf.zk_auth,
             conf.zk_acl,
         ) = old
+
+    def test_lock_shards(self):
+        c = k3zkutil.ZKConf(lock_dir="lock_dir/", lock_shards=16)
+
+        self.assertEqual(16, c.lock_shards())
+        self.assertEqual("lock_dir/", c.lock())
+        self.assertEqual("lock_dir/__queue__/", c.lock_queue())
+
+        # crc32("a") % 16 == 3
+        self.assertEqual("lock_dir/__shard__/03/a", c.lock("a"))
+        self.assertEqual("lock_dir/__queue__/03/a", c.lock_queue("a"))
+
+        self.assertEqual(16, len(c.lock_shard_dirs()))
+        self.assertEqual("lock_dir/__shard__/00/", c.lock_shard_dirs()[0])
+        self.assertEqual("lock_dir/__shard__/15/", c.lock_shard_dirs()[15])
+
+        # every name is in one of the shards
+        for i in range(100):
+            p = c.lock(i)
+            self.assertIn(p.rsplit("/", 1)[0] + "/", c.lock_shard_dirs())
+
+        c = k3zkutil.ZKConf(lock_dir="lock_dir/")
+        self.assertEqual(["lock_dir/"], c.lock_shard_dirs())
+        self.assertEqual("lock_dir/a", c.lock("a"))
+
+    def test_reserved_lock_names(self):
+        c = k3zkutil.ZKConf(lock_dir="lock_dir/")
+
+        for name in ("__queue__", "__shard__", "__queue__/a"):
+            self.assertRaises(ValueError, c.lock, name)
+            self.assertRaises(ValueError, c.lock_queue, name)
+
+        self.assertEqual("lock_dir/a__queue__", c.lock("a__queue__"))
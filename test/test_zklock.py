@@ -2,7 +2,12 @@ import time
 import unittest
 
 from kazoo.client import KazooClient
+from kazoo.exceptions import BadVersionError
 from kazoo.exceptions import ConnectionClosedError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
 
 import k3thread
 import k3ut
@@ -287,6 +292,52 @@ class TestZKLock(unittest.TestCase):
             released, holder, ver = l2.try_release()
             self.assertEqual((True, l2.identifier, 0), (released, holder, ver))
 
+    def test_try_acquire_many(self):
+        names = ["foo_{i}".format(i=i) for i in range(100)]
+
+        l1 = k3zkutil.ZKLock("foo_3", zkclient=self.zk)
+        with l1:
+            with k3ut.Timer() as t:
+                locks = k3zkutil.try_acquire_many(names, zkclient=self.zk)
+                self.assertAlmostEqual(0.0, t.spent(), delta=0.5)
+
+            self.assertEqual(names, [lck.lock_name for lck in locks])
+            self.assertEqual(99, len([lck for lck in locks if lck.is_locked()]))
+
+            self.assertFalse(locks[3].is_locked())
+            self.assertEqual(l1.identifier, locks[3].lock_holder[0])
+
+            for lck in locks:
+                lck.release()
+
+        self.assertEqual([], self.zk.get_children("lock"))
+
+        self.assertRaises(ValueError, k3zkutil.try_acquire_many, names)
+        self.assertRaises(ValueError, k3zkutil.try_acquire_many, names, zkclient=self.zk, queued=True)
+        self.assertRaises(ValueError, k3zkutil.try_acquire_many, names, zkclient=self.zk, priority=0)
+
+    def test_stats(self):
+        st = k3zkutil.ZKLockStats()
+        l1 = k3zkutil.ZKLock("foo_name", zkclient=self.zk, stats=st)
+        l2 = k3zkutil.ZKLock("foo_name", zkclient=self.zk, stats=st)
+
+        with l1:
+            self.assertRaises(k3zkutil.LockTimeout, l2.acquire, timeout=0.1)
+            time.sleep(0.1)
+
+        l2.acquire()
+        self.zk.delete(l2.lock_path)
+        time.sleep(0.1)
+        l2.release()
+
+        snap = st.snapshot()["foo_name"]
+        self.assertEqual(2, snap["acquired"])
+        self.assertEqual(1, snap["timeout"])
+        self.assertEqual(1, snap["lost"])
+        self.assertEqual(2, snap["released"])
+        self.assertEqual(3, snap["wait"]["count"])
+        self.assertGreaterEqual(snap["hold"]["sum"], 0.1)
+
     def test_zk_lost(self):
         sess = {"acquired": True}
 
@@ -496,3 +547,465 @@ class TestZKLock(unittest.TestCase):
 
         lock.release()
         self.assertTrue(lock.zkclient._stopped.is_set())
+
+    def test_queued_fifo(self):
+        holder = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+        holder.acquire()
+
+        order = []
+
+        def _wait(ident):
+            lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+            with lock:
+                order.append(ident)
+
+        ths = []
+        for ii in range(5):
+            ths.append(k3thread.daemon(_wait, args=(ii,)))
+            # let waiters line up in order
+            time.sleep(0.1)
+
+        self.assertEqual(5, len(self.zk.get_children(holder.queue_path)))
+
+        holder.release()
+        for th in ths:
+            th.join()
+
+        self.assertEqual([0, 1, 2, 3, 4], order)
+
+    def test_queued_priority(self):
+        holder = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+        holder.acquire()
+
+        order = []
+
+        def _wait(ident, priority, aging):
+            lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True, priority=priority, aging=aging)
+            with lock:
+                order.append(ident)
+
+        ths = []
+        for ident, priority in ((0, None), (1, 0), (2, 0), (3, None), (4, 5), (5, 1)):
+            ths.append(k3thread.daemon(_wait, args=(ident, priority, 10)))
+            time.sleep(0.1)
+
+        holder.release()
+        for th in ths:
+            th.join()
+
+        # waiters without priority count as priority 0
+        self.assertEqual([4, 5, 0, 1, 2, 3], order)
+
+        # aging: waiting 1 second is worth more than 1 priority level of 0.1 second
+        holder.acquire()
+        order = []
+        ths = [k3thread.daemon(_wait, args=(0, 0, 0.1))]
+        time.sleep(1)
+        ths.append(k3thread.daemon(_wait, args=(1, 1, 0.1)))
+        time.sleep(0.1)
+
+        holder.release()
+        for th in ths:
+            th.join()
+
+        self.assertEqual([0, 1], order)
+
+        # a waiter without priority is not starved by prioritized ones
+        holder.acquire()
+        order = []
+        ths = [k3thread.daemon(_wait, args=(0, None, 0.1))]
+        time.sleep(1)
+        for i in range(1, 4):
+            ths.append(k3thread.daemon(_wait, args=(i, 5, 0.1)))
+            time.sleep(0.1)
+
+        holder.release()
+        for th in ths:
+            th.join()
+
+        self.assertEqual(0, order[0])
+
+    def test_queue_order(self):
+        sort_queue = k3zkutil.zklock._sort_queue
+
+        # skewed clocks do not reorder waiters without priority
+        self.assertEqual(
+            ["a-2000-0000000001", "b-1000-0000000002", "d-1000-0000000004", "c_2500-0000000003"],
+            sort_queue(["d-1000-0000000004", "c_2500-0000000003", "b-1000-0000000002", "a-2000-0000000001"]),
+        )
+
+        # a waiter without enqueue time keeps its place among plain waiters
+        self.assertEqual(
+            ["a-2000-0000000001", "b-0000000002", "c_2500-0000000003"],
+            sort_queue(["c_2500-0000000003", "b-0000000002", "a-2000-0000000001"]),
+        )
+
+    def test_queued_estimated_wait(self):
+        stats = k3zkutil.ZKLockStats()
+        stats.on_released("foo_name", 2)
+
+        holder = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+        holder.acquire()
+
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True, stats=stats)
+        c = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True, stats=stats)
+        self.assertIsNone(b.estimated_wait())
+
+        b_loop = b.acquire_loop(timeout=1)
+        next(b_loop)
+        self.assertEqual((1, 1), (b.ahead, b.waiters))
+        self.assertEqual(2, b.estimated_wait())
+
+        for holder_ident, ver in c.acquire_loop(timeout=1):
+            self.assertEqual((2, 2), (c.ahead, c.waiters))
+            self.assertEqual(4, c.estimated_wait())
+            # give up, it is not possible to acquire in time
+            break
+
+        self.assertIsNone(c.queue_node)
+        self.assertIsNone(c.estimated_wait())
+
+        b_loop.close()
+        holder.release()
+
+    def test_queued_holder_and_timeout(self):
+        a = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, queued=True)
+
+        with a:
+            locked, holder, ver = b.try_acquire()
+            self.assertEqual((False, a.identifier, 0), (locked, holder, ver))
+
+            self.assertRaises(k3zkutil.LockTimeout, b.acquire, timeout=0.2)
+
+            # waiter node is removed on timeout
+            self.assertIsNone(b.queue_node)
+            self.assertIsNone(self.zk.exists(b.queue_path))
+
+        b.acquire(timeout=1)
+        self.assertTrue(b.is_locked())
+        b.release()
+
+        # another waiter is at the head of the queue but the lock node is
+        # not created yet
+        self.zk.create(b.queue_path + "/0-", b"{}", sequence=True, makepath=True)
+        self.assertEqual((False, None, -1), b.try_acquire())
+        self.assertIsNone(b.queue_node)
+
+    def test_manager(self):
+        sess = {"lost": 0}
+
+        def on_lost():
+            sess["lost"] += 1
+
+        for dispatch_thread in (False, True):
+            sess["lost"] = 0
+            mgr = k3zkutil.ZKLockManager(self.zk, dispatch_thread=dispatch_thread)
+            n_listener = len(self.zk.state_listeners)
+
+            locks = [mgr.lock("foo_{i}".format(i=i), on_lost=on_lost) for i in range(10)]
+            self.assertEqual(n_listener, len(self.zk.state_listeners))
+            self.assertEqual(10, len(mgr.get_locks()))
+            self.assertEqual([locks[1]], mgr.get_locks("foo_1"))
+
+            for lck in locks:
+                lck.acquire()
+                self.assertIs(self.zk, lck.zkclient)
+
+            # held locks are pending while suspended
+            mgr.on_connection_change(KazooState.SUSPENDED)
+            time.sleep(0.1)
+            self.assertEqual(0, sess["lost"])
+            for lck in locks:
+                self.assertTrue(lck._suspended)
+
+            mgr.on_connection_change(KazooState.LOST)
+            time.sleep(0.1)
+            self.assertEqual(10, sess["lost"])
+
+            # reported once
+            mgr.on_connection_change(KazooState.LOST)
+            time.sleep(0.1)
+            self.assertEqual(10, sess["lost"])
+
+            for lck in locks:
+                lck.release()
+
+            self.assertEqual([], mgr.get_locks())
+            mgr.close()
+            self.assertNotIn(mgr.on_connection_change, self.zk.state_listeners)
+
+    def _local_loop_acquire(self, n, **kwargs):
+        for ii in range(n):
+            with k3zkutil.ZKLock("foo_name", zkclient=self.zk, timeout=30, **kwargs):
+                self.counter += 1
+                self.assertEqual(1, self.counter)
+                time.sleep(0.001)
+                self.counter -= 1
+                self.total += 1
+
+    def test_local_first(self):
+        for kwargs in (
+            dict(local_first=True),
+            dict(local_first=True, local_handoff=True),
+        ):
+            self.total = 0
+            ths = [k3thread.daemon(self._local_loop_acquire, args=(10,), kwargs=kwargs) for _ in range(5)]
+            for th in ths:
+                th.join()
+
+            self.assertEqual(50, self.total)
+            self.assertIsNone(self.zk.exists(self.lck.lock_path))
+
+        # local contenders share one identifier
+        a = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True)
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True)
+        self.assertEqual(a.identifier["id"], b.identifier["id"])
+
+        with a:
+            self.assertRaises(k3zkutil.LockTimeout, b.acquire, timeout=0.2)
+
+            # other process still sees the lock held
+            locked, holder, ver = self.lck.try_acquire()
+            self.assertFalse(locked)
+            self.assertEqual(a.identifier["id"], holder["id"])
+
+    def test_local_handoff(self):
+        a = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True, local_handoff=True)
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True, local_handoff=True)
+
+        a.acquire()
+        val, zstat = self.zk.get(a.lock_path)
+
+        th = k3thread.daemon(b.acquire)
+        time.sleep(0.1)
+        a.release()
+        th.join()
+
+        self.assertTrue(b.is_locked())
+
+        # the zk node is handed over, not re-created
+        val2, zstat2 = self.zk.get(b.lock_path)
+        self.assertEqual(zstat.czxid, zstat2.czxid)
+
+        b.release()
+        self.assertIsNone(self.zk.exists(b.lock_path))
+
+        # a local contender with its own identifier does not adopt the kept
+        # node of others, it is deleted and created again
+        a = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True, local_handoff=True, identifier="a")
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, local_first=True, local_handoff=True, identifier="b")
+
+        a.acquire()
+        th = k3thread.daemon(b.acquire, kwargs={"timeout": 1})
+        time.sleep(0.1)
+        a.release()
+        th.join()
+
+        self.assertTrue(b.is_locked())
+        self.assertEqual("b", k3utfjson.load(self.zk.get(b.lock_path)[0])["id"])
+
+        b.release()
+        self.assertIsNone(self.zk.exists(b.lock_path))
+
+    def test_lease(self):
+        self.assertRaises(ValueError, k3zkutil.ZKLock, "foo_name", zkclient=self.zk, lease=0)
+        self.assertRaises(ValueError, k3zkutil.ZKLock, "foo_name", zkclient=self.zk, lease=1, local_first=True)
+
+        zk = wait_for_zk("127.0.0.1:21811")
+        zk.add_auth("digest", "xp:123")
+
+        lost = []
+        a = k3zkutil.ZKLock("foo_name", zkclient=zk, lease=0.6, on_lost=lambda: lost.append(1))
+        a.acquire()
+
+        val, zstat = self.zk.get(a.lock_path)
+        self.assertEqual(0, zstat.ephemeralOwner)
+        self.assertIn("expire", k3utfjson.load(val))
+
+        # renewed in background
+        time.sleep(1)
+        val2, zstat2 = self.zk.get(a.lock_path)
+        self.assertGreater(zstat2.version, zstat.version)
+        self.assertGreater(k3utfjson.load(val2)["expire"], k3utfjson.load(val)["expire"])
+        self.assertTrue(a.is_locked())
+        self.assertEqual([], lost)
+
+        # the holder stops renewing, the lease expires
+        zk.stop()
+
+        b = k3zkutil.ZKLock("foo_name", zkclient=self.zk, lease=0.6)
+        self.assertFalse(b.try_acquire()[0])
+
+        t0 = time.time()
+        b.acquire(timeout=2)
+        self.assertTrue(b.is_locked())
+        self.assertLess(time.time() - t0, 1)
+
+        # the renewer finds out it has expired
+        time.sleep(0.5)
+        self.assertEqual([1], lost)
+
+        b.release()
+        self.assertIsNone(self.zk.exists(b.lock_path))
+
+    def test_lease_session_expired(self):
+        lost = []
+        a = k3zkutil.ZKLock("foo_name", zkclient=self.zk, lease=3, on_lost=lambda: lost.append(1))
+        a.acquire()
+
+        # before the first renewal, the watch of acquiring is still armed
+        a.on_connection_change(KazooState.LOST)
+        a.on_node_change(WatchedEvent(EventType.NONE, KeeperState.EXPIRED_SESSION, None))
+        self.assertEqual([], lost)
+        self.assertTrue(a.is_locked())
+
+        a.on_connection_change(KazooState.CONNECTED)
+        self.assertEqual([], lost)
+
+        a.release()
+        self.assertIsNone(self.zk.exists(a.lock_path))
+
+    def test_suspended(self):
+        lost = []
+        lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, on_lost=lambda: lost.append(1))
+        lock.acquire()
+
+        # a blip does not lose the lock
+        lock.on_connection_change(KazooState.SUSPENDED)
+        lock.on_connection_change(KazooState.CONNECTED)
+        time.sleep(0.1)
+        self.assertEqual([], lost)
+        self.assertTrue(lock.is_locked())
+
+        # taken by other while suspended
+        lock.on_connection_change(KazooState.SUSPENDED)
+        self.zk.set(lock.lock_path, k3utfjson.dump({"id": "other", "val": None}).encode("utf-8"))
+        lock.on_connection_change(KazooState.CONNECTED)
+        time.sleep(0.1)
+        self.assertEqual([1], lost)
+        self.zk.delete(lock.lock_path)
+
+        # suspended longer than grace period
+        lost = []
+        lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, on_lost=lambda: lost.append(1), suspended_grace=0.1)
+        lock.acquire()
+
+        lock.on_connection_change(KazooState.SUSPENDED)
+        time.sleep(0.2)
+        self.assertEqual([1], lost)
+
+        lock.on_connection_change(KazooState.LOST)
+        self.assertEqual([1], lost, "reported only once")
+
+        lock.release()
+
+        # a non-ephemeral lock survives session expiry, it is pending until
+        # reconnected, even though every watch receives a session event
+        lost = []
+        lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, on_lost=lambda: lost.append(1), ephemeral=False)
+        lock.acquire()
+
+        lock.on_connection_change(KazooState.LOST)
+        lock.on_node_change(WatchedEvent(EventType.NONE, KeeperState.EXPIRED_SESSION, None))
+        self.assertEqual([], lost)
+        self.assertTrue(lock.is_locked())
+
+        lock.on_connection_change(KazooState.CONNECTED)
+        time.sleep(0.1)
+        self.assertEqual([], lost)
+
+        lock.release()
+
+    def test_get_owner(self):
+        self.assertIsNone(self.lck.get_owner())
+        self.assertIsNone(k3zkutil.get_lock_owner(self.zk, "foo_name"))
+
+        zk = wait_for_zk("127.0.0.1:21811")
+        zk.add_auth("digest", "xp:123")
+
+        lock = k3zkutil.ZKLock("foo_name", zkclient=zk)
+        with lock:
+            time.sleep(0.1)
+            holder, ver = self.lck.get_owner()
+            self.assertEqual(lock.identifier["id"], holder["id"])
+            self.assertEqual(0, ver)
+
+            # served from cache
+            self.assertIs(holder, k3zkutil.get_lock_owner(self.zk, "foo_name")[0])
+
+            lock.set_lock_val(3)
+            time.sleep(0.1)
+            holder, ver = self.lck.get_owner()
+            self.assertEqual(3, holder["val"])
+            self.assertEqual(1, ver)
+
+        time.sleep(0.1)
+        self.assertIsNone(self.lck.get_owner())
+
+        # the holder sees itself
+        with lock:
+            self.assertEqual(lock.identifier["id"], lock.get_owner()[0]["id"])
+
+        # session events of watches do not break the cache or the locks
+        ev = WatchedEvent(EventType.NONE, KeeperState.EXPIRED_SESSION, None)
+        self.lck.on_node_change(ev)
+        k3zkutil.zklock._holder_caches[self.zk].on_node_change(ev)
+        self.assertTrue(self.lck.maybe_available.is_set())
+        self.assertIsNone(self.lck.get_owner())
+
+        zk.stop()
+
+    def test_set_lock_val_versioned(self):
+        lost = []
+        lock = k3zkutil.ZKLock("foo_name", zkclient=self.zk, on_lost=lambda: lost.append(1))
+
+        # acquire if not locked
+        self.assertEqual(1, lock.set_lock_val("a"))
+        self.assertTrue(lock.is_locked())
+        self.assertEqual(("a", 1), lock.get_lock_val())
+
+        self.assertEqual(2, lock.set_lock_val("b"))
+        self.assertEqual(2, lock.lock_holder[1])
+
+        # updated by others but still ours
+        val, zstat = self.zk.get(lock.lock_path)
+        self.zk.set(lock.lock_path, val)
+        self.assertEqual(4, lock.set_lock_val("c"))
+        self.assertEqual(("c", 4), lock.get_lock_val())
+
+        self.assertRaises(BadVersionError, lock.set_lock_val, "d", version=1)
+
+        time.sleep(0.1)
+        self.assertEqual([], lost)
+
+        lock.release()
+
+    def test_set_lock_vals(self):
+        self.assertEqual([], k3zkutil.set_lock_vals([]))
+
+        locks = [k3zkutil.ZKLock("foo_{i}".format(i=i), zkclient=self.zk) for i in range(10)]
+        for lck in locks:
+            lck.acquire()
+
+        vers = k3zkutil.set_lock_vals([(lck, i) for i, lck in enumerate(locks)])
+        self.assertEqual([1] * 10, vers)
+        for i, lck in enumerate(locks):
+            self.assertEqual((i, 1), lck.get_lock_val())
+            self.assertEqual(i, lck.identifier["val"])
+
+        # a version mismatch is verified and retried
+        val, zstat = self.zk.get(locks[3].lock_path)
+        self.zk.set(locks[3].lock_path, val)
+        vers = k3zkutil.set_lock_vals([(lck, "x") for lck in locks])
+        self.assertEqual(3, vers[3])
+        self.assertEqual(("x", 3), locks[3].get_lock_val())
+
+        # taken by other
+        self.zk.delete(locks[5].lock_path)
+        self.zk.create(locks[5].lock_path, k3utfjson.dump({"id": "other", "val": None}).encode("utf-8"))
+        self.assertRaises(k3zkutil.exceptions.ZKUtilError, k3zkutil.set_lock_vals, [(lck, "y") for lck in locks])
+        self.assertEqual(("x", 2), locks[0].get_lock_val())
+
+        for lck in locks:
+            lck.release()
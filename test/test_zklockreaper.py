@@ -0,0 +1,122 @@
+import time
+import unittest
+
+import k3ut
+import k3utdocker
+import k3utfjson
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKLockReaper(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def _create_lock(self, name, node_id="foo", process_id=999999, ip=None):
+        if ip is None:
+            ip = k3zkutil.zkutil.host_ip4[0]
+
+        ident = {"id": "{n}-{ip}-{p}-abc".format(n=node_id, ip=ip, p=process_id), "val": None}
+        self.zk.create("lock/" + name, k3utfjson.dump(ident).encode("utf-8"))
+
+    def test_reap_dead_pid(self):
+        self._create_lock("a")
+        self._create_lock("b")
+        self._create_lock("c", ip="255.255.255.0")
+
+        alive = k3zkutil.ZKLock("d", zkclient=self.zk, ephemeral=False)
+        alive.acquire()
+        eph = k3zkutil.ZKLock("e", zkclient=self.zk)
+        eph.acquire()
+
+        reaper = k3zkutil.ZKLockReaper(self.zk, k3zkutil.LocalPidLiveness())
+
+        self.assertEqual(["a", "b", "c", "d"], sorted([lck["name"] for lck in reaper.scan()]))
+        self.assertEqual(["a", "b"], sorted([lck["name"] for lck in reaper.reap(dry_run=True)]))
+        self.assertEqual(["a", "b", "c", "d", "e"], sorted(self.zk.get_children("lock")))
+
+        self.assertEqual(["a", "b"], sorted([lck["name"] for lck in reaper.reap()]))
+        self.assertEqual(["c", "d", "e"], sorted(self.zk.get_children("lock")))
+
+        alive.release()
+        eph.release()
+
+    def test_changed_lock_kept(self):
+        self._create_lock("a")
+
+        reaper = k3zkutil.ZKLockReaper(self.zk, k3zkutil.AgeLiveness(0))
+        dead = reaper.find_dead()
+        self.assertEqual(["a"], [lck["name"] for lck in dead])
+
+        # re-acquired by others after scan
+        self.zk.delete("lock/a")
+        self._create_lock("a")
+
+        reaper.find_dead = lambda: dead
+        self.assertEqual([], reaper.reap())
+        self.assertEqual(["a"], self.zk.get_children("lock"))
+
+    def test_age_and_heartbeat(self):
+        self._create_lock("a")
+
+        reaper = k3zkutil.ZKLockReaper(self.zk, k3zkutil.AgeLiveness(60))
+        self.assertEqual([], reaper.reap())
+
+        time.sleep(0.2)
+        self._create_lock("c", node_id="bar")
+        ident = {"id": "{n}-{ip}-{p}-abc".format(n="baz", ip="1.1.1.1", p=1), "val": None, "expire": time.time() + 60}
+        self.zk.create("lock/lease", k3utfjson.dump(ident).encode("utf-8"))
+        time.sleep(0.2)
+        # updated recently
+        self.zk.set("lock/c", self.zk.get("lock/c")[0])
+
+        reaper = k3zkutil.ZKLockReaper(self.zk, k3zkutil.AgeLiveness(0.1))
+        self.assertEqual(["a"], [lck["name"] for lck in reaper.reap()])
+        self.zk.delete("lock/c")
+        self.zk.delete("lock/lease")
+
+        lck = k3zkutil.ZKLock("b", zkclient=self.zk, ephemeral=False)
+        lck.acquire()
+
+        liveness = k3zkutil.HeartbeatLiveness(self.zk, "heartbeat")
+        reaper = k3zkutil.ZKLockReaper(self.zk, liveness)
+        self.assertEqual(["b"], [x["name"] for x in reaper.find_dead()])
+
+        k3zkutil.register_heartbeat(self.zk, "heartbeat")
+        self.assertEqual([], reaper.reap())
+
+        lck.release()
@@ -0,0 +1,196 @@
+import io
+import json
+import unittest
+
+import k3ut
+import k3utdocker
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+from k3zkutil.zkcli import main
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKLockScan(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+        self.flat = k3zkutil.ZKConf(lock_dir="lock/")
+        self.sharded = k3zkutil.ZKConf(lock_dir="lock/", lock_shards=8)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def test_sharded_lock(self):
+        locks = [k3zkutil.ZKLock("foo_{i}".format(i=i), zkclient=self.zk, zkconf=self.sharded) for i in range(20)]
+        for lck in locks:
+            lck.acquire()
+            self.assertTrue(lck.lock_path.startswith("lock/__shard__/"))
+            self.assertIsNotNone(self.zk.exists(lck.lock_path))
+
+        # the flat dir only has the shard dir
+        self.assertEqual(["__shard__"], self.zk.get_children("lock"))
+
+        names = k3zkutil.list_locks(self.zk, self.sharded)
+        self.assertEqual(sorted([(lck.lock_name, lck.lock_path) for lck in locks]), sorted(names))
+
+        for lck in locks:
+            lck.release()
+
+        self.assertEqual([], k3zkutil.list_locks(self.zk, self.sharded))
+
+    def test_migrate(self):
+        self.assertRaises(ValueError, k3zkutil.migrate_lock_shards, self.zk, self.flat)
+
+        kept = k3zkutil.ZKLock("kept", zkclient=self.zk, zkconf=self.flat)
+        kept.acquire()
+        for i in range(10):
+            k3zkutil.ZKLock("foo_{i}".format(i=i), zkclient=self.zk, zkconf=self.flat, ephemeral=False).acquire()
+
+        self.assertEqual(11, len(k3zkutil.list_locks(self.zk, self.sharded)))
+
+        moved, left = k3zkutil.migrate_lock_shards(self.zk, self.sharded, dry_run=True)
+        self.assertEqual(10, len(moved))
+        self.assertEqual(["kept"], left)
+        self.assertEqual(11, len(self.zk.get_children("lock")))
+
+        moved, left = k3zkutil.migrate_lock_shards(self.zk, self.sharded)
+        self.assertEqual(10, len(moved))
+        self.assertEqual(["kept"], left)
+        self.assertEqual(sorted(["kept", "__shard__"]), sorted(self.zk.get_children("lock")))
+
+        # moved locks are still held
+        lck = k3zkutil.ZKLock("foo_1", zkclient=self.zk, zkconf=self.sharded)
+        locked, holder, ver = lck.try_acquire()
+        self.assertFalse(locked)
+
+        names = k3zkutil.list_locks(self.zk, self.sharded)
+        self.assertEqual(11, len(names))
+        self.assertIn(("foo_1", self.sharded.lock("foo_1")), names)
+        self.assertIn(("kept", "lock/kept"), names)
+
+        kept.release()
+
+    def test_scan_locks(self):
+        a = k3zkutil.ZKLock("a", zkclient=self.zk, zkconf=self.sharded, identifier="web-1.1.1.1-10-x")
+        b = k3zkutil.ZKLock("b", zkclient=self.zk, zkconf=self.sharded, identifier="web-1.1.1.1-11-y", ephemeral=False)
+        c = k3zkutil.ZKLock("c", zkclient=self.zk, zkconf=self.sharded, identifier="db-2.2.2.2-10-z")
+        for lck in (a, b, c):
+            lck.acquire()
+
+        # not a ZKLock node
+        sem = k3zkutil.ZKSemaphore("sem", 2, zkclient=self.zk, zkconf=self.sharded)
+        sem.acquire()
+
+        locks = k3zkutil.scan_locks(self.zk, self.sharded)
+        self.assertEqual(["a", "b", "c"], sorted([lck["name"] for lck in locks]))
+
+        byname = {lck["name"]: lck for lck in locks}
+        self.assertEqual(b.lock_path, byname["b"]["path"])
+        self.assertEqual(a.identifier, byname["a"]["holder"])
+        self.assertTrue(byname["a"]["ephemeral"])
+        self.assertFalse(byname["b"]["ephemeral"])
+        self.assertEqual(11, byname["b"]["lock_id"]["process_id"])
+
+        idx = k3zkutil.LockIndex(locks)
+        self.assertEqual(["a", "b"], sorted([lck["name"] for lck in idx.find(node_id="web")]))
+        self.assertEqual(["a"], [lck["name"] for lck in idx.oldest(1)])
+
+        out = io.StringIO()
+        main(
+            [
+                "locks",
+                "--hosts",
+                "127.0.0.1:21811",
+                "--auth",
+                "digest:xp:123",
+                "--lock-shards",
+                "8",
+                "--json",
+                "--node-id",
+                "db",
+            ],
+            out=out,
+        )
+        lines = [json.loads(x) for x in out.getvalue().splitlines()]
+        self.assertEqual(["c"], [x["name"] for x in lines])
+
+        out = io.StringIO()
+        main(["locks", "--hosts", "127.0.0.1:21811", "--lock-shards", "8", "--summary"], out=out)
+        self.assertEqual({"web": 2, "db": 1}, {k: v["locks"] for k, v in json.loads(out.getvalue()).items()})
+
+        sem.release()
+        for lck in (a, b, c):
+            lck.release()
+
+
+class TestLockIndex(unittest.TestCase):
+    def _lock(self, name, ident, ctime):
+        return {
+            "name": name,
+            "path": "lock/" + name,
+            "holder": {"id": ident, "val": None},
+            "lock_id": k3zkutil.parse_lock_id(ident),
+            "ctime": ctime,
+        }
+
+    def test_index(self):
+        locks = [
+            self._lock("a", "web-1.1.1.1-10-x", 3),
+            self._lock("b", "web-1.1.1.1-11-x", 1),
+            self._lock("c", "db-2.2.2.2-10-x", 2),
+            self._lock("d", "txid:5-2.2.2.2-10-x", 4),
+        ]
+        idx = k3zkutil.LockIndex(locks)
+
+        def names(lcks):
+            return [lck["name"] for lck in lcks]
+
+        self.assertEqual(["a", "b"], names(idx.find(node_id="web")))
+        self.assertEqual(["a"], names(idx.find(node_id="web", process_id=10)))
+        self.assertEqual(["c", "d"], names(idx.find(ip="2.2.2.2")))
+        self.assertEqual(["c", "d"], names(idx.find(ip="2.2.2.2", process_id=10)))
+        self.assertEqual(["d"], names(idx.find(txid="5")))
+        self.assertEqual([], names(idx.find(node_id="foo")))
+        self.assertEqual(["a", "b", "c", "d"], names(idx.find()))
+
+        self.assertEqual(["b", "c"], names(idx.oldest(2)))
+        self.assertEqual(["b", "c", "a", "d"], names(idx.oldest()))
+
+        self.assertEqual(
+            {
+                "web": {"locks": 2, "processes": 2, "max_age": 9},
+                "db": {"locks": 1, "processes": 1, "max_age": 8},
+                "txid:5": {"locks": 1, "processes": 1, "max_age": 6},
+            },
+            idx.summary(now=10),
+        )
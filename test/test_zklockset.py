@@ -0,0 +1,170 @@
+import time
+import unittest
+
+import k3thread
+import k3ut
+import k3utdocker
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKLockSet(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def test_acquire_release(self):
+        ls = k3zkutil.ZKLockSet(["a", "b", "c"], zkclient=self.zk)
+
+        with ls:
+            self.assertTrue(ls.is_locked())
+            for n in ("a", "b", "c"):
+                self.assertEqual((ls.identifier, 0), ls.lock_holders[n])
+
+        for n in ("a", "b", "c"):
+            self.assertIsNone(self.zk.exists(ls.zkconf.lock(n)))
+
+        self.assertNotIn(ls.on_connection_change, self.zk.state_listeners)
+
+    def test_sharded(self):
+        conf = {"lock_shards": 4}
+        ls = k3zkutil.ZKLockSet(["a", "b", "c", "d", "e"], zkconf=conf, zkclient=self.zk)
+
+        with ls:
+            self.assertTrue(ls.is_locked())
+            for n in ls.lock_names:
+                self.assertIn("/__shard__/", ls.zkconf.lock(n))
+                self.assertIsNotNone(self.zk.exists(ls.zkconf.lock(n)))
+
+        for n in ls.lock_names:
+            self.assertIsNone(self.zk.exists(ls.zkconf.lock(n)))
+
+        # a ZKLock on the same sharded name excludes the set
+        other = k3zkutil.ZKLock("a", zkconf=conf, zkclient=self.zk)
+        other.acquire()
+        ls = k3zkutil.ZKLockSet(["a", "f"], zkconf=conf, zkclient=self.zk, timeout=0.2)
+        self.assertRaises(k3zkutil.LockTimeout, ls.acquire)
+        other.release()
+
+        ols = k3zkutil.ZKOrderedLockSet(self.zk, zkconf=conf)
+        ols.lock("b")
+        ols.lock("a")
+        self.assertEqual(["a", "b"], ols.keys)
+        self.assertIsNotNone(self.zk.exists(ls.zkconf.lock("b")))
+        ols.release()
+        self.assertEqual([], ols.keys)
+
+    def test_all_or_nothing(self):
+        lck = k3zkutil.ZKLock("b", zkclient=self.zk)
+        lck.acquire()
+
+        ls = k3zkutil.ZKLockSet(["a", "b", "c"], zkclient=self.zk)
+
+        locked, holders = ls.try_acquire()
+        self.assertFalse(locked)
+        self.assertEqual({"b": (lck.identifier, 0)}, holders)
+
+        # nothing is left locked by a failed lock set
+        self.assertIsNone(self.zk.exists(ls.zkconf.lock("a")))
+        self.assertIsNone(self.zk.exists(ls.zkconf.lock("c")))
+
+        self.assertRaises(k3zkutil.LockTimeout, ls.acquire, timeout=0.2)
+
+        k3thread.daemon(lck.release, after=0.5)
+        ls.acquire(timeout=2)
+        self.assertTrue(ls.is_locked())
+
+        ls.release()
+
+    def test_lost(self):
+        sess = {"acquired": True}
+
+        def on_lost():
+            sess["acquired"] = False
+
+        ls = k3zkutil.ZKLockSet(["a", "b"], zkclient=self.zk, on_lost=on_lost)
+
+        with ls:
+            self.zk.delete(ls.zkconf.lock("b"))
+            time.sleep(0.1)
+            self.assertFalse(sess["acquired"])
+
+    def test_ordered_lock(self):
+        other = k3zkutil.ZKLock("a", zkclient=self.zk)
+        other.acquire()
+
+        ls = k3zkutil.ZKOrderedLockSet(self.zk, timeout=0.2)
+        ls.lock("c")
+        ls.lock("c")
+        ls.lock("d")
+        self.assertEqual(["c", "d"], ls.keys)
+        self.assertEqual(2, ls.forward)
+
+        ls.lock("b")
+        self.assertEqual(["b", "c", "d"], ls.keys)
+        self.assertEqual(1, ls.backward)
+
+        self.assertRaises(k3zkutil.BackwardLockingConflict, ls.lock, "a")
+        self.assertEqual(1, ls.conflicts)
+        self.assertEqual(["b", "c", "d"], ls.keys)
+
+        ls.release()
+        self.assertEqual([], ls.keys)
+        self.assertEqual(["a"], self.zk.get_children("lock"))
+
+        other.release()
+
+    def test_ordered_run(self):
+        other = k3zkutil.ZKLock("a", zkclient=self.zk)
+        other.acquire()
+        k3thread.daemon(other.release, after=0.3)
+
+        def job(ls):
+            ls.lock("b")
+            ls.lock("a")
+            return list(ls.keys)
+
+        ls = k3zkutil.ZKOrderedLockSet(self.zk, backoff=0.05)
+        self.assertEqual(["a", "b"], ls.run(job))
+        self.assertGreater(ls.restarts, 0)
+        self.assertEqual([], ls.keys)
+        self.assertEqual([], self.zk.get_children("lock"))
+
+        other.acquire()
+        ls = k3zkutil.ZKOrderedLockSet(self.zk, max_restarts=2)
+        self.assertRaises(k3zkutil.BackwardLockingConflict, ls.run, job)
+        self.assertEqual(2, ls.restarts)
+        other.release()
@@ -0,0 +1,72 @@
+import unittest
+
+import k3ut
+import k3zkutil
+
+dd = k3ut.dd
+
+
+class TestZKLockStats(unittest.TestCase):
+    def test_snapshot(self):
+        st = k3zkutil.ZKLockStats(buckets=(0.1, 1))
+
+        st.on_acquired("foo", 0.05, 0)
+        st.on_acquired("foo", 0.5, 3)
+        st.on_timeout("foo", 2, 1)
+        st.on_released("foo", 0.1)
+        st.on_lost("bar")
+
+        snap = st.snapshot()
+        self.assertEqual(["bar", "foo"], sorted(snap.keys()))
+
+        foo = snap["foo"]
+        self.assertEqual(
+            {"acquired": 2, "timeout": 1, "retries": 4, "released": 1, "lost": 0},
+            {k: foo[k] for k in ("acquired", "timeout", "retries", "released", "lost")},
+        )
+        self.assertEqual(3, foo["wait"]["count"])
+        self.assertAlmostEqual(2.55, foo["wait"]["sum"])
+        self.assertEqual([[0.1, 1], [1, 2]], foo["wait"]["buckets"])
+        self.assertEqual(
+            {"count": 1, "sum": 0.1, "buckets": [[0.1, 1], [1, 1]]},
+            foo["hold"],
+        )
+
+        self.assertEqual(1, snap["bar"]["lost"])
+        self.assertEqual(0, snap["bar"]["wait"]["count"])
+
+        st.reset()
+        self.assertEqual({}, st.snapshot())
+
+    def test_mean_hold(self):
+        st = k3zkutil.ZKLockStats()
+        self.assertIsNone(st.mean_hold("foo"))
+
+        st.on_acquired("foo", 0.05, 0)
+        self.assertIsNone(st.mean_hold("foo"))
+
+        st.on_released("foo", 1)
+        st.on_released("foo", 3)
+        self.assertAlmostEqual(2, st.mean_hold("foo"))
+        self.assertIsNone(st.mean_hold("bar"))
+
+    def test_prometheus(self):
+        st = k3zkutil.ZKLockStats(buckets=(1,))
+        st.on_acquired('a"b', 0.5, 2)
+
+        text = st.prometheus()
+        dd(text)
+
+        lines = text.splitlines()
+        for line in (
+            "# TYPE zklock_acquired_total counter",
+            'zklock_acquired_total{lock="a\\"b"} 1',
+            'zklock_retries_total{lock="a\\"b"} 2',
+            "# TYPE zklock_wait_seconds histogram",
+            'zklock_wait_seconds_bucket{lock="a\\"b",le="1"} 1',
+            'zklock_wait_seconds_bucket{lock="a\\"b",le="+Inf"} 1',
+            'zklock_wait_seconds_sum{lock="a\\"b"} 0.5',
+            'zklock_wait_seconds_count{lock="a\\"b"} 1',
+            'zklock_hold_seconds_count{lock="a\\"b"} 0',
+        ):
+            self.assertIn(line, lines)
@@ -0,0 +1,121 @@
+import time
+import unittest
+
+import k3thread
+import k3ut
+import k3utdocker
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKRWLock(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def test_shared_read(self):
+        a = k3zkutil.ZKRWLock("foo_name", zkclient=self.zk)
+        b = k3zkutil.ZKRWLock("foo_name", zkclient=self.zk)
+
+        with a:
+            locked, holder, ver = b.try_acquire()
+            self.assertTrue(locked)
+            self.assertEqual(b.identifier, holder)
+            b.release()
+
+    def test_exclusive_write(self):
+        w = k3zkutil.ZKRWLock("foo_name", write=True, zkclient=self.zk)
+        r = k3zkutil.ZKRWLock("foo_name", zkclient=self.zk)
+        w2 = k3zkutil.ZKRWLock("foo_name", write=True, zkclient=self.zk)
+
+        with w:
+            self.assertEqual((False, w.identifier, 0), r.try_acquire())
+            self.assertEqual((False, w.identifier, 0), w2.try_acquire())
+
+        with r:
+            self.assertEqual((False, r.identifier, 0), w2.try_acquire())
+            self.assertRaises(k3zkutil.LockTimeout, w2.acquire, timeout=0.2)
+
+            # waiting node is removed on timeout
+            self.assertEqual(1, len(self.zk.get_children(r.lock_path)))
+
+    def test_fifo(self):
+        order = []
+
+        def _lock(ident, write):
+            lock = k3zkutil.ZKRWLock("foo_name", write=write, zkclient=self.zk)
+            with lock:
+                order.append(ident)
+                time.sleep(0.2)
+
+        w = k3zkutil.ZKRWLock("foo_name", write=True, zkclient=self.zk)
+        w.acquire()
+
+        ths = []
+        for ident, write in (("r1", False), ("w1", True), ("r2", False)):
+            ths.append(k3thread.daemon(_lock, args=(ident, write)))
+            time.sleep(0.1)
+
+        w.release()
+        for th in ths:
+            th.join()
+
+        # r2 does not overtake the waiting writer w1
+        self.assertEqual(["r1", "w1", "r2"], order)
+
+    def test_writer_preference(self):
+        order = []
+
+        def _lock(ident, write):
+            lock = k3zkutil.ZKRWLock("foo_name", write=write, zkclient=self.zk, writer_preference=True)
+            with lock:
+                order.append(ident)
+                time.sleep(0.2)
+
+        w = k3zkutil.ZKRWLock("foo_name", write=True, zkclient=self.zk)
+        w.acquire()
+
+        ths = []
+        for ident, write in (("r1", False), ("w1", True)):
+            ths.append(k3thread.daemon(_lock, args=(ident, write)))
+            time.sleep(0.1)
+
+        w.release()
+        for th in ths:
+            th.join()
+
+        # waiting reader r1 gives way to w1
+        self.assertEqual(["w1", "r1"], order)
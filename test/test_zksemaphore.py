@@ -0,0 +1,106 @@
+import time
+import unittest
+
+import k3thread
+import k3ut
+import k3utdocker
+import k3zkutil
+from k3confloader import conf
+from k3zkutil.test.helper import wait_for_zk
+
+dd = k3ut.dd
+
+zk_test_name = "zk_test"
+zk_test_tag = "zookeeper:3.9"
+
+zk_test_auth = ("digest", "xp", "123")
+zk_test_acl = (("xp", "123", "cdrw"),)
+
+
+class TestZKSemaphore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        k3utdocker.pull_image(zk_test_tag)
+
+    def setUp(self):
+        conf.zk_acl = zk_test_acl
+        conf.zk_auth = zk_test_auth
+
+        k3utdocker.create_network()
+        k3utdocker.start_container(
+            zk_test_name,
+            zk_test_tag,
+            port_bindings={
+                2181: 21811,
+            },
+        )
+
+        self.zk = wait_for_zk("127.0.0.1:21811")
+        scheme, name, passw = zk_test_auth
+        self.zk.add_auth(scheme, name + ":" + passw)
+
+        acl = k3zkutil.make_kazoo_digest_acl(zk_test_acl)
+        self.zk.create("lock/", acl=acl)
+
+    def tearDown(self):
+        self.zk.stop()
+        k3utdocker.remove_container(zk_test_name)
+
+    def test_max_leases(self):
+        sems = [k3zkutil.ZKSemaphore("foo_name", 2, zkclient=self.zk) for _ in range(3)]
+
+        self.assertTrue(sems[0].try_acquire()[0])
+        self.assertTrue(sems[1].try_acquire()[0])
+
+        locked, holders = sems[2].try_acquire()
+        self.assertFalse(locked)
+        self.assertEqual([sems[0].identifier, sems[1].identifier], holders)
+        self.assertEqual(holders, sems[0].get_holders())
+
+        self.assertRaises(k3zkutil.LockTimeout, sems[2].acquire, timeout=0.2)
+        # waiting node is removed on timeout
+        self.assertEqual(2, len(self.zk.get_children(sems[0].lock_path)))
+
+        sems[0].release()
+        self.assertTrue(sems[2].try_acquire()[0])
+
+        sems[1].release()
+        sems[2].release()
+
+    def test_wait(self):
+        holder = k3zkutil.ZKSemaphore("foo_name", 1, zkclient=self.zk)
+        holder.acquire()
+
+        sem = k3zkutil.ZKSemaphore("foo_name", 1, zkclient=self.zk)
+        it = sem.acquire_loop(timeout=2)
+        self.assertEqual(1, next(it))
+
+        holder.release()
+        self.assertRaises(StopIteration, next, it)
+        self.assertTrue(sem.is_locked())
+        sem.release()
+
+    def test_concurrent(self):
+        sess = {"curr": 0, "max": 0, "total": 0}
+
+        def _run():
+            zk = wait_for_zk("127.0.0.1:21811")
+            scheme, name, passw = zk_test_auth
+            zk.add_auth(scheme, name + ":" + passw)
+
+            for _ in range(10):
+                with k3zkutil.ZKSemaphore("foo_name", 3, zkclient=zk, timeout=30):
+                    sess["curr"] += 1
+                    sess["max"] = max(sess["max"], sess["curr"])
+                    time.sleep(0.01)
+                    sess["curr"] -= 1
+                    sess["total"] += 1
+
+            zk.stop()
+
+        ths = [k3thread.daemon(_run) for _ in range(8)]
+        for th in ths:
+            th.join()
+
+        self.assertEqual(80, sess["total"])
+        self.assertEqual(3, sess["max"])
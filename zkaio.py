@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+asyncio counterparts of `ZKLock`, `cas_loop`, `get_next` and `wait_absent`.
+
+Requests are sent with kazoo `*_async` API and the results and watch events
+are delivered to the event loop with `loop.call_soon_threadsafe()`, thus a
+waiter does not occupy a thread.
+"""
+
+import asyncio
+import copy
+import logging
+import time
+
+import k3utfjson
+from k3txutil.txutil import CASRecord
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import EventType
+
+from . import zkutil
+from .exceptions import ZKWaitTimeout
+from .zkconf import KazooClientExt
+from .zkconf import kazoo_client_ext
+from .zklock import ZKLock
+
+logger = logging.getLogger(__name__)
+
+
+def as_future(async_result):
+    """
+    Convert a kazoo `IAsyncResult` to an `asyncio.Future` of the running loop.
+    :param async_result: returned by kazoo `*_async` methods.
+    :return: an `asyncio.Future` to `await`.
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def _set(rst):
+        if fut.cancelled():
+            return
+
+        if rst.successful():
+            fut.set_result(rst.value)
+        else:
+            fut.set_exception(rst.exception)
+
+    # called in kazoo callback thread
+    async_result.rawlink(lambda rst: loop.call_soon_threadsafe(_set, rst))
+
+    return fut
+
+
+class _LoopEvent(object):
+    # A `threading.Event` alike flag that can be set in any thread and be
+    # waited for in an event loop.
+
+    def __init__(self):
+        self.flag = False
+        self.loop = None
+        self.ev = None
+
+    def set(self):
+        self.flag = True
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wake)
+
+    def clear(self):
+        self.flag = False
+        if self.ev is not None:
+            self.ev.clear()
+
+    def is_set(self):
+        return self.flag
+
+    async def wait(self, timeout):
+        if self.ev is None:
+            self.loop = asyncio.get_running_loop()
+            self.ev = asyncio.Event()
+
+        if self.flag:
+            return True
+
+        if timeout <= 0:
+            return False
+
+        try:
+            await asyncio.wait_for(self.ev.wait(), timeout)
+        except asyncio.TimeoutError:
+            return self.flag
+
+        return True
+
+    def _wake(self):
+        if self.flag:
+            self.ev.set()
+
+
+class AsyncZKLock(ZKLock):
+    """
+    AsyncZKLock is the asyncio version of `ZKLock`:
+
+        async with AsyncZKLock("foo", zkclient=zk):
+            ...
+
+    `acquire_loop` is an async generator, `acquire`, `try_acquire` and `release`
+    are coroutines. Arguments are the same as `ZKLock` except that `queued`,
+    `local_first`, `lease` and `priority` are not supported.
+    `on_lost` is still called in kazoo event thread.
+    """
+
+    def __init__(self, lock_name, **kwargs):
+        for k in ("queued", "local_first", "lease", "priority"):
+            v = kwargs.get(k)
+            if v is not None and v is not False:
+                raise ValueError("{k} is not supported by AsyncZKLock".format(k=k))
+
+        super(AsyncZKLock, self).__init__(lock_name, **kwargs)
+
+        self.maybe_available = _LoopEvent()
+        self.maybe_available.set()
+
+        # Whether the lock node changed since "get" was sent. The mutex is not
+        # held from the "get" reply to updating `lock_holder`, an event in this
+        # window is not taken as a lost lock by `on_node_change`.
+        self._node_changed = False
+
+    def on_node_change(self, watchevent):
+        if watchevent.type != EventType.NONE:
+            with self.mutex:
+                self._node_changed = True
+
+        super(AsyncZKLock, self).on_node_change(watchevent)
+
+    async def acquire_loop(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        start = time.time()
+        expire_at = start + timeout
+        relock = self.is_locked()
+        rounds = 0
+
+        while True:
+            rounds += 1
+
+            if not await self.maybe_available.wait(expire_at - time.time()):
+                logger.debug("lock is still held by others: " + str(self))
+
+                if time.time() > expire_at:
+                    self._record("on_timeout", time.time() - start, rounds - 1)
+                    raise LockTimeout("lock: " + str(self.lock_path))
+
+            await self._create_and_get_async()
+            if self.is_locked():
+                if not relock:
+                    self._acquired_at = time.time()
+                    self._record("on_acquired", self._acquired_at - start, rounds - 1)
+                return
+
+            if self.maybe_available.is_set():
+                continue
+            else:
+                yield self.lock_holder[0], self.lock_holder[1]
+
+    async def acquire(self, timeout=None):
+        async for _ in self.acquire_loop(timeout=timeout):
+            continue
+
+    async def try_acquire(self):
+        """
+        Same as `ZKLock.try_acquire`.
+        """
+        try:
+            await self.acquire(timeout=-1)
+        except LockTimeout:
+            pass
+
+        return self.is_locked(), self.lock_holder[0], self.lock_holder[1]
+
+    async def release(self):
+        """
+        Same as `ZKLock.release`.
+        """
+        if self.is_locked():
+            self._remove_listener()
+
+            # Reset holder first, the mutex can not be held across `await`
+            # to prevent the node deletion from being treated as lock lost.
+            with self.mutex:
+                self.lock_holder = None
+                self._record_released()
+
+            try:
+                await as_future(self.zkclient.delete_async(self.lock_path))
+            except NoNodeError as e:
+                logger.info(repr(e) + " while delete lock: " + str(self))
+
+            logger.info("RELEASED: {s}".format(s=str(self)))
+        else:
+            logger.info("not acquired, do not need to release")
+
+        self.close()
+
+    async def _create_and_get_async(self):
+        # Send "create" and "get" back to back before awaiting either, the
+        # same as `ZKLock`, it takes one round trip.
+        logger.debug("to create and get: {s}".format(s=str(self)))
+
+        # The mutex can not be held across `await`. Clear the flag before
+        # sending the request, thus the watch event always sets it after.
+        with self.mutex:
+            self.maybe_available.clear()
+            self._node_changed = False
+
+        create_rst = self.zkclient.create_async(
+            self.lock_path,
+            k3utfjson.dump(self.identifier).encode("utf-8"),
+            ephemeral=self.ephemeral,
+            acl=self.zkconf.kazoo_digest_acl(),
+            makepath=bool(self.zkconf.lock_shards()),
+        )
+        get_rst = self.zkclient.get_async(self.lock_path, watch=self.on_node_change)
+
+        try:
+            await as_future(create_rst)
+            logger.info("CREATE OK: {s}".format(s=str(self)))
+        except NodeExistsError as e:
+            logger.debug(repr(e) + " while create lock: {s}".format(s=str(self)))
+            self.lock_holder = None
+
+        try:
+            holder, zstat = await as_future(get_rst)
+        except NoNodeError as e:
+            logger.info(repr(e) + " while get lock: {s}".format(s=str(self)))
+            with self.mutex:
+                self.lock_holder = None
+                self.maybe_available.set()
+            return
+
+        with self.mutex:
+            self.lock_holder = (k3utfjson.load(holder), zstat.version)
+            if self.is_locked():
+                if self._node_changed:
+                    # Deleted or updated after "get" replied, try again.
+                    logger.info("lock node changed while acquiring: {s}".format(s=str(self)))
+                    self.lock_holder = None
+                    self.maybe_available.set()
+                else:
+                    self._lost = False
+
+        if self.is_locked():
+            logger.info("ACQUIRED: {s}".format(s=str(self)))
+        else:
+            logger.debug("other holds: {s}".format(s=str(self)))
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, tp, value, tb):
+        await self.release()
+
+
+async def async_cas_loop(zkclient, path, json=True):
+    """
+    The asyncio version of `cas_loop`:
+
+        async for curr in async_cas_loop(zk, "foo"):
+            curr.v += 1
+
+    :param zkclient: a started `KazooClient` or `KazooClientExt`. Hosts, a
+    `ZKConf` or a `dict` are not accepted: connecting a new client blocks the
+    event loop.
+    :return: an async generator yields `CASRecord`.
+    """
+    if not isinstance(zkclient, (KazooClient, KazooClientExt)):
+        raise TypeError("async_cas_loop requires a KazooClient, but: {t}".format(t=type(zkclient)))
+
+    zkclient, owning_zk = kazoo_client_ext(zkclient, json=json)
+
+    try:
+        i = -1
+        while True:
+            i += 1
+
+            val, zstat = await as_future(zkclient._zk.get_async(path))
+            val = zkclient._jl(val)
+            rec = CASRecord(copy.deepcopy(val), zstat, i)
+
+            yield rec
+
+            if rec.v == val:
+                # nothing to update
+                return
+
+            value = zkclient._encode(zkclient._jd(rec.v))
+            try:
+                await as_future(zkclient._zk.set_async(path, value, version=rec.stat.version))
+                return
+            except BadVersionError as e:
+                logger.info(repr(e) + " while cas set")
+                continue
+    finally:
+        if owning_zk:
+            zkutil.close_zk(zkclient)
+
+
+async def _conditioned_get_loop_async(zkclient, path, conditioned_get, timeout=None, **kwargs):
+    if timeout is None:
+        timeout = 86400 * 365
+
+    expire_at = time.time() + timeout
+    maybe_available = _LoopEvent()
+
+    def on_connection_change(state):
+        # notify it to re-get, then raise Connection related error
+        logger.info("connection state change: {0}".format(state))
+        maybe_available.set()
+
+    zkclient.add_listener(on_connection_change)
+
+    try:
+        while True:
+            maybe_available.clear()
+            rst = await conditioned_get(zkclient, path, lambda watchevent: maybe_available.set(), **kwargs)
+
+            if rst is not zkutil.NeedWait:
+                return rst
+
+            if await maybe_available.wait(expire_at - time.time()):
+                continue
+
+            raise ZKWaitTimeout(
+                "timeout({timeout} sec) waiting for {path} to satisfy: {cond}".format(
+                    timeout=timeout, path=path, cond=str(kwargs)
+                )
+            )
+    finally:
+        try:
+            zkclient.remove_listener(on_connection_change)
+        except Exception as e:
+            logger.info(repr(e) + " while removing on_connection_change")
+
+
+async def _get_async(zkclient, path, watch):
+    val, zstat = await as_future(zkclient.get_async(path, watch=watch))
+    if isinstance(zkclient, KazooClientExt):
+        val = zkclient._jl(val)
+
+    return val, zstat
+
+
+async def _get_next(zkclient, path, watch, version=-1):
+    val, zstat = await _get_async(zkclient, path, watch)
+    if zstat.version > version:
+        return val, zstat
+
+    return zkutil.NeedWait
+
+
+async def _wait_absent(zkclient, path, watch):
+    try:
+        await _get_async(zkclient, path, watch)
+    except NoNodeError as e:
+        logger.info(repr(e) + " found, return")
+        return None
+
+    return zkutil.NeedWait
+
+
+async def async_get_next(zkclient, path, timeout=None, version=-1):
+    """
+    The asyncio version of `get_next`.
+    """
+    return await _conditioned_get_loop_async(zkclient, path, _get_next, timeout=timeout, version=version)
+
+
+async def async_wait_absent(zkclient, path, timeout=None):
+    """
+    The asyncio version of `wait_absent`.
+    """
+    return await _conditioned_get_loop_async(zkclient, path, _wait_absent, timeout=timeout)
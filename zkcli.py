@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Command line tools of k3zkutil:
+
+    python -m k3zkutil locks --hosts 127.0.0.1:2181 --node-id web-3
+    python -m k3zkutil locks --oldest 50
+    python -m k3zkutil locks --summary
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from kazoo.client import KazooClient
+
+from .zkconf import ZKConf
+from .zklockscan import LockIndex
+from .zklockscan import scan_locks
+
+
+def cmd_locks(args, out):
+    zkconf = ZKConf(hosts=args.hosts, lock_dir=args.lock_dir, lock_shards=args.lock_shards, auth=args.auth)
+
+    zk = KazooClient(hosts=zkconf.hosts())
+    zk.start()
+    try:
+        if zkconf.auth() is not None:
+            zk.add_auth(*zkconf.kazoo_auth())
+
+        t0 = time.time()
+        idx = LockIndex(scan_locks(zk, zkconf, args.concurrency))
+        spent = time.time() - t0
+    finally:
+        zk.stop()
+
+    now = time.time()
+
+    if args.summary:
+        out.write(json.dumps(idx.summary(now), sort_keys=True, indent=2) + "\n")
+        return
+
+    if any([x is not None for x in (args.node_id, args.ip, args.pid, args.txid)]):
+        locks = idx.find(node_id=args.node_id, ip=args.ip, process_id=args.pid, txid=args.txid)
+        locks = sorted(locks, key=lambda lck: lck["ctime"])
+    else:
+        locks = idx.oldest()
+
+    if args.oldest is not None:
+        locks = locks[: args.oldest]
+
+    for lck in locks:
+        if args.json:
+            out.write(json.dumps(_json_lock(lck, now), sort_keys=True) + "\n")
+        else:
+            out.write(
+                "{age:>10.1f} {e} {p} {h} {v}\n".format(
+                    age=now - lck["ctime"],
+                    e="E" if lck["ephemeral"] else "P",
+                    p=lck["path"],
+                    h=lck["holder"]["id"],
+                    v=json.dumps(lck["holder"].get("val")),
+                )
+            )
+
+    sys.stderr.write("{n} of {t} locks, scanned in {s:.3f} sec\n".format(n=len(locks), t=len(idx.locks), s=spent))
+
+
+def _json_lock(lck, now):
+    rst = dict(lck)
+    rst["age"] = round(now - lck["ctime"], 3)
+    return rst
+
+
+def _auth(s):
+    # "digest:user:password"
+    parts = s.split(":", 2)
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError("auth must be <scheme>:<user>:<password>")
+    return tuple(parts)
+
+
+def main(argv=None, out=None):
+    if out is None:
+        out = sys.stdout
+
+    parser = argparse.ArgumentParser(prog="python -m k3zkutil", description="k3zkutil tools")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.required = True
+
+    p = sub.add_parser("locks", help="list lock holders, by holder or by age")
+    p.add_argument("--hosts", help="zookeeper hosts, by default config.zk_hosts")
+    p.add_argument("--auth", type=_auth, help="<scheme>:<user>:<password>, by default config.zk_auth")
+    p.add_argument("--lock-dir", help="by default config.zk_lock_dir")
+    p.add_argument("--lock-shards", type=int, help="by default config.zk_lock_shards")
+    p.add_argument("--concurrency", type=int, default=1024, help="max number of requests on the wire")
+    p.add_argument("--node-id", help="locks held by this node_id")
+    p.add_argument("--ip", help="locks held by this ip")
+    p.add_argument("--pid", type=int, help="locks held by this process id")
+    p.add_argument("--txid", help="locks held by this transaction")
+    p.add_argument("--oldest", type=int, metavar="N", help="the N oldest locks")
+    p.add_argument("--summary", action="store_true", help="number of locks and max age by node_id")
+    p.add_argument("--json", action="store_true", help="print every lock as one line of json")
+    p.set_defaults(func=cmd_locks)
+
+    args = parser.parse_args(argv)
+    args.func(args, out)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import zlib
+
 from kazoo.client import KazooClient
 
 from k3confloader import conf
@@ -8,6 +10,9 @@ import k3utfjson
 
 from . import zkutil
 
+# children of `lock_dir` that are not lock nodes
+reserved_lock_names = ("__queue__", "__shard__")
+
 
 class ZKConf(object):
     """
@@ -28,6 +33,9 @@ class ZKConf(object):
     zk dir:
         <prefix>/record/<key>
         <prefix>/lock/<key>
+        <prefix>/lock/__queue__/<key>/<guid>-0000000001
+        <prefix>/lock/__shard__/<shard>/<key>                       # with lock_shards
+        <prefix>/lock/__queue__/<shard>/<key>/<guid>-0000000001     # with lock_shards
         <prefix>/tx/
                     alive/0000000001
                     journal/0000000001
@@ -41,11 +49,26 @@ class ZKConf(object):
 
     journal:    Contains journal transaction modifications. Each of them is a complete transaction.
 
+    lock/__queue__: Contains `ephemeral` `sequence` waiter nodes of queued `ZKLock`.
+
+    lock/__shard__: With `lock_shards=n`, lock names are spread over `n`
+                subdirectories by crc32 of the name, thus none of the
+                directories has too many children.
+
     journal_id_set: Committed and Purged journal id.
     """
 
     def __init__(
-        self, hosts=None, tx_dir=None, seq_dir=None, record_dir=None, lock_dir=None, node_id=None, auth=None, acl=None
+        self,
+        hosts=None,
+        tx_dir=None,
+        seq_dir=None,
+        record_dir=None,
+        lock_dir=None,
+        node_id=None,
+        auth=None,
+        acl=None,
+        lock_shards=None,
     ):
         self.conf = {
             "hosts": hosts,
@@ -56,6 +79,7 @@ class ZKConf(object):
             "node_id": node_id,
             "auth": auth,
             "acl": acl,
+            "lock_shards": lock_shards,
         }
 
     def hosts(self):
@@ -76,8 +100,41 @@ class ZKConf(object):
     def acl(self):
         return self._get_config("acl")
 
+    def lock_shards(self):
+        return self._get_config("lock_shards")
+
     def lock(self, key=""):
-        return "".join([self.lock_dir(), _dump_txid(key)])
+        _check_lock_name(key)
+
+        shard = self._lock_shard(key)
+        if shard != "":
+            shard = "__shard__/" + shard
+
+        return "".join([self.lock_dir(), shard, _dump_txid(key)])
+
+    def lock_queue(self, key=""):
+        _check_lock_name(key)
+        return "".join([self.lock_dir(), "__queue__/", self._lock_shard(key), _dump_txid(key)])
+
+    def lock_shard_dirs(self):
+        """
+        :return: a list of the directories containing lock nodes: all of the
+        shards, or only `lock_dir()` if lock names are not sharded.
+        """
+        n = self.lock_shards()
+        if not n:
+            return [self.lock_dir()]
+
+        return ["".join([self.lock_dir(), "__shard__/", _shard_name(i, n), "/"]) for i in range(n)]
+
+    def _lock_shard(self, key):
+        n = self.lock_shards()
+        key = _dump_txid(key)
+        if not n or key == "":
+            return ""
+
+        i = zlib.crc32(key.encode("utf-8")) % n
+        return _shard_name(i, n) + "/"
 
     def record(self, key=""):
         return "".join([self.record_dir(), key])
@@ -176,6 +233,11 @@ class KazooClientExt(KazooClient):
         return self._zk.create(path, value=value, acl=acl, ephemeral=ephemeral, sequence=sequence, makepath=makepath)
 
 
+def _check_lock_name(key):
+    if _dump_txid(key).split("/", 1)[0] in reserved_lock_names:
+        raise ValueError("reserved lock name: {k}".format(k=key))
+
+
 def _dump_txid(txid):
     if isinstance(txid, str):
         return txid
@@ -185,6 +247,10 @@ def _dump_txid(txid):
         raise TypeError("invalid type txid: " + repr(txid))
 
 
+def _shard_name(i, n):
+    return "%0*d" % (len(str(n - 1)), i)
+
+
 def _dump_journal_id(journal_id):
     if isinstance(journal_id, int):
         return "journal_id%010d" % journal_id
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import heapq
 import logging
+import os
 import threading
 import time
+import uuid
+import weakref
 
 import k3utfjson
 
 from kazoo.client import KazooClient
+from kazoo.exceptions import BadVersionError
 from kazoo.exceptions import LockTimeout
 from kazoo.exceptions import NodeExistsError
 from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NotEmptyError
+from kazoo.exceptions import RolledBackError
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
 from .exceptions import ZKUtilError
 
 from . import zkutil
@@ -28,84 +37,355 @@ class ZKTXConnectionLost(ZKTXError):
     pass
 
 
-# TODO add method: ZKLock.get_owner() to get current lock owner
 class ZKLock(object):
     """
     ZKLock implements a zookeeper based distributed lock.
+
+    With `queued=True`, waiters line up as `ephemeral` `sequence` nodes in
+    `ZKConf.lock_queue(lock_name)` and each one only watches its predecessor.
+    Only the head of the queue competes for the lock node, thus a release wakes
+    up exactly one waiter and the lock is granted in FIFO order.
+    Queued and non-queued locks on the same `lock_name` still exclude each
+    other, but non-queued ones do not wait in line.
+
+    A queued waiter with `priority` is granted before the ones with lower
+    priority. To prevent starvation, one priority level is worth `aging`
+    seconds of waiting: waiters are ordered by enqueue time minus
+    `priority * aging`, thus the clocks of them should be synchronized. A
+    waiter without `priority` counts as priority 0, thus it is passed only by
+    waiters that come within `priority * aging` seconds after it. Waiters
+    without `priority` are always in FIFO order among themselves, even if the
+    clocks are skewed. Specifying `priority` makes a lock queued.
+
+    A lock created with `manager`, a `ZKLockManager`, uses the client of the
+    manager and receives connection events from it, instead of registering
+    its own connection listener.
+
+    With `local_first=True`, contenders in one process first compete for an
+    in-memory lock on the same hosts and `ZKConf.lock(lock_name)`, and only the
+    local winner talks to zookeeper. They share one identifier unless
+    `identifier` is specified.
+    With `local_handoff=True` in addition, releasing a lock while other local
+    contenders are waiting keeps the zk node and hands it over to the next
+    local winner, instead of deleting and creating it again.
+
+    `stats` is a `ZKLockStats` or any object with the same `on_*` hooks. It
+    receives wait time, retries, timeouts, hold time and lost events.
+
+    While a queued lock is waiting, `ahead` is the number of contenders before
+    it, the holder included, and `waiters` is the length of the queue.
+    `estimated_wait()` multiplies `ahead` by the mean hold time observed by
+    `stats`, so that a caller can give up early on a lock it will not get in
+    time:
+
+        for holder, ver in lck.acquire_loop(timeout=5):
+            w = lck.estimated_wait()
+            if w is not None and w > deadline - time.time():
+                break
+
+    With `lease=<seconds>`, the lock node is not `ephemeral` and records an
+    expiry timestamp `"expire"` besides `id` and `val`. It survives session
+    expiry and is renewed by a background thread shared by all leases in the
+    process, with one transaction per zk client every `lease / 3` seconds.
+    A contender deletes a lock node whose lease has expired. Clocks of the
+    holders and contenders should be synchronized. A held lease does not watch
+    its own node, a lease taken by others is found out by the next renewal,
+    within `lease / 3` seconds.
+
+    A held lock is not lost when the connection is `SUSPENDED`: it is pending
+    until the connection comes back, then the ownership is verified with one
+    `get`. `on_lost` is called on `LOST`, if the lock node is no longer ours,
+    or if it is still pending after `suspended_grace` seconds. By default the
+    grace period is unlimited and only `LOST` ends it.
+
+    `get_owner()` returns the current holder from an in-memory cache kept
+    warm by watches, see `get_lock_owner`.
     """
 
     def __init__(
-        self, lock_name, zkconf=None, zkclient=None, on_lost=None, identifier=None, ephemeral=True, timeout=10
+        self,
+        lock_name,
+        zkconf=None,
+        zkclient=None,
+        on_lost=None,
+        identifier=None,
+        ephemeral=True,
+        timeout=10,
+        queued=False,
+        manager=None,
+        local_first=False,
+        local_handoff=False,
+        stats=None,
+        lease=None,
+        suspended_grace=None,
+        priority=None,
+        aging=10,
     ):
-        if zkconf is None:
-            zkconf = ZKConf()
-        if isinstance(zkconf, dict):
-            zkconf = ZKConf(**zkconf)
-        self.zkconf = zkconf
-
-        if zkclient is None:
-            # If user does not pass a zkclient instance,
-            # we need to create one for lock to use.
-            # This zkclient will be closed after lock is released
-
-            if on_lost is None:
-                raise ValueError("on_lost must be specified to watch zk connection issue if no zkclient specified")
-
-            zkclient = make_owning_zkclient(zkconf.hosts(), zkconf.auth())
-            self.owning_client = True
-        else:
-            self.owning_client = False
-
-        if identifier is None:
-            identifier = zkutil.lock_id(zkconf.node_id())
-
-        if not isinstance(identifier, dict):
-            identifier = make_identifier(identifier, None)
-
-        assert sorted(["id", "val"]) == sorted(list(identifier.keys()))
+        if lease is not None:
+            if lease <= 0:
+                raise ValueError("lease must be positive, but: {l}".format(l=lease))
+            if local_first:
+                raise ValueError("lease is not supported with local_first")
+            ephemeral = False
+
+        if manager is not None:
+            zkclient = manager.zkclient
+            if zkconf is None:
+                zkconf = manager.zkconf
+
+        (
+            self.zkconf,
+            self.zkclient,
+            self.owning_client,
+            _identifier,
+        ) = prepare_lock_env(zkconf, zkclient, on_lost, identifier)
+
+        if local_first and identifier is None:
+            # local contenders are the same holder from zookeeper's view
+            _identifier = make_identifier(_local_lock_id(self.zkconf.node_id()), None)
+        identifier = _identifier
 
         # a copy of hosts for debugging and tracking
-        self._hosts = ",".join(["{0}:{1}".format(*x) for x in zkclient.hosts])
-
-        self.zkclient = zkclient
-        if isinstance(self.zkclient, KazooClientExt):
-            self.zkclient = self.zkclient._zk
+        self._hosts = ",".join(["{0}:{1}".format(*x) for x in self.zkclient.hosts])
 
         self.on_lost = on_lost
 
         self.lock_name = lock_name
-        self.lock_path = zkconf.lock(self.lock_name)
+        self.lock_path = self.zkconf.lock(self.lock_name)
         self.identifier = identifier
         self.ephemeral = ephemeral
         self.timeout = timeout
 
+        self.lease = lease
+        self._lease_expire = None
+
+        # whether on_lost is called for the current holding
+        self._lost = False
+
+        self.suspended_grace = suspended_grace
+        self._suspended = False
+
+        if priority is not None:
+            queued = True
+        if aging <= 0:
+            raise ValueError("aging must be positive, but: {a}".format(a=aging))
+
+        self.queued = queued
+        self.priority = priority
+        self.aging = aging
+        self.queue_path = self.zkconf.lock_queue(self.lock_name)
+        self.queue_node = None
+        self._queue_guid = uuid.uuid4().hex
+        # number of contenders before this one, and length of the queue
+        self.ahead = None
+        self.waiters = None
+
+        self.local_first = local_first
+        self.local_handoff = local_handoff
+        self.local = None
+        self._local_key = (self._hosts, self.lock_path)
+
         self.mutex = threading.RLock()
         self.maybe_available = threading.Event()
         self.maybe_available.set()
         self.lock_holder = None
 
-        logger.info("adding event listener: {s}".format(s=self))
-        self.zkclient.add_listener(self.on_connection_change)
+        self.stats = stats
+        # number of rounds in the current acquire_loop
+        self._rounds = 0
+        self._acquired_at = None
+
+        self._holder_cache_gen = None
+
+        self.manager = manager
+        if self.manager is None:
+            logger.info("adding event listener: {s}".format(s=self))
+            self.zkclient.add_listener(self.on_connection_change)
+        else:
+            self.manager.add(self)
 
     def on_node_change(self, watchevent):
+        _invalidate_holder(self.zkclient, watchevent.path)
+
         # Must be locked first.
         # Or there is a chance on_node_change is triggered before
         #         self.maybe_available.clear()
         with self.mutex:
+            if watchevent.type == EventType.NONE:
+                # Session events are delivered to all watches, e.g. on expiry.
+                # The connection listener handles them: a non-ephemeral lock
+                # or a lease is verified once reconnected.
+                self.maybe_available.set()
+                return
+
+            if self.lease is not None and self.is_locked():
+                if watchevent.type != EventType.CHANGED:
+                    self._lease_lost()
+                # Renewed or updated by ourselves. It is not watched again:
+                # the next renewal finds out a lost lease by BadVersion or
+                # NoNode, without one request per lock per renewal.
+                return
+
+            if self.is_locked() and watchevent.type == EventType.CHANGED:
+                # Might be updated by `set_lock_val`. Lost only if it is no
+                # longer ours.
+                self._verify_own_change()
+                return
+
             self.maybe_available.set()
 
             # If locked. the node change is treated as losing a lock
-            if self.is_locked():
+            if self._mark_lost():
                 if self.on_lost is not None:
                     self.on_lost()
 
         logger.info("node state changed:{ev}, lock might be released: {s}".format(ev=watchevent, s=str(self)))
 
+    def on_queue_change(self, watchevent):
+        # The predecessor in waiter queue changed, it is our turn to re-check.
+        # Unlike on_node_change, it never means the lock is lost.
+        with self.mutex:
+            self.maybe_available.set()
+
+        logger.info("queue node changed:{ev}, might be my turn: {s}".format(ev=watchevent, s=str(self)))
+
     def on_connection_change(self, state):
         # notify zklock to re-do acquiring procedure, to trigger Connection Error
         with self.mutex:
             self.maybe_available.set()
 
+            if self.lease is not None:
+                # A lease does not depend on session. It is lost only if
+                # renewal fails.
+                return
+
+            # A non-ephemeral node survives session expiry, it is verified
+            # after reconnecting, the same as SUSPENDED.
+            if state == KazooState.SUSPENDED or (state == KazooState.LOST and not self.ephemeral):
+                if self.is_locked():
+                    self._suspend()
+                return
+
+            suspended = self._resume()
+
+            if state == KazooState.CONNECTED:
+                if suspended and self.is_locked():
+                    self._verify_owner()
+                return
+
+            if not self._mark_lost():
+                # not held, or reported already
+                return
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def _mark_lost(self):
+        # Must be called with mutex held.
+        # Return True if the lock is held and the loss is not reported yet.
+        if not self.is_locked() or self._lost:
+            return False
+
+        self._lost = True
+        self._record("on_lost")
+        return True
+
+    def _suspend(self):
+        if self._suspended:
+            return
+
+        logger.info("connection suspended, lock pending: {s}".format(s=str(self)))
+        self._suspended = True
+
+        if self.suspended_grace is not None:
+            _get_suspended_grace(self.zkclient).add(self, self.suspended_grace)
+
+    def _resume(self):
+        # Return True if the lock was pending.
+        suspended, self._suspended = self._suspended, False
+
+        if suspended and self.suspended_grace is not None:
+            _get_suspended_grace(self.zkclient).remove(self)
+
+        return suspended
+
+    def _on_grace_timeout(self):
+        with self.mutex:
+            if not self._suspended:
+                return
+
+            self._resume()
+            if not self._mark_lost():
+                return
+
+        logger.info("still suspended after {g} seconds, lock lost: {s}".format(g=self.suspended_grace, s=str(self)))
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def _verify_own_change(self):
+        # Watch it again with an "exists". The version tells if it is our own
+        # update, only an unknown version costs a "get".
+        rst = self.zkclient.exists_async(self.lock_path, watch=self.on_node_change)
+        rst.rawlink(self._on_own_change)
+
+    def _on_own_change(self, rst):
+        try:
+            zstat = rst.get()
+        except Exception as e:
+            logger.info(repr(e) + " while verify lock: {s}".format(s=str(self)))
+            return
+
+        with self.mutex:
+            if not self.is_locked():
+                return
+
+            if zstat is not None and zstat.version <= self.lock_holder[1]:
+                return
+
+        self._verify_owner()
+
+    def _verify_owner(self):
+        # Called in kazoo threads, must not block.
+        logger.info("verify lock: {s}".format(s=str(self)))
+
+        rst = self.zkclient.get_async(self.lock_path, watch=self.on_node_change)
+        rst.rawlink(self._on_owner_verified)
+
+    def _on_owner_verified(self, rst):
+        try:
+            holder, zstat = rst.get()
+        except NoNodeError:
+            holder = None
+        except Exception as e:
+            # connection is lost again, the next state change handles it
+            logger.info(repr(e) + " while verify lock: {s}".format(s=str(self)))
+            return
+
+        if holder is not None:
+            try:
+                holder = k3utfjson.load(holder)
+                ours = self.cmp_identifier(holder, self.identifier)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.info(repr(e) + " while verify lock: {s}".format(s=str(self)))
+                ours = False
+
+        with self.mutex:
+            if not self.is_locked():
+                # released meanwhile
+                return
+
+            if holder is not None and ours:
+                if zstat.version >= self.lock_holder[1]:
+                    self.lock_holder = (holder, zstat.version)
+                logger.info("VERIFIED: {s}".format(s=str(self)))
+                return
+
+            if not self._mark_lost():
+                return
+
+        logger.info("lock lost, now held by {h}: {s}".format(h=holder, s=str(self)))
+
         if self.on_lost is not None:
             self.on_lost()
 
@@ -113,42 +393,137 @@ class ZKLock(object):
         if timeout is None:
             timeout = self.timeout
 
-        expire_at = time.time() + timeout
-
-        while True:
-            # Even if timeout is smaller than 0, try-loop continue on until
-            # maybe_available is not ready.
-            #
-            # There is a chance that:
-            #  - Failed to create lock node(lock is occupied by other)
-            #  - Failed to get lock node(just deleted)
-            #  - Failed to create lock node(lock is occupied by other)
-            #  - Failed to get lock node(just deleted)
-            #  - ...
-            if not self.maybe_available.wait(timeout=expire_at - time.time()):
-                logger.debug("lock is still held by others: " + str(self))
-
-                if time.time() > expire_at:
-                    raise LockTimeout("lock: " + str(self.lock_path))
-
-            # Always proceed the "get" phase, in order to add a watch handler.
-            # To watch node change event.
-
-            self._create()
-            self._acquire_by_get()
-            if self.is_locked():
-                return
+        start = time.time()
+        expire_at = start + timeout
+        self._rounds = 0
+        relock = self.is_locked()
+        self.ahead = None
 
-            # If it is possible to acquire the lock in next retry, do not yield
-            if self.maybe_available.is_set():
-                continue
+        try:
+            if not self.local_first:
+                yield from self._acquire_loop(expire_at)
             else:
-                yield self.lock_holder[0], self.lock_holder[1]
+                yield from self._acquire_loop_local(expire_at)
+        except LockTimeout:
+            self._record("on_timeout", time.time() - start, max(self._rounds - 1, 0))
+            raise
+
+        if self.is_locked():
+            self.ahead = 0
+
+        if self.is_locked() and not relock:
+            self._acquired_at = time.time()
+            self._record("on_acquired", self._acquired_at - start, max(self._rounds - 1, 0))
+
+        if self.is_locked() and self.lease is not None:
+            _lease_renewer.add(self)
+
+    def _acquire_loop_local(self, expire_at):
+        self._acquire_local(expire_at)
+        try:
+            if not self._adopt_kept():
+                yield from self._acquire_loop(expire_at)
+        finally:
+            if not self.is_locked():
+                self._release_local()
+
+    def _acquire_loop(self, expire_at):
+        # only the one competing for the lock node waits for a lease to expire
+        competing = True
+        try:
+            while True:
+                self._rounds += 1
+
+                # Even if timeout is smaller than 0, try-loop continue on until
+                # maybe_available is not ready.
+                #
+                # There is a chance that:
+                #  - Failed to create lock node(lock is occupied by other)
+                #  - Failed to get lock node(just deleted)
+                #  - Failed to create lock node(lock is occupied by other)
+                #  - Failed to get lock node(just deleted)
+                #  - ...
+                #
+                # Wake up when the lease of the holder expires.
+                wait_until = expire_at
+                lease_end = self._holder_lease_end() if competing else None
+                if lease_end is not None:
+                    wait_until = min(wait_until, lease_end)
+
+                if not self.maybe_available.wait(timeout=wait_until - time.time()):
+                    logger.debug("lock is still held by others: " + str(self))
+
+                    if time.time() > expire_at:
+                        raise LockTimeout("lock: " + str(self.lock_path))
+
+                if self.queued:
+                    self._enqueue()
+                    competing = self._is_queue_head()
+                    if not competing:
+                        if self.maybe_available.is_set():
+                            continue
+
+                        # Not our turn yet, report the current holder.
+                        self._get_holder()
+                        if self.is_locked():
+                            # held by another ZKLock with the same identifier
+                            self._dequeue()
+                            return
+
+                        if self.lock_holder is not None:
+                            yield self.lock_holder[0], self.lock_holder[1]
+                        continue
+
+                # Always proceed the "get" phase, in order to add a watch handler.
+                # To watch node change event.
+
+                self._create_and_get()
+                if self.is_locked():
+                    self._dequeue()
+                    return
+
+                if self._break_expired_lease():
+                    continue
+
+                # If it is possible to acquire the lock in next retry, do not yield
+                if self.maybe_available.is_set():
+                    continue
+                else:
+                    yield self.lock_holder[0], self.lock_holder[1]
+        finally:
+            # Leave the waiter queue on timeout, error or if caller stopped waiting.
+            if self.queue_node is not None and not self.is_locked():
+                try:
+                    self._dequeue()
+                except Exception as e:
+                    logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
 
     def acquire(self, timeout=None):
-        for holder, ver in self.acquire_loop(timeout=timeout):
+        for _ in self.acquire_loop(timeout=timeout):
             continue
 
+    def estimated_wait(self):
+        """
+        Estimate the seconds a queued waiter still waits: `ahead` times the
+        mean hold time returned by `stats.mean_hold(lock_name)`.
+        :return: `None` if not waiting in the queue or no hold time is observed.
+        """
+        ahead = self.ahead
+        mean_hold = getattr(self.stats, "mean_hold", None)
+        if ahead is None or mean_hold is None:
+            return None
+
+        try:
+            hold = mean_hold(self.lock_name)
+        except Exception as e:
+            logger.exception(repr(e) + " while get mean hold time: {s}".format(s=str(self)))
+            return None
+
+        if hold is None:
+            return None
+
+        return ahead * hold
+
     def try_acquire(self):
         """
         Try to acquire the lock and return result.
@@ -165,13 +540,21 @@ class ZKLock(object):
         # - the 1st element is `False`,
         # - the 2nd is identifier of the lock holder,
         # - the 3rd is a non-negative integer, which is the version of the zk node.
+        #
+        # A queued waiter not at the head of the queue may find the lock node
+        # absent, e.g., the head is between a release and its create. Then
+        # the holder is `None` and the version is `-1`.
         try:
             self.acquire(timeout=-1)
         except LockTimeout:
             pass
 
+        holder = self.lock_holder
+        if holder is None:
+            return False, None, -1
+
         # if_locked, lock holder identifier, holder version
-        return self.is_locked(), self.lock_holder[0], self.lock_holder[1]
+        return self.is_locked(), holder[0], holder[1]
 
     def try_release(self):
         """
@@ -203,7 +586,8 @@ class ZKLock(object):
             logger.debug("got lock holder: {s}".format(s=str(self)))
 
             if self.cmp_identifier(holder, self.identifier):
-                self.zkclient.remove_listener(self.on_connection_change)
+                self._remove_listener()
+                _lease_renewer.remove(self)
 
                 try:
                     self.zkclient.delete(self.lock_path, version=zstat.version)
@@ -211,6 +595,7 @@ class ZKLock(object):
                     logger.info(repr(e) + " while delete lock: " + str(self))
 
                 self.lock_holder = None
+                self._record_released()
 
                 return True, holder, zstat.version
             else:
@@ -232,28 +617,64 @@ class ZKLock(object):
         with self.mutex:
             if self.is_locked():
                 # remove listener to avoid useless event triggering
-                self.zkclient.remove_listener(self.on_connection_change)
+                self._remove_listener()
+                _lease_renewer.remove(self)
 
-                try:
-                    self.zkclient.delete(self.lock_path)
-                except NoNodeError as e:
-                    logger.info(repr(e) + " while delete lock: " + str(self))
+                if self._keep_for_handoff():
+                    logger.info("KEPT for local waiter: {s}".format(s=str(self)))
+                else:
+                    try:
+                        self.zkclient.delete(self.lock_path)
+                    except NoNodeError as e:
+                        logger.info(repr(e) + " while delete lock: " + str(self))
 
                 self.lock_holder = None
+                self._record_released()
 
                 logger.info("RELEASED: {s}".format(s=str(self)))
             else:
                 logger.info("not acquired, do not need to release")
 
+        self._release_local()
         self.close()
 
     def close(self):
-        self.zkclient.remove_listener(self.on_connection_change)
+        self._remove_listener()
+        _lease_renewer.remove(self)
+
+        with self.mutex:
+            self._resume()
+
+        if self.queue_node is not None:
+            try:
+                self._dequeue()
+            except Exception as e:
+                logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
 
         if self.owning_client:
             logger.info("zk client is made by me, close it")
             zkutil.close_zk(self.zkclient)
 
+    def _record(self, event, *args):
+        if self.stats is None:
+            return
+
+        try:
+            getattr(self.stats, event)(self.lock_name, *args)
+        except Exception as e:
+            logger.exception(repr(e) + " while record {e}: {s}".format(e=event, s=str(self)))
+
+    def _record_released(self):
+        acquired_at, self._acquired_at = self._acquired_at, None
+        if acquired_at is not None:
+            self._record("on_released", time.time() - acquired_at)
+
+    def _remove_listener(self):
+        if self.manager is None:
+            self.zkclient.remove_listener(self.on_connection_change)
+        else:
+            self.manager.remove(self)
+
     def is_locked(self):
         holder = self.lock_holder
         if holder is None:
@@ -261,40 +682,243 @@ class ZKLock(object):
 
         return self.cmp_identifier(holder[0], self.identifier)
 
-    def _create(self):
-        logger.debug("to creaet: {s}".format(s=str(self)))
+    def _enqueue(self):
+        if self.queue_node is not None:
+            return
+
+        # Waiters are ordered by the virtual enqueue time in the node name,
+        # see `_sort_queue`.
+        if self.priority is None:
+            vt = int(time.time() * 1000)
+            name = "{p}/{g}-{vt}-".format(p=self.queue_path, g=self._queue_guid, vt=vt)
+        else:
+            vt = int((time.time() - self.priority * self.aging) * 1000)
+            name = "{p}/{g}_{vt}-".format(p=self.queue_path, g=self._queue_guid, vt=vt)
+
+        # Waiter node is always ephemeral, a dead waiter must not block the queue.
+        while True:
+            try:
+                self.queue_node = self.zkclient.create(
+                    name,
+                    k3utfjson.dump(self.identifier).encode("utf-8"),
+                    ephemeral=True,
+                    sequence=True,
+                    makepath=True,
+                    acl=self.zkconf.kazoo_digest_acl(),
+                )
+                break
+            except NoNodeError as e:
+                # the queue dir is deleted by a leaving waiter after makepath
+                logger.info(repr(e) + " while enqueue, retry: " + str(self))
+
+        logger.debug("ENQUEUED: {n} {s}".format(n=self.queue_node, s=str(self)))
+
+    def _is_queue_head(self):
+        try:
+            children = self.zkclient.get_children(self.queue_path)
+        except NoNodeError:
+            children = []
+
+        children = _sort_queue(children)
+        self.waiters = len(children)
+
+        name = self.queue_node.rsplit("/", 1)[-1]
+        if name not in children:
+            # Waiter node is removed, e.g., session expired. Line up again.
+            logger.info("queue node lost: {n} {s}".format(n=self.queue_node, s=str(self)))
+            with self.mutex:
+                self.queue_node = None
+                self.maybe_available.set()
+            self.ahead = None
+            return False
+
+        idx = children.index(name)
+        self.ahead = idx + 1
+        if idx == 0:
+            return True
+
+        predecessor = self.queue_path + "/" + children[idx - 1]
+
+        with self.mutex:
+            self.maybe_available.clear()
+            if self.zkclient.exists(predecessor, watch=self.on_queue_change) is None:
+                # predecessor just left
+                self.maybe_available.set()
+
+        return False
+
+    def _dequeue(self):
+        node, self.queue_node = self.queue_node, None
+        self.ahead = None
+        if node is None:
+            return
+
+        try:
+            self.zkclient.delete(node)
+        except NoNodeError as e:
+            logger.info(repr(e) + " while delete queue node: " + str(self))
+
+        # Remove the queue dir if no one else is waiting, zookeeper refuses it
+        # otherwise. Other waiters create it again with `makepath`.
+        try:
+            self.zkclient.delete(self.queue_path)
+        except (NoNodeError, NotEmptyError) as e:
+            logger.debug(repr(e) + " while delete queue dir: " + str(self))
+
+        logger.debug("DEQUEUED: {n} {s}".format(n=node, s=str(self)))
+
+    def _acquire_local(self, expire_at):
+        if self.local is not None:
+            return
+
+        ll = _get_local_lock(self._local_key)
 
+        timeout = expire_at - time.time()
+        if timeout > 0:
+            ok = ll.lock.acquire(timeout=timeout)
+        else:
+            ok = ll.lock.acquire(False)
+
+        if not ok:
+            self._put_local_lock(ll)
+            raise LockTimeout("local lock: " + str(self.lock_path))
+
+        with ll.mutex:
+            ll.owner = self
+        self.local = ll
+
+    def _release_local(self):
+        ll, self.local = self.local, None
+        if ll is None:
+            return
+
+        with ll.mutex:
+            ll.owner = None
+        ll.lock.release()
+
+        self._put_local_lock(ll)
+
+    def _put_local_lock(self, ll):
+        kept = _put_local_lock(ll)
+        if kept is None:
+            return
+
+        # No one takes over the kept node.
+        holder, version = kept[0]
+        try:
+            self.zkclient.delete(self.lock_path, version=version)
+        except (NoNodeError, BadVersionError) as e:
+            logger.info(repr(e) + " while delete kept lock: " + str(self))
+
+    def _keep_for_handoff(self):
+        ll = self.local
+        if ll is None or not self.local_handoff or self.owning_client:
+            return False
+
+        with _local_locks_mutex:
+            if ll.refs <= 1:
+                # no one is waiting
+                return False
+
+            with ll.mutex:
+                ll.kept = (self.lock_holder, self.zkclient.client_id)
+                ll.kept_stale = False
+
+        return True
+
+    def _adopt_kept(self):
+        ll = self.local
+        with ll.mutex:
+            kept, ll.kept = ll.kept, None
+            stale, ll.kept_stale = ll.kept_stale, False
+
+        if kept is None:
+            return False
+
+        holder, client_id = kept
+        if not self.cmp_identifier(holder[0], self.identifier):
+            # Local contenders with different identifiers. No one else
+            # releases the kept node, delete it if it is not changed.
+            logger.info("kept lock is not mine, delete it: {s}".format(s=str(self)))
+            try:
+                self.zkclient.delete(self.lock_path, version=holder[1])
+            except (NoNodeError, BadVersionError) as e:
+                logger.info(repr(e) + " while delete kept lock: " + str(self))
+            return False
+
+        if stale or client_id != self.zkclient.client_id:
+            # The regular procedure tells if the node is still ours.
+            return False
+
+        with self.mutex:
+            self.lock_holder = holder
+
+        logger.info("ADOPTED from local: {s}".format(s=str(self)))
+        return self.is_locked()
+
+    def _get_holder(self):
         try:
-            self.zkclient.create(
-                self.lock_path,
-                k3utfjson.dump(self.identifier).encode("utf-8"),
-                ephemeral=self.ephemeral,
-                acl=self.zkconf.kazoo_digest_acl(),
-            )
-
-        except NodeExistsError as e:
-            # NOTE Success create on server side might also results in failure
-            # on client side due to network issue.
-            # 'get' after 'create' to check if existent node belongs to this
-            # client.
-
-            logger.debug(repr(e) + " while create lock: {s}".format(s=str(self)))
+            holder, zstat = self.zkclient.get(self.lock_path)
+        except NoNodeError:
             self.lock_holder = None
             return
 
-        logger.info("CREATE OK: {s}".format(s=str(self)))
+        self.lock_holder = (k3utfjson.load(holder), zstat.version)
 
     def set_lock_val(self, val, version=-1):
-        locked, holder, ver = self.try_acquire()
-        if not locked:
-            raise ZKUtilError("set non-locked: {k}".format(k=self.lock_name))
+        """
+        Update `val` of the identifier in the lock node.
 
-        self.identifier["val"] = val
+        If the lock is held, it takes one version-checked `set` with the
+        version in `lock_holder`. The lock is verified again with
+        `try_acquire` only if the version does not match. If the lock is not
+        held, it tries to acquire it first.
 
-        value = k3utfjson.dump(self.identifier).encode("utf-8")
-        st = self.zkclient.set(self.lock_path, value, version=version)
+        :param val: the new value.
+        :param version: if it is not `-1`, the `set` fails with
+        `BadVersionError` if the version of the lock node does not match.
+        :return: the new version of the lock node.
+        """
+        verify = False
+        while True:
+            if not self.is_locked() or verify:
+                locked, holder, ver = self.try_acquire()
+                if not locked:
+                    raise ZKUtilError("set non-locked: {k}".format(k=self.lock_name))
+
+            expect = version if version != -1 else self.lock_holder[1]
+            value = dict(self._node_value(), val=val)
+
+            try:
+                st = self.zkclient.set(self.lock_path, k3utfjson.dump(value).encode("utf-8"), version=expect)
+            except (BadVersionError, NoNodeError) as e:
+                if version != -1 and isinstance(e, BadVersionError):
+                    raise
+
+                # updated or removed by others, verify the lock
+                logger.info(repr(e) + " while set lock val: {s}".format(s=str(self)))
+                verify = True
+                continue
 
-        return st.version
+            self._lock_val_set(val, st)
+            return st.version
+
+    def _lock_val_set(self, val, zstat):
+        with self.mutex:
+            self.identifier["val"] = val
+            if self.is_locked():
+                self.lock_holder = (self._node_value(), zstat.version)
+
+    def get_owner(self):
+        """
+        Get the current lock holder.
+        Repeated queries are served from memory, only a change of the lock
+        hits zookeeper.
+
+        :return: a tuple of holder identifier and zk node version, or `None`
+        if the lock is free.
+        """
+        return _get_holder_cache(self.zkclient).get(self.zkclient, self.lock_path)
 
     def get_lock_val(self):
         holder, zstat = self.zkclient.get(self.lock_path)
@@ -305,31 +929,147 @@ class ZKLock(object):
     def cmp_identifier(self, ia, ib):
         return ia["id"] == ib["id"]
 
-    def _acquire_by_get(self):
-        logger.debug("to get: {s}".format(s=str(self)))
+    def _node_value(self, expire=None):
+        # identifier, with the lease expiry of a lease lock
+        if self.lease is None:
+            return self.identifier
+
+        val = dict(self.identifier)
+        val["expire"] = self._lease_expire if expire is None else expire
+        return val
+
+    def _holder_lease_end(self):
+        holder = self.lock_holder
+        if holder is None or self.is_locked():
+            return None
+
+        return holder[0].get("expire")
+
+    def _break_expired_lease(self):
+        lease_end = self._holder_lease_end()
+        if lease_end is None or time.time() < lease_end:
+            return False
+
+        holder, version = self.lock_holder
+        logger.info("lease of {h} expired, delete it: {s}".format(h=holder, s=str(self)))
 
         try:
-            with self.mutex:
-                holder, zstat = self.zkclient.get(self.lock_path, watch=self.on_node_change)
-                holder = k3utfjson.load(holder)
+            self.zkclient.delete(self.lock_path, version=version)
+        except (NoNodeError, BadVersionError) as e:
+            # released, or renewed just now
+            logger.info(repr(e) + " while delete expired lock: " + str(self))
+
+        with self.mutex:
+            self.maybe_available.set()
 
-                self.lock_holder = (holder, zstat.version)
+        return True
 
-                logger.debug("got lock holder: {s}".format(s=str(self)))
+    def _lease_renewed(self, expire, zstat):
+        with self.mutex:
+            if not self.is_locked():
+                return
 
-                if self.cmp_identifier(holder, self.identifier):
-                    logger.info("ACQUIRED: {s}".format(s=str(self)))
-                    return
+            self._lease_expire = expire
+            self.lock_holder = (self._node_value(), zstat.version)
 
-                logger.debug("other holds: {s}".format(s=str(self)))
-                self.maybe_available.clear()
+    def _lease_lost(self):
+        _lease_renewer.remove(self)
 
-        except NoNodeError as e:
-            # create failed but when getting it, it has been deleted
-            logger.info(repr(e) + " while get lock: {s}".format(s=str(self)))
-            with self.mutex:
+        with self.mutex:
+            self.maybe_available.set()
+            if not self._mark_lost():
+                return
+
+        logger.info("LEASE LOST: {s}".format(s=str(self)))
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def _create_and_get(self):
+        # Send "create" and "get" back to back without waiting for the reply.
+        # zookeeper serves the requests of one session in order, thus the "get"
+        # sees the result of the "create", and it takes only one round trip.
+        #
+        # The mutex is held until the "get" is done, or there is a chance
+        # on_node_change is triggered before self.lock_holder is updated.
+        with self.mutex:
+            create_rst, get_rst = self._send_create_and_get()
+            self._recv_create_and_get(create_rst, get_rst)
+
+    def _send_create_and_get(self):
+        logger.debug("to create and get: {s}".format(s=str(self)))
+
+        if self.local is None:
+            watch = self.on_node_change
+        else:
+            # shared by local contenders, forwarded to the current local owner
+            watch = self.local.on_node_change
+
+        if self.lease is not None:
+            self._lease_expire = time.time() + self.lease
+
+        create_rst = self.zkclient.create_async(
+            self.lock_path,
+            k3utfjson.dump(self._node_value()).encode("utf-8"),
+            ephemeral=self.ephemeral,
+            acl=self.zkconf.kazoo_digest_acl(),
+            # a shard dir is created on demand
+            makepath=bool(self.zkconf.lock_shards()),
+        )
+
+        # The holder read with our own watch is shared with the holder cache.
+        self._holder_cache_gen = None
+        if self.local is None:
+            cache = _holder_caches.get(self.zkclient)
+            if cache is not None:
+                self._holder_cache_gen = cache.generation(self.lock_path)
+
+        # Always proceed the "get" phase, in order to add a watch handler.
+        get_rst = self.zkclient.get_async(self.lock_path, watch=watch)
+
+        return create_rst, get_rst
+
+    def _recv_create_and_get(self, create_rst, get_rst):
+        with self.mutex:
+            try:
+                create_rst.get()
+                logger.info("CREATE OK: {s}".format(s=str(self)))
+
+            except NodeExistsError as e:
+                # NOTE Success create on server side might also results in failure
+                # on client side due to network issue.
+                # 'get' after 'create' to check if existent node belongs to this
+                # client.
+
+                logger.debug(repr(e) + " while create lock: {s}".format(s=str(self)))
+                self.lock_holder = None
+
+            try:
+                holder, zstat = get_rst.get()
+
+            except NoNodeError as e:
+                # create failed but when getting it, it has been deleted
+                logger.info(repr(e) + " while get lock: {s}".format(s=str(self)))
                 self.lock_holder = None
                 self.maybe_available.set()
+                return
+
+            holder = k3utfjson.load(holder)
+
+            self.lock_holder = (holder, zstat.version)
+
+            if self._holder_cache_gen is not None:
+                _holder_caches[self.zkclient].fill(self.lock_path, self._holder_cache_gen, self.lock_holder)
+
+            logger.debug("got lock holder: {s}".format(s=str(self)))
+
+            if self.cmp_identifier(holder, self.identifier):
+                self._lost = False
+                logger.info("ACQUIRED: {s}".format(s=str(self)))
+                return
+
+            logger.debug("other holds: {s}".format(s=str(self)))
+            self.maybe_available.clear()
 
     def __str__(self):
         return "<id={id} {l}:[{holder}] on {h}>".format(
@@ -346,6 +1086,504 @@ class ZKLock(object):
         self.release()
 
 
+def try_acquire_many(lock_names, **kwargs):
+    """
+    Try to acquire many locks on one zk client at once.
+    It never blocks.
+
+    The "create" and "get" requests of all of the locks are sent before waiting
+    for any reply, thus it takes about one round trip no matter how many locks
+    there are.
+
+        locks = try_acquire_many(["a", "b"], zkclient=zk)
+        for lck in locks:
+            if lck.is_locked():
+                ...
+            lck.release()
+
+    :param lock_names: list of lock names.
+    :param kwargs: other arguments passed to `ZKLock`. `zkclient` or `manager`
+    must be specified, `queued`, `local_first`, `lease` and `priority` are not
+    supported.
+    :return: a list of `ZKLock` in the same order as `lock_names`. Every one of
+    them has to be released, whether it is locked or not.
+    """
+    if kwargs.get("zkclient") is None and kwargs.get("manager") is None:
+        raise ValueError("zkclient or manager must be specified")
+
+    for k in ("queued", "local_first", "lease", "priority"):
+        v = kwargs.get(k)
+        if v is not None and v is not False:
+            raise ValueError("{k} is not supported by try_acquire_many".format(k=k))
+
+    locks = [ZKLock(n, **kwargs) for n in lock_names]
+
+    # Hold the mutexes until replies are handled, the same as `_create_and_get`.
+    for lck in locks:
+        lck.mutex.acquire()
+
+    try:
+        sent = [(lck, lck._send_create_and_get()) for lck in locks]
+        for lck, (create_rst, get_rst) in sent:
+            lck._recv_create_and_get(create_rst, get_rst)
+    finally:
+        for lck in locks:
+            lck.mutex.release()
+
+    for lck in locks:
+        if lck.lock_holder is None:
+            # The lock node is deleted between "create" and "get", try again.
+            lck.try_acquire()
+
+    return locks
+
+
+class _LeaseRenewer(object):
+    # One daemon thread renews all of the leases in the process. It runs
+    # only when there are leases to renew.
+
+    # max number of locks renewed in one transaction
+    batch = 1000
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.locks = set()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.interval = None
+
+    def add(self, lck):
+        with self.mutex:
+            self.locks.add(lck)
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="zklock-lease-renewer", daemon=True)
+                self.thread.start()
+            elif self.interval is not None and lck.lease / 3.0 < self.interval:
+                # a new lease needs a shorter interval
+                self.wakeup.set()
+
+    def remove(self, lck):
+        with self.mutex:
+            self.locks.discard(lck)
+
+    def _loop(self):
+        while True:
+            with self.mutex:
+                if len(self.locks) == 0:
+                    self.thread = None
+                    self.interval = None
+                    return
+                self.interval = min([lck.lease for lck in self.locks]) / 3.0
+                interval = self.interval
+
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+
+            with self.mutex:
+                locks = list(self.locks)
+
+            by_client = {}
+            for lck in locks:
+                by_client.setdefault(id(lck.zkclient), []).append(lck)
+
+            for lcks in by_client.values():
+                for i in range(0, len(lcks), self.batch):
+                    try:
+                        self._renew(lcks[i : i + self.batch])
+                    except Exception as e:
+                        logger.exception(repr(e) + " while renew leases")
+
+    def _renew(self, locks):
+        zk = locks[0].zkclient
+        now = time.time()
+
+        tx = zk.transaction()
+        renewing = []
+        for lck in locks:
+            with lck.mutex:
+                if not lck.is_locked():
+                    self.remove(lck)
+                    continue
+
+                expire = now + lck.lease
+                tx.set_data(
+                    lck.lock_path,
+                    k3utfjson.dump(lck._node_value(expire)).encode("utf-8"),
+                    version=lck.lock_holder[1],
+                )
+                renewing.append((lck, expire))
+
+        if len(renewing) == 0:
+            return
+
+        try:
+            rsts = tx.commit()
+        except Exception as e:
+            logger.info(repr(e) + " while renew {n} leases".format(n=len(renewing)))
+            self._check_expired(renewing)
+            return
+
+        if not any([isinstance(r, Exception) for r in rsts]):
+            for (lck, expire), zstat in zip(renewing, rsts):
+                lck._lease_renewed(expire, zstat)
+            return
+
+        # Some of them are lost or updated by others. Renew them one by one.
+        self._renew_each(zk, renewing)
+
+    def _renew_each(self, zk, renewing):
+        gets = [(lck, expire, zk.get_async(lck.lock_path)) for lck, expire in renewing]
+
+        sets = []
+        for lck, expire, ar in gets:
+            try:
+                holder, zstat = ar.get()
+            except NoNodeError:
+                lck._lease_lost()
+                continue
+            except Exception as e:
+                logger.info(repr(e) + " while get lease: " + str(lck))
+                self._check_expired([(lck, expire)])
+                continue
+
+            if not lck.cmp_identifier(k3utfjson.load(holder), lck.identifier):
+                lck._lease_lost()
+                continue
+
+            value = k3utfjson.dump(lck._node_value(expire)).encode("utf-8")
+            sets.append((lck, expire, zk.set_async(lck.lock_path, value, version=zstat.version)))
+
+        for lck, expire, ar in sets:
+            try:
+                zstat = ar.get()
+            except NoNodeError:
+                lck._lease_lost()
+                continue
+            except Exception as e:
+                # BadVersionError: updated by the holder just now, retry in next round
+                logger.info(repr(e) + " while renew lease: " + str(lck))
+                self._check_expired([(lck, expire)])
+                continue
+
+            lck._lease_renewed(expire, zstat)
+
+    def _check_expired(self, renewing):
+        now = time.time()
+        for lck, _ in renewing:
+            if lck._lease_expire is not None and now > lck._lease_expire:
+                lck._lease_lost()
+
+
+_lease_renewer = _LeaseRenewer()
+
+
+def set_lock_vals(lock_vals):
+    """
+    Update `val` of many held locks in one transaction.
+
+    The same as `ZKLock.set_lock_val` without `version`, except that all of
+    the version-checked `set`s are sent in one transaction. If some of the
+    versions do not match, these locks are verified with `try_acquire` and
+    the transaction is sent again.
+
+        set_lock_vals([(lck_a, 1), (lck_b, 2)])
+
+    Every held lock watches its node, thus the update costs one more `exists`
+    per lock to watch it again, in kazoo event thread. A `get` is sent only if
+    the version is not the one we set. Leases do not watch their own nodes.
+
+    :param lock_vals: a list of `(lock, val)`. The locks must use the same zk
+    client. The size of a transaction is limited by `jute.maxbuffer` of
+    zookeeper, which is 1MB by default.
+    :return: a list of the new versions of the lock nodes.
+    """
+    if len(lock_vals) == 0:
+        return []
+
+    zkclient = lock_vals[0][0].zkclient
+    for lck, _ in lock_vals:
+        if lck.zkclient is not zkclient:
+            raise ValueError("locks must use the same zkclient")
+
+    verify = [lck for lck, _ in lock_vals if not lck.is_locked()]
+    while True:
+        for lck in verify:
+            locked, holder, ver = lck.try_acquire()
+            if not locked:
+                raise ZKUtilError("set non-locked: {k}".format(k=lck.lock_name))
+
+        tx = zkclient.transaction()
+        for lck, val in lock_vals:
+            value = dict(lck._node_value(), val=val)
+            tx.set_data(lck.lock_path, k3utfjson.dump(value).encode("utf-8"), version=lck.lock_holder[1])
+
+        rsts = tx.commit()
+
+        verify = []
+        for (lck, _), rst in zip(lock_vals, rsts):
+            if isinstance(rst, (BadVersionError, NoNodeError)):
+                logger.info(repr(rst) + " while set lock val: {s}".format(s=str(lck)))
+                verify.append(lck)
+            elif isinstance(rst, Exception) and not isinstance(rst, RolledBackError):
+                raise rst
+
+        if len(verify) == 0:
+            break
+
+    for (lck, val), zstat in zip(lock_vals, rsts):
+        lck._lock_val_set(val, zstat)
+
+    return [zstat.version for zstat in rsts]
+
+
+def get_lock_owner(zkclient, lock_name, zkconf=None):
+    """
+    Get the current holder of a lock without creating a `ZKLock`.
+
+    Holders are cached per zk client and kept up to date by watches, thus
+    polling the holders of many locks costs one `get` for every lock change,
+    not for every query. The watch set by a `ZKLock` on the same client is
+    shared, its reads fill the cache too. The cache is dropped when the
+    connection is not `CONNECTED`.
+
+    :return: a tuple of holder identifier and zk node version, or `None` if
+    the lock is free. The identifier must not be modified.
+    """
+    if zkconf is None:
+        zkconf = ZKConf()
+    if isinstance(zkconf, dict):
+        zkconf = ZKConf(**zkconf)
+
+    if isinstance(zkclient, KazooClientExt):
+        zkclient = zkclient._zk
+
+    return _get_holder_cache(zkclient).get(zkclient, zkconf.lock(lock_name))
+
+
+class _HolderCache(object):
+    # Lock holders on one zk client. An entry is valid until the watch on
+    # its path fires. It does not reference the client, thus it is released
+    # with the client.
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # path to (holder, version) or None if the lock is free
+        self.holders = {}
+        # path to the number of invalidations, a read started before an
+        # invalidation must not be cached
+        self.gens = {}
+        self.epoch = 0
+
+    def generation(self, path):
+        path = _abs_path(path)
+        with self.mutex:
+            return (self.epoch, self.gens.get(path, 0))
+
+    def fill(self, path, gen, holder):
+        path = _abs_path(path)
+        with self.mutex:
+            if gen == (self.epoch, self.gens.get(path, 0)):
+                self.holders[path] = holder
+
+    def invalidate(self, path):
+        path = _abs_path(path)
+        with self.mutex:
+            self.holders.pop(path, None)
+            self.gens[path] = self.gens.get(path, 0) + 1
+
+    def clear(self):
+        with self.mutex:
+            self.holders = {}
+            self.gens = {}
+            self.epoch += 1
+
+    def on_connection_change(self, state):
+        # Changes might be missed until reconnected.
+        if state != KazooState.CONNECTED:
+            self.clear()
+
+    def on_node_change(self, watchevent):
+        if watchevent.path is None:
+            # a session event, cleared by on_connection_change
+            return
+        self.invalidate(watchevent.path)
+
+    def get(self, zkclient, path):
+        key = _abs_path(path)
+        with self.mutex:
+            if key in self.holders:
+                return self.holders[key]
+
+        while True:
+            gen = self.generation(path)
+            try:
+                holder, zstat = zkclient.get(path, watch=self.on_node_change)
+                holder = (k3utfjson.load(holder), zstat.version)
+            except NoNodeError:
+                # watch for creation
+                if zkclient.exists(path, watch=self.on_node_change) is not None:
+                    # just created
+                    continue
+                holder = None
+
+            self.fill(path, gen, holder)
+            return holder
+
+
+_holder_caches = weakref.WeakKeyDictionary()
+_holder_caches_mutex = threading.Lock()
+
+
+def _get_holder_cache(zkclient):
+    with _holder_caches_mutex:
+        cache = _holder_caches.get(zkclient)
+        if cache is None:
+            cache = _HolderCache()
+            zkclient.add_listener(cache.on_connection_change)
+            _holder_caches[zkclient] = cache
+
+        return cache
+
+
+class _SuspendedGrace(object):
+    """
+    Grace periods of the suspended locks on one zk client. One timer fires at
+    the earliest deadline and sweeps all of the expired locks, thus a
+    `SUSPENDED` event does not start a thread for every lock.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # lock to deadline
+        self.deadlines = {}
+        # heap of (deadline, seq, lock), entries not in deadlines are stale
+        self.heap = []
+        self.seq = 0
+        self.timer = None
+        self.timer_at = None
+
+    def add(self, lck, grace):
+        deadline = time.time() + grace
+        with self.mutex:
+            self.deadlines[lck] = deadline
+            self.seq += 1
+            heapq.heappush(self.heap, (deadline, self.seq, lck))
+            self._schedule()
+
+    def remove(self, lck):
+        with self.mutex:
+            self.deadlines.pop(lck, None)
+            if len(self.deadlines) == 0:
+                self.heap = []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+    def _schedule(self):
+        # Must be called with mutex held.
+        if len(self.heap) == 0:
+            return
+
+        at = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_at <= at:
+                return
+            self.timer.cancel()
+
+        self.timer = threading.Timer(max(at - time.time(), 0), self._fire)
+        self.timer.daemon = True
+        self.timer_at = at
+        self.timer.start()
+
+    def _fire(self):
+        now = time.time()
+        expired = []
+        with self.mutex:
+            self.timer = None
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                deadline, _, lck = heapq.heappop(self.heap)
+                if self.deadlines.get(lck) == deadline:
+                    del self.deadlines[lck]
+                    expired.append(lck)
+
+            self._schedule()
+
+        for lck in expired:
+            try:
+                lck._on_grace_timeout()
+            except Exception as e:
+                logger.exception(repr(e) + " while grace timeout: {s}".format(s=str(lck)))
+
+
+_suspended_graces = weakref.WeakKeyDictionary()
+_suspended_graces_mutex = threading.Lock()
+
+
+def _get_suspended_grace(zkclient):
+    with _suspended_graces_mutex:
+        grace = _suspended_graces.get(zkclient)
+        if grace is None:
+            grace = _SuspendedGrace()
+            _suspended_graces[zkclient] = grace
+
+        return grace
+
+
+def _invalidate_holder(zkclient, path):
+    if path is None:
+        # a session event, the cache is cleared by its connection listener
+        return
+
+    cache = _holder_caches.get(zkclient)
+    if cache is not None:
+        cache.invalidate(path)
+
+
+def _abs_path(path):
+    return "/" + path.strip("/")
+
+
+def prepare_lock_env(zkconf, zkclient, on_lost, identifier):
+    """
+    Normalize the common arguments of lock classes.
+
+    :return: a tuple of `(zkconf, zkclient, owning_client, identifier)`.
+    `owning_client` is `True` if `zkclient` is created here and should be closed
+    by the lock.
+    """
+    if zkconf is None:
+        zkconf = ZKConf()
+    if isinstance(zkconf, dict):
+        zkconf = ZKConf(**zkconf)
+
+    if zkclient is None:
+        # If user does not pass a zkclient instance,
+        # we need to create one for lock to use.
+        # This zkclient will be closed after lock is released
+
+        if on_lost is None:
+            raise ValueError("on_lost must be specified to watch zk connection issue if no zkclient specified")
+
+        zkclient = make_owning_zkclient(zkconf.hosts(), zkconf.auth())
+        owning_client = True
+    else:
+        owning_client = False
+
+    if isinstance(zkclient, KazooClientExt):
+        zkclient = zkclient._zk
+
+    if identifier is None:
+        identifier = zkutil.lock_id(zkconf.node_id())
+
+    if not isinstance(identifier, dict):
+        identifier = make_identifier(identifier, None)
+
+    assert sorted(["id", "val"]) == sorted(list(identifier.keys()))
+
+    return zkconf, zkclient, owning_client, identifier
+
+
 def make_owning_zkclient(hosts, auth):
     zkclient = KazooClient(hosts=hosts)
     zkclient.start()
@@ -357,5 +1595,100 @@ def make_owning_zkclient(hosts, auth):
     return zkclient
 
 
+class _LocalLock(object):
+    # The in-process part of `local_first` locks, shared by the local
+    # contenders on the same hosts and lock path.
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.mutex = threading.RLock()
+        # number of locks holding or waiting for `self.lock`
+        self.refs = 0
+        self.owner = None
+        # (lock_holder, client_id) of the zk node kept for handoff
+        self.kept = None
+        self.kept_stale = False
+
+    def on_node_change(self, watchevent):
+        with self.mutex:
+            owner = self.owner
+            if self.kept is not None:
+                self.kept_stale = True
+
+        if owner is not None:
+            owner.on_node_change(watchevent)
+
+
+_local_locks = {}
+_local_locks_mutex = threading.Lock()
+_local_lock_ids = {}
+
+
+def _get_local_lock(key):
+    with _local_locks_mutex:
+        ll = _local_locks.get(key)
+        if ll is None:
+            ll = _LocalLock(key)
+            _local_locks[key] = ll
+
+        ll.refs += 1
+        return ll
+
+
+def _put_local_lock(ll):
+    # Return the kept node info if it is the last reference.
+    with _local_locks_mutex:
+        ll.refs -= 1
+        if ll.refs > 0:
+            return None
+
+        del _local_locks[ll.key]
+
+        with ll.mutex:
+            kept, ll.kept = ll.kept, None
+        return kept
+
+
+def _local_lock_id(node_id):
+    # one identifier per process, pid changes after fork
+    key = (node_id, os.getpid())
+    with _local_locks_mutex:
+        if key not in _local_lock_ids:
+            _local_lock_ids[key] = zkutil.lock_id(node_id)
+        return _local_lock_ids[key]
+
+
+def _sort_queue(children):
+    # waiter node name: <guid>-<enqueue time in ms>-<10 digit sequence>, or
+    # with priority: <guid>_<virtual enqueue time in ms>-<10 digit sequence>
+    prioritized = []
+    plain = []
+    for name in children:
+        seq = name[-10:]
+        base = name[:-11]
+        if "_" in base:
+            prioritized.append((int(base.split("_", 1)[1]), seq, name))
+        elif "-" in base:
+            plain.append((int(base.rsplit("-", 1)[1]), seq, name))
+        else:
+            # <guid>-<sequence> from an older client, no enqueue time
+            plain.append((None, seq, name))
+
+    # A waiter without priority is not before the ones without priority
+    # enqueued earlier, whatever their clocks say.
+    keys = list(prioritized)
+    last = None
+    for vt, seq, name in sorted(plain, key=lambda x: x[1]):
+        if vt is None:
+            vt = last or 0
+        elif last is not None and vt < last:
+            vt = last
+        last = vt
+        keys.append((vt, seq, name))
+
+    return [name for vt, seq, name in sorted(keys)]
+
+
 def make_identifier(_id, val):
     return {"id": _id, "val": val}
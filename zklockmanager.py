@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import queue
+import threading
+
+from .zkconf import KazooClientExt
+from .zkconf import ZKConf
+from .zklock import ZKLock
+
+logger = logging.getLogger(__name__)
+
+
+class ZKLockManager(object):
+    """
+    ZKLockManager tracks all of the locks created through it on one zk client.
+
+    It registers only one connection listener on the client and dispatches a
+    connection state change to every live lock.
+    With `dispatch_thread=True`, the dispatching runs in a dedicated thread, so
+    that kazoo event thread spends O(1) time on a connection event no matter how
+    many locks there are.
+
+    `stats` is passed to every lock created by `lock()`, unless it is
+    specified there.
+
+        mgr = ZKLockManager(zk)
+        with mgr.lock("foo"):
+            ...
+    """
+
+    def __init__(self, zkclient, zkconf=None, dispatch_thread=False, stats=None):
+        if zkconf is None:
+            zkconf = ZKConf()
+        if isinstance(zkconf, dict):
+            zkconf = ZKConf(**zkconf)
+        self.zkconf = zkconf
+
+        if isinstance(zkclient, KazooClientExt):
+            zkclient = zkclient._zk
+        self.zkclient = zkclient
+        self.stats = stats
+
+        self.mutex = threading.RLock()
+        # lock name to the set of live locks on it
+        self.locks = {}
+        self.lock_count = 0
+
+        self.state_queue = None
+        self.dispatcher = None
+        if dispatch_thread:
+            self.state_queue = queue.Queue()
+            self.dispatcher = threading.Thread(target=self._dispatch_loop, name="zklock-dispatcher")
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+
+        self.zkclient.add_listener(self.on_connection_change)
+
+    def lock(self, lock_name, **kwargs):
+        """
+        Create a `ZKLock` managed by this manager.
+        :param lock_name: the lock name.
+        :param kwargs: other arguments passed to `ZKLock`, except `zkclient`.
+        :return: a `ZKLock` instance.
+        """
+        kwargs.setdefault("stats", self.stats)
+        return ZKLock(lock_name, manager=self, **kwargs)
+
+    def add(self, lck):
+        with self.mutex:
+            st = self.locks.setdefault(lck.lock_name, set())
+            if lck not in st:
+                st.add(lck)
+                self.lock_count += 1
+
+    def remove(self, lck):
+        with self.mutex:
+            st = self.locks.get(lck.lock_name)
+            if st is None or lck not in st:
+                return
+
+            st.remove(lck)
+            self.lock_count -= 1
+            if len(st) == 0:
+                del self.locks[lck.lock_name]
+
+    def get_locks(self, lock_name=None):
+        """
+        Return a list of live locks on `lock_name`, or all of the live locks if
+        `lock_name` is `None`.
+        """
+        with self.mutex:
+            if lock_name is not None:
+                return list(self.locks.get(lock_name, ()))
+
+            rst = []
+            for st in self.locks.values():
+                rst.extend(st)
+            return rst
+
+    def on_connection_change(self, state):
+        logger.info("connection state changed: {st}, {n} locks".format(st=state, n=self.lock_count))
+
+        if self.state_queue is not None:
+            self.state_queue.put(state)
+        else:
+            self._dispatch(state)
+
+    def close(self):
+        """
+        Remove the connection listener and stop the dispatcher thread.
+        Live locks no longer receive connection events.
+        :return: nothing
+        """
+        self.zkclient.remove_listener(self.on_connection_change)
+
+        if self.state_queue is not None:
+            self.state_queue.put(None)
+            self.dispatcher.join()
+
+    def _dispatch(self, state):
+        for lck in self.get_locks():
+            try:
+                lck.on_connection_change(state)
+            except Exception as e:
+                logger.exception(repr(e) + " while dispatch connection state to {s}".format(s=str(lck)))
+
+    def _dispatch_loop(self):
+        while True:
+            state = self.state_queue.get()
+            if state is None:
+                return
+
+            self._dispatch(state)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import os
+import time
+
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+
+from . import zkutil
+from .zkconf import KazooClientExt
+from .zkconf import ZKConf
+from .zklockscan import pipeline
+from .zklockscan import scan_locks
+
+logger = logging.getLogger(__name__)
+
+
+class ZKLockReaper(object):
+    """
+    ZKLockReaper finds and deletes the non-ephemeral `ZKLock`s whose holder is
+    dead.
+
+    Lock nodes in `ZKConf.lock_dir()` and its shards are read with pipelined
+    requests, and grouped by holder: `(node_id, ip, process_id)` parsed from
+    the identifier with `zkutil.parse_lock_id`. `liveness(holder, locks)` is
+    called once for every holder and returns `False` if the holder is dead,
+    `True` if it is alive or `None` if it does not know. Only the locks of
+    dead holders are deleted.
+
+        reaper = ZKLockReaper(zk, liveness=AgeLiveness(3600))
+        for lck in reaper.reap():
+            print("reaped", lck["name"], lck["holder"])
+
+    If `liveness` has a method `prefetch(holders)`, it is called once with all
+    of the holders before `liveness` is called for each of them, to batch the
+    checks, as `HeartbeatLiveness` does.
+
+    A lock is deleted with the version read in the scan, after checking that
+    its `czxid` is not changed, thus a lock updated or re-acquired after the
+    scan is kept.
+    But the check and the delete are not atomic with the liveness check: a
+    holder that is alive and does not touch its lock node is not protected.
+    Thus `liveness` must be conservative: return `False` only if the holder is
+    certainly dead, and `None` if unsure.
+    Ephemeral locks and the directories of queued locks, `ZKRWLock` and
+    `ZKSemaphore` are skipped.
+    """
+
+    def __init__(self, zkclient, liveness, zkconf=None, concurrency=256):
+        """
+        :param zkclient: a `KazooClient` or `KazooClientExt`.
+        :param liveness: a callable `liveness(holder, locks)`. `holder` is a
+        `dict` returned by `zkutil.parse_lock_id`, `locks` is a list of lock
+        info of this holder, see `scan()`.
+        :param zkconf: specifies `lock_dir`. By default `ZKConf()`.
+        :param concurrency: max number of requests sent without waiting for reply.
+        """
+        if zkconf is None:
+            zkconf = ZKConf()
+        if isinstance(zkconf, dict):
+            zkconf = ZKConf(**zkconf)
+        self.zkconf = zkconf
+
+        if isinstance(zkclient, KazooClientExt):
+            zkclient = zkclient._zk
+        self.zkclient = zkclient
+
+        self.liveness = liveness
+        self.concurrency = concurrency
+
+    def scan(self):
+        """
+        Read all of the non-ephemeral lock nodes.
+        :return: a list of `dict`, see `zklockscan.scan_locks`.
+        """
+        locks = scan_locks(self.zkclient, self.zkconf, self.concurrency)
+        return [lck for lck in locks if not lck["ephemeral"] and lck["children"] == 0]
+
+    def find_dead(self, locks=None):
+        """
+        :return: the locks in `locks` or in a new `scan()` whose holder is dead.
+        """
+        if locks is None:
+            locks = self.scan()
+
+        by_holder = {}
+        for lck in locks:
+            lid = lck["lock_id"]
+            by_holder.setdefault((lid["node_id"], lid["ip"], lid["process_id"]), []).append(lck)
+
+        prefetch = getattr(self.liveness, "prefetch", None)
+        if prefetch is not None:
+            try:
+                prefetch([lcks[0]["lock_id"] for lcks in by_holder.values()])
+            except Exception as e:
+                logger.exception(repr(e) + " while prefetch liveness")
+
+        dead = []
+        for lcks in by_holder.values():
+            try:
+                alive = self.liveness(lcks[0]["lock_id"], lcks)
+            except Exception as e:
+                logger.exception(repr(e) + " while check liveness of {h}".format(h=lcks[0]["lock_id"]))
+                continue
+
+            if alive is False:
+                dead.extend(lcks)
+
+        return dead
+
+    def reap(self, dry_run=False):
+        """
+        Delete the locks of dead holders.
+        :param dry_run: only find out the locks to delete.
+        :return: a list of deleted locks, see `scan()`.
+        """
+        dead = self.find_dead()
+        if dry_run or len(dead) == 0:
+            return dead
+
+        # re-check czxid: a lock deleted and created again is not the one scanned
+        rsts = self._pipeline(dead, lambda lck: self.zkclient.exists_async(lck["path"]))
+        unchanged = []
+        for lck, zstat in rsts:
+            if isinstance(zstat, Exception):
+                raise zstat
+
+            if zstat is not None and zstat.czxid == lck["czxid"] and zstat.version == lck["version"]:
+                unchanged.append(lck)
+
+        reaped = []
+        rsts = self._pipeline(unchanged, lambda lck: self.zkclient.delete_async(lck["path"], version=lck["version"]))
+        for lck, rst in rsts:
+            if isinstance(rst, (NoNodeError, BadVersionError)):
+                logger.info(repr(rst) + " while reap lock {p}".format(p=lck["path"]))
+                continue
+            if isinstance(rst, Exception):
+                raise rst
+
+            logger.info("REAPED: {p} held by {h}".format(p=lck["path"], h=lck["holder"]))
+            reaped.append(lck)
+
+        return reaped
+
+    def _pipeline(self, items, send):
+        return pipeline(items, send, self.concurrency)
+
+
+class LocalPidLiveness(object):
+    """
+    Tell if a holder on this host is alive by checking its process id.
+    It does not know about holders on other hosts.
+    The identifier records a process id, which might be reused by another
+    process after the holder died.
+    """
+
+    def __init__(self, node_id=None, ips=None):
+        self.node_id = node_id
+        self.ips = set(ips if ips is not None else zkutil.host_ip4)
+
+    def __call__(self, holder, locks):
+        if self.node_id is not None and holder["node_id"] != self.node_id:
+            return None
+
+        if holder["ip"] not in self.ips or holder["process_id"] is None:
+            return None
+
+        try:
+            os.kill(holder["process_id"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # exists, but owned by other user
+            return True
+
+        return True
+
+
+class AgeLiveness(object):
+    """
+    Treat a holder as dead if none of its locks is updated in the last
+    `max_age` seconds, by the node `mtime`, or by the `expire` of a lease,
+    whichever is later.
+    `max_age` must be longer than the longest hold without an update.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def __call__(self, holder, locks):
+        now = time.time()
+        return min([now - _last_alive(lck) for lck in locks]) <= self.max_age
+
+
+def _last_alive(lck):
+    expire = lck["holder"].get("expire")
+    if expire is None:
+        return lck["mtime"]
+
+    return max(lck["mtime"], expire)
+
+
+class HeartbeatLiveness(object):
+    """
+    Tell if a holder is alive by the ephemeral heartbeat node registered by
+    `register_heartbeat()` in the holder process.
+    `ZKLockReaper` checks the heartbeats of all holders with pipelined
+    `exists` by `prefetch()`.
+    """
+
+    def __init__(self, zkclient, heartbeat_dir, concurrency=256):
+        if isinstance(zkclient, KazooClientExt):
+            zkclient = zkclient._zk
+        self.zkclient = zkclient
+        self.heartbeat_dir = heartbeat_dir
+        self.concurrency = concurrency
+
+        # heartbeat path to whether it exists
+        self.prefetched = {}
+
+    def prefetch(self, holders):
+        paths = [self._path(h) for h in holders]
+        rsts = pipeline(paths, self.zkclient.exists_async, self.concurrency)
+
+        self.prefetched = {}
+        for path, zstat in rsts:
+            if isinstance(zstat, Exception):
+                logger.info(repr(zstat) + " while check heartbeat {p}".format(p=path))
+                continue
+            self.prefetched[path] = zstat is not None
+
+    def __call__(self, holder, locks):
+        path = self._path(holder)
+        alive = self.prefetched.pop(path, None)
+        if alive is not None:
+            return alive
+
+        return self.zkclient.exists(path) is not None
+
+    def _path(self, holder):
+        return _heartbeat_path(self.heartbeat_dir, holder["node_id"], holder["ip"], holder["process_id"])
+
+
+def register_heartbeat(zkclient, heartbeat_dir, node_id=None):
+    """
+    Create the ephemeral heartbeat node of the current process, for
+    `HeartbeatLiveness` to check.
+    The node lives as long as the session of `zkclient`.
+    :return: the path of the heartbeat node.
+    """
+    lid = zkutil.parse_lock_id(zkutil.lock_id(node_id))
+    path = _heartbeat_path(heartbeat_dir, lid["node_id"], lid["ip"], lid["process_id"])
+
+    try:
+        zkclient.create(path, ephemeral=True, makepath=True)
+    except NodeExistsError as e:
+        logger.info(repr(e) + " while register heartbeat {p}".format(p=path))
+
+    return path
+
+
+def _heartbeat_path(heartbeat_dir, node_id, ip, process_id):
+    return "{d}/{n}-{i}-{p}".format(d=heartbeat_dir.rstrip("/"), n=node_id, i=ip, p=process_id)
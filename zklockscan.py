@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import time
+
+import k3utfjson
+
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+
+from . import zkutil
+from .zkconf import KazooClientExt
+from .zkconf import ZKConf
+from .zkconf import reserved_lock_names
+
+logger = logging.getLogger(__name__)
+
+
+def list_locks(zkclient, zkconf=None, concurrency=256):
+    """
+    List the lock nodes in `ZKConf.lock_dir()` and in all of its shards.
+
+    The children of the shards are listed with pipelined requests, at most
+    `concurrency` of them on the wire at a time. Locks left in the flat
+    `lock_dir`, such as the ones created before sharding, are listed too.
+
+    :return: a list of `(lock_name, path)`.
+    """
+    zkclient, zkconf = _normalize(zkclient, zkconf)
+
+    lock_dir = zkconf.lock_dir()
+    dirs = [lock_dir]
+    if zkconf.lock_shards():
+        dirs.extend(zkconf.lock_shard_dirs())
+
+    locks = []
+    for d, children in pipeline(dirs, lambda d: zkclient.get_children_async(d.rstrip("/") or "/"), concurrency):
+        if isinstance(children, NoNodeError):
+            continue
+        if isinstance(children, Exception):
+            raise children
+
+        for name in children:
+            if d == lock_dir and name in reserved_lock_names:
+                continue
+            locks.append((name, d + name))
+
+    return locks
+
+
+def scan_locks(zkclient, zkconf=None, concurrency=256):
+    """
+    Read all of the lock nodes listed by `list_locks`, with pipelined `get`s.
+
+    Nodes that are not `ZKLock` nodes, such as the directories of `ZKRWLock`
+    and `ZKSemaphore`, are skipped.
+
+    :return: a list of `dict`:
+    `{"name": lock_name, "path": path, "holder": identifier,
+    "lock_id": parse_lock_id(identifier["id"]), "version": version,
+    "czxid": czxid, "ctime": ctime_in_sec, "mtime": mtime_in_sec,
+    "ephemeral": bool, "children": number_of_children}`.
+    """
+    zkclient, zkconf = _normalize(zkclient, zkconf)
+
+    names = list_locks(zkclient, zkconf, concurrency)
+
+    locks = []
+    for (name, path), rst in pipeline(names, lambda n: zkclient.get_async(n[1]), concurrency):
+        if isinstance(rst, NoNodeError):
+            continue
+        if isinstance(rst, Exception):
+            raise rst
+
+        val, zstat = rst
+        try:
+            holder = k3utfjson.load(val)
+            lid = zkutil.parse_lock_id(holder["id"])
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.debug(repr(e) + " while parse lock {p}, skip".format(p=path))
+            continue
+
+        locks.append(
+            {
+                "name": name,
+                "path": path,
+                "holder": holder,
+                "lock_id": lid,
+                "version": zstat.version,
+                "czxid": zstat.czxid,
+                "ctime": zstat.ctime / 1000.0,
+                "mtime": zstat.mtime / 1000.0,
+                "ephemeral": zstat.ephemeralOwner != 0,
+                "children": zstat.numChildren,
+            }
+        )
+
+    return locks
+
+
+class LockIndex(object):
+    """
+    Reverse indexes of the locks returned by `scan_locks`, to find out who
+    holds what.
+
+        idx = LockIndex(scan_locks(zk))
+        idx.find(node_id="web-3")
+        idx.oldest(50)
+
+    `by_node_id`, `by_ip`, `by_process` and `by_txid` are `dict`s of lists of
+    locks. The key of `by_process` is `(ip, process_id)`.
+    """
+
+    def __init__(self, locks):
+        self.locks = locks
+
+        self.by_node_id = {}
+        self.by_ip = {}
+        self.by_process = {}
+        self.by_txid = {}
+
+        for lck in locks:
+            lid = lck["lock_id"]
+            self.by_node_id.setdefault(lid["node_id"], []).append(lck)
+            self.by_ip.setdefault(lid["ip"], []).append(lck)
+            self.by_process.setdefault((lid["ip"], lid["process_id"]), []).append(lck)
+            if lid["txid"] is not None:
+                self.by_txid.setdefault(lid["txid"], []).append(lck)
+
+        self._by_age = None
+
+    def find(self, node_id=None, ip=None, process_id=None, txid=None):
+        """
+        :return: the locks whose holder matches all of the specified fields.
+        """
+        if txid is not None:
+            locks = self.by_txid.get(txid, [])
+        elif ip is not None and process_id is not None:
+            locks = self.by_process.get((ip, process_id), [])
+        elif node_id is not None:
+            locks = self.by_node_id.get(node_id, [])
+        elif ip is not None:
+            locks = self.by_ip.get(ip, [])
+        else:
+            locks = self.locks
+
+        want = {"node_id": node_id, "ip": ip, "process_id": process_id, "txid": txid}
+        want = {k: v for k, v in want.items() if v is not None}
+
+        return [lck for lck in locks if all([lck["lock_id"][k] == v for k, v in want.items()])]
+
+    def oldest(self, n=None):
+        """
+        :return: the `n` locks created the earliest, the oldest first.
+        All of the locks if `n` is `None`.
+        """
+        if self._by_age is None:
+            self._by_age = sorted(self.locks, key=lambda lck: lck["ctime"])
+
+        return self._by_age[:n]
+
+    def summary(self, now=None):
+        """
+        :return: a `dict` of `node_id` to
+        `{"locks": number_of_locks, "processes": number_of_processes, "max_age": seconds}`.
+        """
+        if now is None:
+            now = time.time()
+
+        rst = {}
+        for node_id, locks in self.by_node_id.items():
+            rst[node_id] = {
+                "locks": len(locks),
+                "processes": len(set([(lck["lock_id"]["ip"], lck["lock_id"]["process_id"]) for lck in locks])),
+                "max_age": max([now - lck["ctime"] for lck in locks]),
+            }
+
+        return rst
+
+
+def migrate_lock_shards(zkclient, zkconf=None, dry_run=False, concurrency=256):
+    """
+    Move the locks in the flat `ZKConf.lock_dir()` into their shards, after
+    `lock_shards` is configured.
+
+    Every lock is moved in a transaction of a version-checked `delete` and a
+    `create`, thus a lock updated or released meanwhile is left in place.
+    `ephemeral` locks belong to a session and can not be moved, they are left
+    in place until their holders release them. Directories of queued locks,
+    `ZKRWLock` and `ZKSemaphore` are left too.
+
+    Processes still using the flat layout must be stopped before migrating,
+    or a lock might be held on both of the paths.
+
+    :param dry_run: only find out the locks to move.
+    :return: a tuple of two lists of lock names: moved and left.
+    """
+    zkclient, zkconf = _normalize(zkclient, zkconf)
+
+    if not zkconf.lock_shards():
+        raise ValueError("lock_shards is not configured")
+
+    lock_dir = zkconf.lock_dir()
+    try:
+        names = zkclient.get_children(lock_dir.rstrip("/") or "/")
+    except NoNodeError:
+        return [], []
+
+    names = [n for n in names if n not in reserved_lock_names]
+
+    movable = []
+    left = []
+    for name, rst in pipeline(names, lambda n: zkclient.get_async(lock_dir + n), concurrency):
+        if isinstance(rst, NoNodeError):
+            continue
+        if isinstance(rst, Exception):
+            raise rst
+
+        val, zstat = rst
+        if zstat.ephemeralOwner != 0 or zstat.numChildren > 0:
+            left.append(name)
+            continue
+
+        movable.append((name, val, zstat.version))
+
+    if dry_run or len(movable) == 0:
+        return [m[0] for m in movable], left
+
+    acl = zkconf.kazoo_digest_acl()
+    _ensure_shard_dirs(zkclient, zkconf, acl, concurrency)
+
+    def _move(m):
+        name, val, version = m
+        tx = zkclient.transaction()
+        tx.delete(lock_dir + name, version=version)
+        tx.create(zkconf.lock(name), val, acl=acl)
+        return tx.commit_async()
+
+    moved = []
+    for (name, _, _), rst in pipeline(movable, _move, concurrency):
+        if isinstance(rst, Exception):
+            raise rst
+
+        errs = [r for r in rst if isinstance(r, Exception)]
+        if len(errs) > 0:
+            logger.info("{e} while move lock {n}, leave it".format(e=errs, n=name))
+            left.append(name)
+            continue
+
+        logger.info("MOVED: {n} to {p}".format(n=name, p=zkconf.lock(name)))
+        moved.append(name)
+
+    return moved, left
+
+
+def pipeline(items, send, concurrency=256):
+    """
+    Call `send(item)` for every item, with at most `concurrency` requests on
+    the wire without waiting for reply.
+
+    :param send: returns a kazoo async result.
+    :return: a list of `(item, result)`, `result` is the exception if the
+    request failed.
+    """
+    rst = []
+    for i in range(0, len(items), concurrency):
+        batch = [(it, send(it)) for it in items[i : i + concurrency]]
+        for it, ar in batch:
+            try:
+                rst.append((it, ar.get()))
+            except Exception as e:
+                rst.append((it, e))
+
+    return rst
+
+
+def _ensure_shard_dirs(zkclient, zkconf, acl, concurrency):
+    parent = zkconf.lock_dir() + "__shard__"
+    try:
+        zkclient.create(parent, acl=acl, makepath=True)
+    except NodeExistsError:
+        pass
+
+    dirs = [d.rstrip("/") for d in zkconf.lock_shard_dirs()]
+    for _, rst in pipeline(dirs, lambda d: zkclient.create_async(d, acl=acl), concurrency):
+        if isinstance(rst, Exception) and not isinstance(rst, NodeExistsError):
+            raise rst
+
+
+def _normalize(zkclient, zkconf):
+    if zkconf is None:
+        zkconf = ZKConf()
+    if isinstance(zkconf, dict):
+        zkconf = ZKConf(**zkconf)
+
+    if isinstance(zkclient, KazooClientExt):
+        zkclient = zkclient._zk
+
+    return zkclient, zkconf
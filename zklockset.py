@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import bisect
+import logging
+import random
+import threading
+import time
+
+import k3utfjson
+
+from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import RolledBackError
+
+from . import zkutil
+from .exceptions import BackwardLockingConflict
+from .zklock import ZKLock
+from .zklock import prepare_lock_env
+
+logger = logging.getLogger(__name__)
+
+
+class ZKLockSet(object):
+    """
+    ZKLockSet acquires a set of locks all-or-nothing, in one zookeeper transaction.
+
+    Lock nodes are the same as the ones `ZKLock` uses, thus a `ZKLockSet` and a
+    `ZKLock` on the same lock name exclude each other.
+    A connection listener is registered once for the entire set.
+    """
+
+    def __init__(
+        self, lock_names, zkconf=None, zkclient=None, on_lost=None, identifier=None, ephemeral=True, timeout=10
+    ):
+        (
+            self.zkconf,
+            self.zkclient,
+            self.owning_client,
+            self.identifier,
+        ) = prepare_lock_env(zkconf, zkclient, on_lost, identifier)
+
+        self._hosts = ",".join(["{0}:{1}".format(*x) for x in self.zkclient.hosts])
+
+        self.on_lost = on_lost
+
+        self.lock_names = sorted(set(lock_names))
+        self.lock_paths = {n: self.zkconf.lock(n) for n in self.lock_names}
+        self.ephemeral = ephemeral
+        self.timeout = timeout
+
+        # shard dirs are created once on first use, a transaction can not makepath.
+        self._shard_dirs_ready = not self.zkconf.lock_shards()
+
+        self.mutex = threading.RLock()
+        self.maybe_available = threading.Event()
+        self.maybe_available.set()
+
+        # lock name to (holder identifier, zk node version)
+        self.lock_holders = {}
+
+        logger.info("adding event listener: {s}".format(s=self))
+        self.zkclient.add_listener(self.on_connection_change)
+
+    def on_node_change(self, watchevent):
+        with self.mutex:
+            self.maybe_available.set()
+
+            if self.is_locked():
+                if self.on_lost is not None:
+                    self.on_lost()
+
+        logger.info("node state changed:{ev}, locks might be released: {s}".format(ev=watchevent, s=str(self)))
+
+    def on_connection_change(self, state):
+        with self.mutex:
+            self.maybe_available.set()
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def acquire_loop(self, timeout=None):
+        """
+        Same as `ZKLock.acquire_loop` except that it yields a `dict` of
+        `{lock_name: (holder, version)}` of the locks held by others.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        expire_at = time.time() + timeout
+
+        while True:
+            if not self.maybe_available.wait(timeout=expire_at - time.time()):
+                logger.debug("locks are still held by others: " + str(self))
+
+                if time.time() > expire_at:
+                    raise LockTimeout("locks: " + str(self.locked_by_others()))
+
+            self._create()
+            self._acquire_by_get()
+            if self.is_locked():
+                return
+
+            if self.maybe_available.is_set():
+                continue
+            else:
+                yield self.locked_by_others()
+
+    def acquire(self, timeout=None):
+        for _ in self.acquire_loop(timeout=timeout):
+            continue
+
+    def try_acquire(self):
+        """
+        Try to acquire all of the locks and return result.
+        It never blocks.
+        :return: a tuple of result and a `dict` of locks held by others.
+        Such as `(True, {})` or `(False, {"foo": ({"id": "aa-xx-cc", "val": None}, 0)})`.
+        """
+        try:
+            self.acquire(timeout=-1)
+        except LockTimeout:
+            pass
+
+        return self.is_locked(), self.locked_by_others()
+
+    def release(self):
+        """
+        Release all of the locks in one transaction if they have been locked.
+        Otherwise return silently.
+
+        If this lock set initiated a connection by itself, it will be closed.
+
+        :return: Nothing
+        """
+        with self.mutex:
+            mine = self._locked_names()
+            if len(mine) > 0:
+                self.zkclient.remove_listener(self.on_connection_change)
+
+                tx = self.zkclient.transaction()
+                for n in mine:
+                    tx.delete(self.lock_paths[n])
+
+                if not _tx_ok(tx.commit()):
+                    # Some of the lock nodes are already gone, delete the others one by one.
+                    self._delete_each(mine)
+
+                self.lock_holders = {}
+                logger.info("RELEASED: {s}".format(s=str(self)))
+            else:
+                logger.info("not acquired, do not need to release")
+
+        self.close()
+
+    def close(self):
+        self.zkclient.remove_listener(self.on_connection_change)
+
+        if self.owning_client:
+            logger.info("zk client is made by me, close it")
+            zkutil.close_zk(self.zkclient)
+
+    def is_locked(self):
+        return len(self._locked_names()) == len(self.lock_names)
+
+    def locked_by_others(self):
+        return {n: h for n, h in self.lock_holders.items() if not self.cmp_identifier(h[0], self.identifier)}
+
+    def cmp_identifier(self, ia, ib):
+        return ia["id"] == ib["id"]
+
+    def _locked_names(self):
+        return [n for n, h in self.lock_holders.items() if self.cmp_identifier(h[0], self.identifier)]
+
+    def _create(self):
+        mine = set(self._locked_names())
+        names = [n for n in self.lock_names if n not in mine]
+
+        if len(names) == 0:
+            return
+
+        logger.debug("to create {n}: {s}".format(n=names, s=str(self)))
+
+        value = k3utfjson.dump(self.identifier).encode("utf-8")
+        acl = self.zkconf.kazoo_digest_acl()
+
+        if not self._shard_dirs_ready:
+            self._ensure_shard_dirs(acl)
+
+        tx = self.zkclient.transaction()
+        for n in names:
+            tx.create(self.lock_paths[n], value, acl=acl, ephemeral=self.ephemeral)
+
+        rsts = tx.commit()
+        for rst in rsts:
+            if isinstance(rst, NodeExistsError):
+                # Held by others, or created by us but the response was lost.
+                # The following get tells.
+                logger.debug(repr(rst) + " while create locks: {s}".format(s=str(self)))
+                return
+
+            if isinstance(rst, Exception) and not isinstance(rst, RolledBackError):
+                raise rst
+
+        logger.info("CREATE OK: {s}".format(s=str(self)))
+
+    def _ensure_shard_dirs(self, acl):
+        dirs = sorted(set([self.lock_paths[n].rsplit("/", 1)[0] for n in self.lock_names]))
+        rsts = [self.zkclient.ensure_path_async(d, acl=acl) for d in dirs]
+        for rst in rsts:
+            rst.get()
+
+        self._shard_dirs_ready = True
+
+    def _acquire_by_get(self):
+        logger.debug("to get: {s}".format(s=str(self)))
+
+        with self.mutex:
+            # pipeline all gets, it takes one round trip.
+            rsts = [
+                (n, self.zkclient.get_async(self.lock_paths[n], watch=self.on_node_change)) for n in self.lock_names
+            ]
+
+            holders = {}
+            absent = False
+            for n, rst in rsts:
+                try:
+                    holder, zstat = rst.get()
+                except NoNodeError as e:
+                    logger.info(repr(e) + " while get lock {n}: {s}".format(n=n, s=str(self)))
+                    absent = True
+                    continue
+
+                holders[n] = (k3utfjson.load(holder), zstat.version)
+
+            self.lock_holders = holders
+
+            if self.is_locked():
+                logger.info("ACQUIRED: {s}".format(s=str(self)))
+                return
+
+            if absent and len(self.locked_by_others()) == 0:
+                # locks are just released, retry at once
+                self.maybe_available.set()
+            else:
+                logger.debug("other holds: {s}".format(s=str(self)))
+                self.maybe_available.clear()
+
+    def _delete_each(self, names):
+        rsts = [(n, self.zkclient.delete_async(self.lock_paths[n])) for n in names]
+        for n, rst in rsts:
+            try:
+                rst.get()
+            except NoNodeError as e:
+                logger.info(repr(e) + " while delete lock {n}: {s}".format(n=n, s=str(self)))
+
+    def __str__(self):
+        return "<id={id} {l}:[{holders}] on {h}>".format(
+            id=self.identifier["id"],
+            l=",".join(self.lock_names),
+            holders=(self.locked_by_others() or ""),
+            h=str(self._hosts),
+        )
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, tp, value, tb):
+        self.release()
+
+
+class ZKOrderedLockSet(object):
+    """
+    ZKOrderedLockSet acquires `ZKLock`s one by one, when the keys to lock are
+    not known in advance, without dead lock.
+
+    Locking a key greater than all of the held keys is a forward locking, it
+    waits until the lock is acquired or timeout. Otherwise it is a backward
+    locking (see `zkutil.is_backward_locking`), which only tries once and
+    raises `BackwardLockingConflict` if the lock is held by others.
+
+    `run()` calls a function that locks keys with `lock()`. On conflict it
+    releases all of the held locks and calls it again after a randomized
+    exponential backoff:
+
+        def job(ls):
+            ls.lock("b")
+            ls.lock("a")
+            ...
+
+        ZKOrderedLockSet(zkclient=zk).run(job)
+
+    Held keys are kept sorted, thus checking a key is O(log n).
+    """
+
+    def __init__(self, zkclient, timeout=10, backoff=0.01, max_backoff=1.0, max_restarts=None, **lock_kwargs):
+        """
+        :param zkclient: the zk client shared by all of the locks.
+        :param timeout: timeout in seconds of a forward locking.
+        :param backoff: the initial upper bound in seconds of the sleep before a restart.
+        It doubles on every restart until `max_backoff`.
+        :param max_restarts: `run()` re-raises `BackwardLockingConflict` after
+        so many restarts. `None` means no limit.
+        :param lock_kwargs: other arguments passed to `ZKLock`.
+        """
+        self.zkclient = zkclient
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.lock_kwargs = lock_kwargs
+
+        # sorted held keys and key to ZKLock
+        self.keys = []
+        self.locks = {}
+
+        self.forward = 0
+        self.backward = 0
+        self.conflicts = 0
+        self.restarts = 0
+
+    def lock(self, key):
+        """
+        Lock `key`, it does nothing if `key` is already held.
+        :return: nothing
+        :raise: `BackwardLockingConflict` if it is a backward locking and the
+        lock is held by others. `LockTimeout` if it is a forward locking and timeout.
+        """
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return
+
+        lck = ZKLock(key, zkclient=self.zkclient, timeout=self.timeout, **self.lock_kwargs)
+
+        if i == len(self.keys):
+            self.forward += 1
+            try:
+                lck.acquire()
+            except Exception:
+                lck.close()
+                raise
+        else:
+            self.backward += 1
+            locked, holder, ver = lck.try_acquire()
+            if not locked:
+                lck.close()
+                self.conflicts += 1
+                raise BackwardLockingConflict(
+                    "backward locking {k} before {last}, held by: {h}".format(k=key, last=self.keys[-1], h=holder)
+                )
+
+        self.keys.insert(i, key)
+        self.locks[key] = lck
+
+    def is_backward_locking(self, key):
+        return len(self.keys) > 0 and key < self.keys[-1]
+
+    def release(self):
+        """
+        Release all of the held locks.
+        """
+        while len(self.keys) > 0:
+            key = self.keys.pop()
+            self.locks.pop(key).release()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func(self, *args, **kwargs)` until it returns without
+        `BackwardLockingConflict`. All of the locks are released before it
+        returns.
+        :return: what `func` returns.
+        """
+        n = 0
+        while True:
+            try:
+                return func(self, *args, **kwargs)
+            except BackwardLockingConflict as e:
+                if self.max_restarts is not None and n >= self.max_restarts:
+                    raise
+
+                n += 1
+                self.restarts += 1
+                logger.info(repr(e) + " restart #{n}".format(n=n))
+            finally:
+                self.release()
+
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (n - 1))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tp, value, tb):
+        self.release()
+
+
+def _tx_ok(rsts):
+    for rst in rsts:
+        if isinstance(rst, Exception):
+            return False
+    return True
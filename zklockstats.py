@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import bisect
+import threading
+
+# upper bounds in seconds of histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+_COUNTERS = (
+    ("acquired", "Number of times a lock is acquired."),
+    ("timeout", "Number of LockTimeout raised while acquiring a lock."),
+    ("retries", "Number of extra rounds in acquire_loop before a lock is acquired or timed out."),
+    ("released", "Number of times a lock is released."),
+    ("lost", "Number of times a held lock is found lost."),
+)
+
+_HISTOGRAMS = (
+    ("wait", "Seconds spent in acquire_loop, including the timed out ones."),
+    ("hold", "Seconds a lock is held, from acquired to released."),
+)
+
+
+class ZKLockStats(object):
+    """
+    ZKLockStats aggregates lock events per lock name in memory.
+
+    Pass it to `ZKLock(stats=...)` or any object with the same `on_*` methods
+    to receive the events instead:
+
+        stats = ZKLockStats()
+        with ZKLock("foo", zkclient=zk, stats=stats):
+            ...
+        stats.snapshot()["foo"]["hold"]["count"]  # 1
+        print(stats.prometheus())
+
+    Hooks are called in the thread where the event happens, thus they must be
+    thread safe and cheap.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="zklock"):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.mutex = threading.Lock()
+        # lock name to _LockNameStats
+        self.locks = {}
+
+    def on_acquired(self, lock_name, wait, retries):
+        with self.mutex:
+            st = self._get(lock_name)
+            st.counters["acquired"] += 1
+            st.counters["retries"] += retries
+            st.histograms["wait"].add(wait)
+
+    def on_timeout(self, lock_name, wait, retries):
+        with self.mutex:
+            st = self._get(lock_name)
+            st.counters["timeout"] += 1
+            st.counters["retries"] += retries
+            st.histograms["wait"].add(wait)
+
+    def on_released(self, lock_name, hold):
+        with self.mutex:
+            st = self._get(lock_name)
+            st.counters["released"] += 1
+            st.histograms["hold"].add(hold)
+
+    def on_lost(self, lock_name):
+        with self.mutex:
+            self._get(lock_name).counters["lost"] += 1
+
+    def mean_hold(self, lock_name):
+        """
+        :return: the average seconds `lock_name` is held, or `None` if it has
+        never been released.
+        """
+        with self.mutex:
+            st = self.locks.get(lock_name)
+            if st is None or st.histograms["hold"].count == 0:
+                return None
+
+            h = st.histograms["hold"]
+            return h.sum / h.count
+
+    def reset(self):
+        with self.mutex:
+            self.locks = {}
+
+    def snapshot(self):
+        """
+        :return: a `dict` of lock name to its stats, such as:
+        `{"foo": {"acquired": 1, "timeout": 0, "retries": 0, "released": 1, "lost": 0,
+        "wait": {"count": 1, "sum": 0.002, "buckets": [[0.001, 0], [0.005, 1], ...]},
+        "hold": {...}}}`.
+        Histogram buckets are cumulative, the same as prometheus.
+        """
+        with self.mutex:
+            return {name: st.snapshot() for name, st in self.locks.items()}
+
+    def prometheus(self):
+        """
+        :return: stats in prometheus text exposition format.
+        """
+        snap = self.snapshot()
+        names = sorted(snap.keys())
+
+        lines = []
+        for k, hlp in _COUNTERS:
+            metric = "{p}_{k}_total".format(p=self.prefix, k=k)
+            lines.append("# HELP {m} {h}".format(m=metric, h=hlp))
+            lines.append("# TYPE {m} counter".format(m=metric))
+            for name in names:
+                lines.append("{m}{{lock={n}}} {v}".format(m=metric, n=_label(name), v=snap[name][k]))
+
+        for k, hlp in _HISTOGRAMS:
+            metric = "{p}_{k}_seconds".format(p=self.prefix, k=k)
+            lines.append("# HELP {m} {h}".format(m=metric, h=hlp))
+            lines.append("# TYPE {m} histogram".format(m=metric))
+            for name in names:
+                h = snap[name][k]
+                lbl = _label(name)
+                for le, cnt in h["buckets"]:
+                    lines.append('{m}_bucket{{lock={n},le="{le}"}} {c}'.format(m=metric, n=lbl, le=le, c=cnt))
+                lines.append('{m}_bucket{{lock={n},le="+Inf"}} {c}'.format(m=metric, n=lbl, c=h["count"]))
+                lines.append("{m}_sum{{lock={n}}} {v}".format(m=metric, n=lbl, v=repr(h["sum"])))
+                lines.append("{m}_count{{lock={n}}} {v}".format(m=metric, n=lbl, v=h["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def _get(self, lock_name):
+        st = self.locks.get(lock_name)
+        if st is None:
+            st = _LockNameStats(self.buckets)
+            self.locks[lock_name] = st
+        return st
+
+
+class _LockNameStats(object):
+    def __init__(self, buckets):
+        self.counters = {k: 0 for k, _ in _COUNTERS}
+        self.histograms = {k: _Histogram(buckets) for k, _ in _HISTOGRAMS}
+
+    def snapshot(self):
+        rst = dict(self.counters)
+        for k, h in self.histograms.items():
+            rst[k] = h.snapshot()
+        return rst
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last one is for values greater than all of the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+
+    def snapshot(self):
+        cumulative = []
+        n = 0
+        for le, cnt in zip(self.buckets, self.counts):
+            n += cnt
+            cumulative.append([le, n])
+
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+def _label(v):
+    v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return '"' + v + '"'
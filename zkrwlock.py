@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import threading
+import time
+import uuid
+
+import k3utfjson
+
+from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NotEmptyError
+
+from . import zkutil
+from .zklock import prepare_lock_env
+
+logger = logging.getLogger(__name__)
+
+READ = "read"
+WRITE = "write"
+
+
+class ZKRWLock(object):
+    """
+    ZKRWLock implements a zookeeper based distributed read-write lock.
+
+    Readers share the lock and a writer holds it exclusively.
+    Contenders line up as `ephemeral` `sequence` nodes under
+    `ZKConf.lock(lock_name)`, a reader waits for the nearest writer before it
+    and a writer waits for its predecessor. Thus the lock is granted in FIFO
+    order and neither readers nor writers starve.
+
+    With `writer_preference=True`, a reader that has not yet acquired the lock
+    gives way to the writers arrived after it, thus waiting writers are always
+    served before waiting readers.
+
+    `ZKRWLock` and `ZKLock` must not be used on the same `lock_name`.
+    """
+
+    def __init__(
+        self,
+        lock_name,
+        write=False,
+        zkconf=None,
+        zkclient=None,
+        on_lost=None,
+        identifier=None,
+        timeout=10,
+        writer_preference=False,
+    ):
+        (
+            self.zkconf,
+            self.zkclient,
+            self.owning_client,
+            self.identifier,
+        ) = prepare_lock_env(zkconf, zkclient, on_lost, identifier)
+
+        self._hosts = ",".join(["{0}:{1}".format(*x) for x in self.zkclient.hosts])
+
+        self.on_lost = on_lost
+
+        self.lock_name = lock_name
+        self.lock_path = self.zkconf.lock(self.lock_name)
+        self.mode = WRITE if write else READ
+        self.timeout = timeout
+        self.writer_preference = writer_preference
+
+        self.node = None
+        self._guid = uuid.uuid4().hex
+
+        self.mutex = threading.RLock()
+        self.maybe_available = threading.Event()
+        self.maybe_available.set()
+        self.lock_holder = None
+
+        logger.info("adding event listener: {s}".format(s=self))
+        self.zkclient.add_listener(self.on_connection_change)
+
+    def on_node_change(self, watchevent):
+        # watch on our own node
+        with self.mutex:
+            self.maybe_available.set()
+
+            if self.is_locked():
+                if self.on_lost is not None:
+                    self.on_lost()
+
+        logger.info("node state changed:{ev}, lock might be lost: {s}".format(ev=watchevent, s=str(self)))
+
+    def on_queue_change(self, watchevent):
+        # watch on the node we are waiting for
+        with self.mutex:
+            self.maybe_available.set()
+
+        logger.info("blocker changed:{ev}, might be my turn: {s}".format(ev=watchevent, s=str(self)))
+
+    def on_connection_change(self, state):
+        with self.mutex:
+            self.maybe_available.set()
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def acquire_loop(self, timeout=None):
+        """
+        Same as `ZKLock.acquire_loop`.
+        While waiting it yields the identifier and version of the node this
+        lock is waiting for.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        expire_at = time.time() + timeout
+
+        try:
+            while True:
+                if not self.maybe_available.wait(timeout=expire_at - time.time()):
+                    logger.debug("lock is still held by others: " + str(self))
+
+                    if time.time() > expire_at:
+                        raise LockTimeout("lock: " + str(self.lock_path))
+
+                self._enqueue()
+                blocker = self._find_blocker()
+
+                if self.node is None:
+                    # lost our node or gave way to writers, line up again
+                    continue
+
+                if blocker is None:
+                    self._acquired()
+                    if self.is_locked():
+                        return
+                    continue
+
+                self._get_blocker(blocker)
+
+                if self.maybe_available.is_set():
+                    continue
+                else:
+                    yield self.lock_holder[0], self.lock_holder[1]
+        finally:
+            if self.node is not None and not self.is_locked():
+                try:
+                    self._dequeue()
+                except Exception as e:
+                    logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
+
+    def acquire(self, timeout=None):
+        for _ in self.acquire_loop(timeout=timeout):
+            continue
+
+    def try_acquire(self):
+        """
+        Try to acquire the lock and return result.
+        It never blocks.
+        :return: a tuple of result, lock holder and lock holder version, the
+        same as `ZKLock.try_acquire`.
+        """
+        try:
+            self.acquire(timeout=-1)
+        except LockTimeout:
+            pass
+
+        return self.is_locked(), self.lock_holder[0], self.lock_holder[1]
+
+    def release(self):
+        """
+        Release the lock if it has been locked.
+        Otherwise return silently.
+
+        If this lock initiated a connection by itself, it will be closed.
+
+        :return: Nothing
+        """
+        with self.mutex:
+            if self.is_locked():
+                self.zkclient.remove_listener(self.on_connection_change)
+
+                self._dequeue()
+                self.lock_holder = None
+
+                logger.info("RELEASED: {s}".format(s=str(self)))
+            else:
+                logger.info("not acquired, do not need to release")
+
+        self.close()
+
+    def close(self):
+        self.zkclient.remove_listener(self.on_connection_change)
+
+        if self.node is not None:
+            try:
+                self._dequeue()
+            except Exception as e:
+                logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
+
+        if self.owning_client:
+            logger.info("zk client is made by me, close it")
+            zkutil.close_zk(self.zkclient)
+
+    def is_locked(self):
+        holder = self.lock_holder
+        if holder is None:
+            return False
+
+        return self.cmp_identifier(holder[0], self.identifier)
+
+    def cmp_identifier(self, ia, ib):
+        return ia["id"] == ib["id"]
+
+    def _enqueue(self):
+        if self.node is not None:
+            return
+
+        while True:
+            try:
+                self.node = self.zkclient.create(
+                    "{p}/{m}-{g}-".format(p=self.lock_path, m=self.mode, g=self._guid),
+                    k3utfjson.dump(self.identifier).encode("utf-8"),
+                    ephemeral=True,
+                    sequence=True,
+                    makepath=True,
+                    acl=self.zkconf.kazoo_digest_acl(),
+                )
+                break
+            except NoNodeError as e:
+                # the dir is deleted by a leaving one after makepath
+                logger.info(repr(e) + " while create node, retry: " + str(self))
+
+        logger.debug("ENQUEUED: {s}".format(s=str(self)))
+
+    def _dequeue(self):
+        node, self.node = self.node, None
+        if node is None:
+            return
+
+        try:
+            self.zkclient.delete(node)
+        except NoNodeError as e:
+            logger.info(repr(e) + " while delete lock node: " + str(self))
+
+        # zookeeper refuses it if others are still in it
+        try:
+            self.zkclient.delete(self.lock_path)
+        except (NoNodeError, NotEmptyError) as e:
+            logger.debug(repr(e) + " while delete lock dir: " + str(self))
+
+    def _find_blocker(self):
+        """
+        Return the name of the node this lock has to wait for, or `None` if
+        nothing blocks it. `self.node` is reset if it has to line up again.
+        """
+        try:
+            children = self.zkclient.get_children(self.lock_path)
+        except NoNodeError:
+            children = []
+
+        children = sorted(children, key=_node_seq)
+        name = self.node.rsplit("/", 1)[-1]
+        if name not in children:
+            logger.info("lock node lost: {s}".format(s=str(self)))
+            self.node = None
+            return None
+
+        idx = children.index(name)
+        before = children[:idx]
+
+        if self.mode == WRITE:
+            return (before or [None])[-1]
+
+        if self.writer_preference:
+            after = children[idx + 1 :]
+            if len([c for c in after if _node_mode(c) == WRITE]) > 0:
+                # Not acquired yet, line up again behind the writers arrived after us.
+                logger.info("give way to writers: {s}".format(s=str(self)))
+                self._dequeue()
+                return None
+
+        writers = [c for c in before if _node_mode(c) == WRITE]
+        return (writers or [None])[-1]
+
+    def _get_blocker(self, blocker):
+        with self.mutex:
+            self.maybe_available.clear()
+            try:
+                holder, zstat = self.zkclient.get(self.lock_path + "/" + blocker, watch=self.on_queue_change)
+            except NoNodeError:
+                # blocker just left
+                self.maybe_available.set()
+                return
+
+            self.lock_holder = (k3utfjson.load(holder), zstat.version)
+
+    def _acquired(self):
+        with self.mutex:
+            # watch our own node to find out lock lost
+            zstat = self.zkclient.exists(self.node, watch=self.on_node_change)
+            if zstat is None:
+                self.node = None
+                return
+
+            self.lock_holder = (self.identifier, zstat.version)
+
+        logger.info("ACQUIRED: {s}".format(s=str(self)))
+
+    def __str__(self):
+        return "<id={id} {m} {l}:[{holder}] on {h}>".format(
+            id=self.identifier["id"],
+            m=self.mode,
+            l=self.node or self.lock_path,
+            holder=(self.lock_holder or ""),
+            h=str(self._hosts),
+        )
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, tp, value, tb):
+        self.release()
+
+
+def _node_seq(name):
+    # lock node name: <read|write>-<guid>-<10 digit sequence>
+    return name[-10:]
+
+
+def _node_mode(name):
+    return name.split("-", 1)[0]
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import logging
+import threading
+import time
+import uuid
+
+import k3utfjson
+
+from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NotEmptyError
+
+from . import zkutil
+from .zklock import prepare_lock_env
+
+logger = logging.getLogger(__name__)
+
+
+class ZKSemaphore(object):
+    """
+    ZKSemaphore grants up to `max_leases` leases on `lock_name` cluster wide.
+
+    Contenders line up as `ephemeral` `sequence` nodes under
+    `ZKConf.lock(lock_name)`, the first `max_leases` of them hold a lease.
+    The value of a node is the identifier of the contender, the same as
+    `ZKLock`.
+
+    A waiter does not watch the whole directory: the first waiter watches the
+    children, and every other one only watches its predecessor. A waiter that
+    becomes a holder touches its own node to wake up the next one. Thus a
+    released lease wakes up O(1) waiters.
+
+    `ZKSemaphore`, `ZKLock` and `ZKRWLock` must not be used on the same
+    `lock_name`.
+
+        with ZKSemaphore("foo", 3, zkclient=zk):
+            ...
+    """
+
+    def __init__(
+        self,
+        lock_name,
+        max_leases,
+        zkconf=None,
+        zkclient=None,
+        on_lost=None,
+        identifier=None,
+        timeout=10,
+    ):
+        if max_leases < 1:
+            raise ValueError("max_leases must be at least 1, but: {n}".format(n=max_leases))
+
+        (
+            self.zkconf,
+            self.zkclient,
+            self.owning_client,
+            self.identifier,
+        ) = prepare_lock_env(zkconf, zkclient, on_lost, identifier)
+
+        self._hosts = ",".join(["{0}:{1}".format(*x) for x in self.zkclient.hosts])
+
+        self.on_lost = on_lost
+
+        self.lock_name = lock_name
+        self.lock_path = self.zkconf.lock(self.lock_name)
+        self.max_leases = max_leases
+        self.timeout = timeout
+
+        self.node = None
+        self._guid = uuid.uuid4().hex
+        # number of contenders before this one
+        self.ahead = None
+        self._waited = False
+        self.leased = False
+
+        self.mutex = threading.RLock()
+        self.maybe_available = threading.Event()
+        self.maybe_available.set()
+
+        logger.info("adding event listener: {s}".format(s=self))
+        self.zkclient.add_listener(self.on_connection_change)
+
+    def on_node_change(self, watchevent):
+        # watch on our own node
+        with self.mutex:
+            self.maybe_available.set()
+
+            if self.is_locked():
+                if self.on_lost is not None:
+                    self.on_lost()
+
+        logger.info("node state changed:{ev}, lease might be lost: {s}".format(ev=watchevent, s=str(self)))
+
+    def on_queue_change(self, watchevent):
+        # watch on the predecessor or on the children
+        with self.mutex:
+            self.maybe_available.set()
+
+        logger.info("queue changed:{ev}, might be my turn: {s}".format(ev=watchevent, s=str(self)))
+
+    def on_connection_change(self, state):
+        with self.mutex:
+            self.maybe_available.set()
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def acquire_loop(self, timeout=None):
+        """
+        Same as `ZKLock.acquire_loop` except that while waiting it yields the
+        number of contenders before this one, holders included.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        expire_at = time.time() + timeout
+
+        try:
+            while True:
+                if not self.maybe_available.wait(timeout=expire_at - time.time()):
+                    logger.debug("leases are still held by others: " + str(self))
+
+                    if time.time() > expire_at:
+                        raise LockTimeout("semaphore: " + str(self.lock_path))
+
+                self._enqueue()
+                self._check()
+
+                if self.is_locked():
+                    return
+
+                if self.maybe_available.is_set():
+                    continue
+                else:
+                    yield self.ahead
+        finally:
+            if self.node is not None and not self.is_locked():
+                try:
+                    self._dequeue()
+                except Exception as e:
+                    logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
+
+    def acquire(self, timeout=None):
+        for _ in self.acquire_loop(timeout=timeout):
+            continue
+
+    def try_acquire(self):
+        """
+        Try to acquire a lease and return result.
+        It never blocks.
+        :return: a tuple of result and the identifiers of the current holders.
+        """
+        try:
+            self.acquire(timeout=-1)
+        except LockTimeout:
+            pass
+
+        return self.is_locked(), self.get_holders()
+
+    def get_holders(self):
+        """
+        :return: a list of identifiers of the current lease holders, in the
+        order they are granted. All of the holders are read in one round trip.
+        """
+        children = self._get_children()[: self.max_leases]
+
+        rsts = [self.zkclient.get_async(self.lock_path + "/" + c) for c in children]
+
+        holders = []
+        for rst in rsts:
+            try:
+                val, _ = rst.get()
+            except NoNodeError:
+                # just released
+                continue
+            holders.append(k3utfjson.load(val))
+
+        return holders
+
+    def release(self):
+        """
+        Release the lease if it has been acquired.
+        Otherwise return silently.
+
+        If this semaphore initiated a connection by itself, it will be closed.
+
+        :return: Nothing
+        """
+        with self.mutex:
+            if self.is_locked():
+                self.zkclient.remove_listener(self.on_connection_change)
+
+                self.leased = False
+                self._dequeue()
+
+                logger.info("RELEASED: {s}".format(s=str(self)))
+            else:
+                logger.info("not acquired, do not need to release")
+
+        self.close()
+
+    def close(self):
+        self.zkclient.remove_listener(self.on_connection_change)
+
+        if self.node is not None:
+            try:
+                self._dequeue()
+            except Exception as e:
+                logger.info(repr(e) + " while dequeue: {s}".format(s=str(self)))
+
+        if self.owning_client:
+            logger.info("zk client is made by me, close it")
+            zkutil.close_zk(self.zkclient)
+
+    def is_locked(self):
+        return self.leased
+
+    def _enqueue(self):
+        if self.node is not None:
+            return
+
+        while True:
+            try:
+                self.node = self.zkclient.create(
+                    "{p}/lease-{g}-".format(p=self.lock_path, g=self._guid),
+                    k3utfjson.dump(self.identifier).encode("utf-8"),
+                    ephemeral=True,
+                    sequence=True,
+                    makepath=True,
+                    acl=self.zkconf.kazoo_digest_acl(),
+                )
+                break
+            except NoNodeError as e:
+                # the dir is deleted by a leaving one after makepath
+                logger.info(repr(e) + " while create node, retry: " + str(self))
+
+        self._waited = False
+
+        logger.debug("ENQUEUED: {s}".format(s=str(self)))
+
+    def _dequeue(self):
+        node, self.node = self.node, None
+        if node is None:
+            return
+
+        try:
+            self.zkclient.delete(node)
+        except NoNodeError as e:
+            logger.info(repr(e) + " while delete lease node: " + str(self))
+
+        # zookeeper refuses it if others are still in it
+        try:
+            self.zkclient.delete(self.lock_path)
+        except (NoNodeError, NotEmptyError) as e:
+            logger.debug(repr(e) + " while delete semaphore dir: " + str(self))
+
+    def _get_children(self, watch=None):
+        try:
+            children = self.zkclient.get_children(self.lock_path, watch=watch)
+        except NoNodeError:
+            children = []
+
+        return sorted(children, key=_node_seq)
+
+    def _check(self):
+        with self.mutex:
+            self.maybe_available.clear()
+
+        children = self._get_children()
+        idx = self._index(children)
+
+        if idx == self.max_leases:
+            # The first waiter: wake up on any release.
+            children = self._get_children(watch=self.on_queue_change)
+            idx = self._index(children)
+
+        if idx is None:
+            # lost our node, line up again
+            with self.mutex:
+                self.node = None
+                self.maybe_available.set()
+            return
+
+        self.ahead = idx
+
+        if idx < self.max_leases:
+            self._leased()
+            return
+
+        if idx > self.max_leases:
+            self._waited = True
+            predecessor = self.lock_path + "/" + children[idx - 1]
+            if self.zkclient.exists(predecessor, watch=self.on_queue_change) is None:
+                # predecessor just left
+                self.maybe_available.set()
+        else:
+            self._waited = True
+
+        logger.debug("{n} ahead: {s}".format(n=idx, s=str(self)))
+
+    def _index(self, children):
+        name = self.node.rsplit("/", 1)[-1]
+        if name not in children:
+            logger.info("lease node lost: {s}".format(s=str(self)))
+            return None
+
+        return children.index(name)
+
+    def _leased(self):
+        if self._waited:
+            # The next waiter might be watching our node, wake it up.
+            try:
+                self.zkclient.set(self.node, k3utfjson.dump(self.identifier).encode("utf-8"))
+            except NoNodeError as e:
+                logger.info(repr(e) + " while touch lease node: " + str(self))
+
+        with self.mutex:
+            # watch our own node to find out lease lost
+            if self.zkclient.exists(self.node, watch=self.on_node_change) is None:
+                self.node = None
+                self.maybe_available.set()
+                return
+
+            self.leased = True
+            self.maybe_available.set()
+
+        logger.info("ACQUIRED: {s}".format(s=str(self)))
+
+    def __str__(self):
+        return "<id={id} {l}:[{ahead}/{n}] on {h}>".format(
+            id=self.identifier["id"],
+            l=self.node or self.lock_path,
+            ahead=self.ahead,
+            n=self.max_leases,
+            h=str(self._hosts),
+        )
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, tp, value, tb):
+        self.release()
+
+
+def _node_seq(name):
+    # lease node name: lease-<guid>-<10 digit sequence>
+    return name[-10:]
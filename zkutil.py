@@ -337,13 +337,13 @@ def is_backward_locking(locked_keys, key):
     :param key: is the key to lock.
     :return: a `bool` indicate if locking `key` would be a backward-locking.
     """
-    locked_keys = sorted(locked_keys)
     assert key not in locked_keys, "must not re-lock a key"
 
+    # Only the greatest locked key matters, no need to sort.
     if len(locked_keys) == 0:
         is_backward = False
     else:
-        is_backward = key < locked_keys[-1]
+        is_backward = key < max(locked_keys)
 
     return is_backward
 